@@ -1,35 +1,168 @@
-import os, time
-from email_service.utils import create_client, run_prompt, poll_for_response
+import os, json, argparse
+from datetime import date
+from openai import NotFoundError
+from email_service.utils import build_context_instructions
+from email_service.backends import BACKENDS, get_backend
+from email_service.tools.o365_toolkit import toolkit_registry
+from email_service.tools.utils import account_pool
+from email_service.tools.throttling import throttle_stats
+from email_service.openai_clients import rate_limits
 
 ## Assign environmental files
 # Set your OpenAI API key
-os.environ["OPENAI_API_KEY"] = "YOUR API KEY"
+os.environ.setdefault("OPENAI_API_KEY", "YOUR API KEY")
 # Set your Microsoft Graph client ID
-os.environ["CLIENT_ID"] = "YOUR CLIENT ID"
+os.environ.setdefault("CLIENT_ID", "YOUR CLIENT ID")
 # Set your Microsoft Graph client secret
-os.environ["CLIENT_SECRET"] = "YOUR CLIENT SECRET"
+os.environ.setdefault("CLIENT_SECRET", "YOUR CLIENT SECRET")
 
 # Assign constants
-first_loop = True
-debug = False
-model = "gpt-4o"
-LOOP_DELAY_SECONDS = 3
+DEFAULT_MODEL = "gpt-4o"
+# File where the thread id of the last session is saved, for --resume
+SESSION_FILE = os.path.expanduser("~/.admingpt_cli_session.json")
+GREETING_PROMPT = 'Confirm you\'re ready by replying, "Hello, [MY FULL NAME]. How can I assist you today?"'
 
-# Main loop for the application
-while True:
 
-    if first_loop:
+def load_thread_id():
+    """Returns the thread id saved by the last session, if any."""
+    try:
+        with open(SESSION_FILE) as f:
+            return json.load(f).get("thread_id")
+    except (OSError, ValueError):
+        return None
+
+
+def save_thread_id(thread_id):
+    with open(SESSION_FILE, "w") as f:
+        json.dump({"thread_id": thread_id}, f)
+
+
+class Session:
+    """
+    One conversation for the whole CLI session.
+
+    Follow-up prompts run in the same conversation, so they keep its context,
+    and the per-run context is only rebuilt when the day changes.
+    """
+
+    def __init__(self, model=DEFAULT_MODEL, debug=False, resume=None, stream=True, backend=None):
+        self.model = model
+        self.debug = debug
+        self.stream = stream
+        self.backend = get_backend("cli", backend)
+        self.resumed = False
+
+        if resume and not self.backend.supports_resume:
+            print("Error: The " + self.backend.name + " backend can't resume conversations, starting a new one.")
+        elif resume:
+            try:
+                self.conversation = self.backend.create(debug, model, conversation_id=resume)
+                self.resumed = True
+            except NotFoundError:
+                print("Error: Thread " + resume + " was not found, starting a new conversation.")
+        if not self.resumed:
+            self.conversation = self.backend.create(debug, model)
+        if self.backend.supports_resume:
+            save_thread_id(self.conversation.id)
+
+        self._context_date = None
+        self._context = None
+
+    def context_instructions(self):
+        """The per-run context, which includes the date, so it's rebuilt daily."""
+        if self._context_date != date.today():
+            self._context = build_context_instructions()
+            self._context_date = date.today()
+        return self._context
+
+    def ask(self, prompt):
+        """Runs a prompt in the session's conversation, printing the response as it streams."""
+        streamed = []
+
+        def on_text(text):
+            streamed.append(text)
+            print(text, end="", flush=True)
+
+        response = self.backend.execute(
+            self.conversation,
+            prompt,
+            stream=self.stream,
+            additional_instructions=self.context_instructions(),
+            on_text=on_text,
+        )
+
+        if streamed:
+            print()
+        else:
+            # Polled runs and failures don't stream any text
+            print(response)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat with the AdminGPT assistant.")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--debug", action="store_true")
+    parser.add_argument(
+        "--resume",
+        nargs="?",
+        const="last",
+        metavar="THREAD_ID",
+        help="Continue a conversation, the last session's by default.",
+    )
+    parser.add_argument(
+        "--no-stream", dest="stream", action="store_false", help="Poll runs instead of streaming."
+    )
+    parser.add_argument(
+        "--backend",
+        choices=list(BACKENDS),
+        help="Execution backend (default is ADMINGPT_CLI_BACKEND, or assistants).",
+    )
+    args = parser.parse_args()
+
+    resume = load_thread_id() if args.resume == "last" else args.resume
+    if args.resume == "last" and resume is None:
+        print("Error: There is no saved conversation to resume, starting a new one.")
+
+    session = Session(
+        model=args.model, debug=args.debug, resume=resume, stream=args.stream, backend=args.backend
+    )
+    if session.backend.supports_resume:
+        print("Conversation " + session.conversation.id + " (continue it with --resume)")
+
+    if not session.resumed:
         # Start with a default prompt
-        prompt = 'Confirm you\'re ready by replying, "Hello, [MY FULL NAME]. How can I assist you today?"'
-        first_loop = False
-    else:
-        prompt = input("Enter your request here: ")
+        session.ask(GREETING_PROMPT)
+
+    # Main loop for the application
+    while True:
+        try:
+            prompt = input("Enter your request here: ")
+        except (EOFError, KeyboardInterrupt):
+            print()
+            break
+
         if prompt.lower() == "stop":
             break
+        if prompt.lower() == "stats":
+            # Print the tool timings, account pool, Graph throttling and OpenAI rate limit
+            # counters for this session
+            print(
+                json.dumps(
+                    {
+                        "tools": toolkit_registry.stats(),
+                        "accounts": account_pool.stats(),
+                        "graph": throttle_stats.stats(),
+                        "openai": rate_limits.stats(),
+                    },
+                    indent=4,
+                )
+            )
+            continue
+        if not prompt.strip():
+            continue
+
+        session.ask(prompt)
 
-    (client, assistant, thread) = create_client(debug, model)
-    run = run_prompt(prompt, client, assistant, thread)
-    response = poll_for_response(client, thread, run, model, debug)
-    print(response)
 
-    time.sleep(LOOP_DELAY_SECONDS)
+if __name__ == "__main__":
+    main()
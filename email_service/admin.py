@@ -1,3 +1,7 @@
 from django.contrib import admin
+from .models import Tenant
 
 # Register your models here.
+@admin.register(Tenant)
+class TenantAdmin(admin.ModelAdmin):
+    list_display = ("slug", "assistant_first_name", "model", "max_concurrency", "is_active")
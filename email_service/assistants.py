@@ -0,0 +1,291 @@
+import os, json, time, hashlib, threading
+from datetime import datetime as dt, timedelta, timezone
+from openai import APIError, NotFoundError
+from openai.types.beta import Assistant
+
+ASSISTANT_NAME = "AI Administrative Assistant"
+# Assistants not used for this long are deleted from OpenAI and the registry
+STALE_ASSISTANT_DAYS = 14
+# Only persist a new last-used time once it is older than this
+LAST_USED_RESOLUTION = timedelta(hours=1)
+# Registry file used by the CLI, which runs without the Django database
+REGISTRY_FILE = os.environ.get("ADMINGPT_ASSISTANTS_FILE") or os.path.expanduser(
+    "~/.admingpt_assistants.json"
+)
+# A registered Assistant is checked to still exist at most this often per process
+VERIFY_INTERVAL_SECONDS = 600
+
+# When each registered Assistant was last found to exist, by id
+_verified_at = {}
+_verified_lock = threading.Lock()
+
+
+def _digest(value) -> str:
+    """Stable SHA-256 digest of any JSON-serializable value."""
+    return hashlib.sha256(
+        json.dumps(value, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def assistant_key(instructions, model, tools, temperature) -> str:
+    """Registry key for an Assistant configuration."""
+    return _digest(
+        {
+            "instructions": instructions,
+            "model": model,
+            "tools": tools,
+            "temperature": temperature,
+        }
+    )
+
+
+class DjangoAssistantStore:
+    """Assistant registry persisted in the Django database."""
+
+    def get(self, key):
+        from .models import AssistantRecord
+
+        record = AssistantRecord.objects.filter(key=key).first()
+        if record is None:
+            return None
+        return {
+            "assistant_id": record.assistant_id,
+            "model": record.model,
+            "instructions_hash": record.instructions_hash,
+            "last_used_at": record.last_used_at,
+        }
+
+    def save(self, key, record):
+        from .models import AssistantRecord
+
+        AssistantRecord.objects.update_or_create(key=key, defaults=record)
+
+    def add(self, key, record):
+        """Saves record unless key is registered already, returning the registered record."""
+        from .models import AssistantRecord
+
+        _, created = AssistantRecord.objects.get_or_create(key=key, defaults=record)
+        return record if created else self.get(key)
+
+    def delete(self, key):
+        from .models import AssistantRecord
+
+        AssistantRecord.objects.filter(key=key).delete()
+
+    def delete_assistant(self, assistant_id):
+        from .models import AssistantRecord
+
+        AssistantRecord.objects.filter(assistant_id=assistant_id).delete()
+
+    def stale(self, before):
+        from .models import AssistantRecord
+
+        return list(
+            AssistantRecord.objects.filter(last_used_at__lt=before).values_list(
+                "key", "assistant_id"
+            )
+        )
+
+
+class FileAssistantStore:
+    """Assistant registry persisted in a JSON file, used by the CLI."""
+
+    def __init__(self, path=None):
+        self.path = path or REGISTRY_FILE
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _dump(self, records):
+        with open(self.path, "w") as f:
+            json.dump(records, f, indent=4)
+
+    def get(self, key):
+        with self._lock:
+            record = self._load().get(key)
+        if record is None:
+            return None
+        record["last_used_at"] = dt.fromisoformat(record["last_used_at"])
+        return record
+
+    def save(self, key, record):
+        with self._lock:
+            records = self._load()
+            records[key] = {**record, "last_used_at": record["last_used_at"].isoformat()}
+            self._dump(records)
+
+    def add(self, key, record):
+        """Saves record unless key is registered already, returning the registered record."""
+        with self._lock:
+            records = self._load()
+            if key not in records:
+                records[key] = {**record, "last_used_at": record["last_used_at"].isoformat()}
+                self._dump(records)
+                return record
+            existing = records[key]
+        existing["last_used_at"] = dt.fromisoformat(existing["last_used_at"])
+        return existing
+
+    def delete(self, key):
+        with self._lock:
+            records = self._load()
+            records.pop(key, None)
+            self._dump(records)
+
+    def delete_assistant(self, assistant_id):
+        with self._lock:
+            records = self._load()
+            self._dump(
+                {
+                    key: record
+                    for key, record in records.items()
+                    if record["assistant_id"] != assistant_id
+                }
+            )
+
+    def stale(self, before):
+        with self._lock:
+            records = self._load()
+        return [
+            (key, record["assistant_id"])
+            for key, record in records.items()
+            if dt.fromisoformat(record["last_used_at"]) < before
+        ]
+
+
+def get_store(interface="cli"):
+    """Return the registry store for an interface."""
+    if interface == "email":
+        return DjangoAssistantStore()
+    return FileAssistantStore()
+
+
+def _recently_verified(assistant_id):
+    with _verified_lock:
+        verified_at = _verified_at.get(assistant_id)
+    return verified_at is not None and time.monotonic() - verified_at < VERIFY_INTERVAL_SECONDS
+
+
+def _mark_verified(assistant_id):
+    with _verified_lock:
+        _verified_at[assistant_id] = time.monotonic()
+
+
+def get_or_create_assistant(
+    client,
+    instructions,
+    model,
+    tools,
+    temperature,
+    interface="cli",
+):
+    """
+    Return an Assistant for the given configuration, reusing a registered one if possible.
+
+    A registered Assistant is checked to still exist once every VERIFY_INTERVAL_SECONDS,
+    and created again if it was deleted outside the registry.
+
+    Parameters:
+    instructions (str): The static instructions that identify the Assistant.
+
+    Returns:
+    Assistant: The registered Assistant. On a verified registry hit only its id, name and model are set.
+    """
+    store = get_store(interface)
+    key = assistant_key(instructions, model, tools, temperature)
+    now = dt.now(timezone.utc)
+
+    record = store.get(key)
+    assistant = None
+    if record is not None and not _recently_verified(record["assistant_id"]):
+        try:
+            assistant = client.beta.assistants.retrieve(record["assistant_id"])
+            _mark_verified(assistant.id)
+        except NotFoundError:
+            # The Assistant was deleted outside the registry, so create a new one
+            store.delete(key)
+            record = None
+
+    if record is None:
+        # Nothing to reuse, so this is also a good time to clean up old Assistants
+        collect_stale_assistants(client, store)
+
+        assistant = client.beta.assistants.create(
+            name=ASSISTANT_NAME,
+            instructions=instructions,
+            model=model,
+            tools=tools,
+            temperature=temperature,
+        )
+        record = store.add(
+            key,
+            {
+                "assistant_id": assistant.id,
+                "model": model,
+                "instructions_hash": _digest(instructions),
+                "last_used_at": now,
+            },
+        )
+        if record["assistant_id"] == assistant.id:
+            _mark_verified(assistant.id)
+            return assistant
+
+        # Another process registered an Assistant for this configuration first, so
+        # use theirs and delete ours, which the registry would never clean up
+        try:
+            client.beta.assistants.delete(assistant.id)
+        except APIError as e:
+            print("Warning: Could not delete assistant " + assistant.id + ": " + str(e))
+        return Assistant.model_construct(
+            id=record["assistant_id"], name=ASSISTANT_NAME, model=model, object="assistant"
+        )
+
+    if now - record["last_used_at"] > LAST_USED_RESOLUTION:
+        store.save(key, {**record, "last_used_at": now})
+
+    if assistant is not None:
+        return assistant
+    return Assistant.model_construct(
+        id=record["assistant_id"], name=ASSISTANT_NAME, model=model, object="assistant"
+    )
+
+
+def forget_missing_assistant(client, assistant_id, interface="cli"):
+    """
+    Drops an Assistant from the registry if it no longer exists, so the next run creates it again.
+
+    Called when starting a run fails with NotFoundError, which may also mean the
+    thread is missing.
+
+    Returns:
+    bool: Whether the Assistant was missing.
+    """
+    try:
+        client.beta.assistants.retrieve(assistant_id)
+        return False
+    except NotFoundError:
+        with _verified_lock:
+            _verified_at.pop(assistant_id, None)
+        get_store(interface).delete_assistant(assistant_id)
+        return True
+
+
+def collect_stale_assistants(client, store, max_age_days=STALE_ASSISTANT_DAYS):
+    """Delete registered Assistants that have not been used for max_age_days."""
+    before = dt.now(timezone.utc) - timedelta(days=max_age_days)
+    for key, assistant_id in store.stale(before):
+        try:
+            client.beta.assistants.delete(assistant_id)
+        except NotFoundError:
+            # The Assistant was already deleted outside the registry
+            pass
+        except APIError as e:
+            # Keep the record so deletion is retried on the next collection
+            print("Warning: Could not delete assistant " + assistant_id + ": " + str(e))
+            continue
+        store.delete(key)
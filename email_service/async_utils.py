@@ -0,0 +1,197 @@
+import asyncio
+from asgiref.sync import sync_to_async
+from openai import APIConnectionError, NotFoundError
+from .tools.o365_toolkit import tools, toolkit_registry
+from .tools.async_graph import AsyncGraphClient
+from .tools.profile import get_profile
+from .assistants import forget_missing_assistant, get_or_create_assistant
+from .openai_clients import async_openai_client, openai_client, rate_limits
+from .utils import (
+    build_assistant_instructions,
+    profile_context_instructions,
+    execute_tool_call,
+    _execute_tool_call_in_thread,
+    latest_message_text,
+    PollBackoff,
+    RunEvents,
+    RUN_FAILED_RESPONSE,
+    RUN_FAILED_STATUSES,
+)
+
+"""Maximum number of read-only tools running concurrently within one step."""
+MAX_TOOL_TASKS = 5
+
+
+async def abuild_context_instructions(graph):
+    """Async version of build_context_instructions."""
+    profile = await sync_to_async(get_profile)(graph.account, graph.interface)
+    return profile_context_instructions(profile)
+
+
+async def acreate_client(debug=False, model=None, interface="cli"):
+    """Async version of create_client, returning the event loop's AsyncOpenAI client."""
+    assistant_instructions = build_assistant_instructions(debug=debug, interface=interface)
+
+    # The Assistant registry is synchronous, and only calls the API on a miss
+    assistant = await sync_to_async(get_or_create_assistant)(
+        openai_client(),
+        instructions=assistant_instructions,
+        model=model,
+        tools=tools,
+        temperature=0.05,
+        interface=interface,
+    )
+
+    client = async_openai_client()
+    thread = await client.beta.threads.create()
+
+    return client, assistant, thread
+
+
+async def aexecute_tool_calls(tool_calls, interface="cli"):
+    """
+    Async version of execute_tool_calls.
+
+    The toolkit functions are synchronous, so they run on worker threads: read-only
+    tools concurrently, up to MAX_TOOL_TASKS at a time, and tools that write to the
+    mailbox or calendar one at a time in the order the model requested them.
+    """
+    semaphore = asyncio.Semaphore(MAX_TOOL_TASKS)
+
+    async def execute_read(tool_call):
+        async with semaphore:
+            return await sync_to_async(_execute_tool_call_in_thread, thread_sensitive=False)(
+                tool_call, interface
+            )
+
+    reads = {
+        tool_call.id: asyncio.ensure_future(execute_read(tool_call))
+        for tool_call in tool_calls
+        if toolkit_registry.is_read_only(tool_call.function.name)
+    }
+    outputs = {}
+
+    # Write tools run while the reads are in flight
+    for tool_call in tool_calls:
+        if tool_call.id not in reads:
+            outputs[tool_call.id] = await sync_to_async(execute_tool_call)(
+                tool_call, interface=interface
+            )
+
+    for tool_call_id, task in reads.items():
+        outputs[tool_call_id] = await task
+
+    return [
+        {"tool_call_id": tool_call.id, "output": outputs[tool_call.id]}
+        for tool_call in tool_calls
+    ]
+
+
+async def aexecute_prompt(
+    prompt,
+    client,
+    assistant,
+    thread,
+    model,
+    debug=False,
+    interface="cli",
+    stream=True,
+    additional_instructions=None,
+    on_text=None,
+):
+    """
+    Async version of execute_prompt.
+
+    Parameters:
+    additional_instructions (str): The per-run context, built with an async Graph
+        request if not given.
+    """
+    try:
+        async with rate_limits.aslot(model):
+            await client.beta.threads.messages.create(
+                thread_id=thread.id,
+                role="user",
+                content=prompt,
+            )
+
+            if additional_instructions is None:
+                graph = await AsyncGraphClient.create(interface)
+                additional_instructions = await abuild_context_instructions(graph)
+
+            if not stream:
+                run = await client.beta.threads.runs.create(
+                    thread_id=thread.id,
+                    assistant_id=assistant.id,
+                    additional_instructions=additional_instructions,
+                )
+                return await apoll_for_response(client, thread, run, model, debug, interface)
+
+            stream_manager = client.beta.threads.runs.stream(
+                thread_id=thread.id,
+                assistant_id=assistant.id,
+                additional_instructions=additional_instructions,
+            )
+            return await astream_for_response(
+                client, thread, stream_manager, model, debug, interface, on_text
+            )
+    except NotFoundError:
+        # The Assistant may have been deleted outside the registry, the next run recreates it
+        await sync_to_async(forget_missing_assistant)(openai_client(), assistant.id, interface)
+        raise
+
+
+async def astream_for_response(
+    client, thread, stream_manager, model, debug=False, interface="cli", on_text=None
+):
+    """Async version of stream_for_response."""
+    events = RunEvents(debug, on_text)
+
+    try:
+        while stream_manager is not None:
+            async with stream_manager as stream:
+                stream_manager = None
+
+                async for event in stream:
+                    tool_calls = events.handle(event)
+                    if tool_calls is not None:
+                        # The run pauses here, so submit the outputs on a new stream
+                        stream_manager = client.beta.threads.runs.submit_tool_outputs_stream(
+                            thread_id=thread.id,
+                            run_id=events.run.id,
+                            tool_outputs=await aexecute_tool_calls(tool_calls, interface=interface),
+                        )
+                    elif events.failed:
+                        return RUN_FAILED_RESPONSE
+    except APIConnectionError as e:
+        # The stream broke, so fall back to polling the run if it was created
+        return await apoll_for_response(
+            client, thread, events.run_to_poll(e), model, debug, interface
+        )
+
+    return events.response
+
+
+async def apoll_for_response(client, thread, run, model, debug=False, interface="cli"):
+    """Async version of poll_for_response, waiting with asyncio.sleep between polls."""
+    backoff = PollBackoff(debug)
+
+    while True:
+        run = await client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
+
+        if run.status == "completed":
+            return latest_message_text(
+                await client.beta.threads.messages.list(thread_id=thread.id)
+            )
+        elif run.status == "requires_action":
+            tools_outputs = await aexecute_tool_calls(
+                run.required_action.submit_tool_outputs.tool_calls, interface=interface
+            )
+
+            if run.required_action.type == "submit_tool_outputs":
+                await client.beta.threads.runs.submit_tool_outputs(
+                    thread_id=thread.id, run_id=run.id, tool_outputs=tools_outputs
+                )
+        elif run.status in RUN_FAILED_STATUSES:
+            return RUN_FAILED_RESPONSE
+
+        await asyncio.sleep(backoff.next_delay(run.status))
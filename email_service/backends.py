@@ -0,0 +1,327 @@
+import os, uuid
+from openai.types.chat import ChatCompletionMessageToolCall
+from .tools.o365_toolkit import tools
+from .openai_clients import async_openai_client, openai_client, rate_limits
+from .utils import (
+    build_assistant_instructions,
+    build_context_instructions,
+    create_client,
+    execute_prompt,
+    execute_tool_calls,
+    RUN_FAILED_RESPONSE,
+)
+
+"""Backend of each interface, overridden with ADMINGPT_<INTERFACE>_BACKEND, e.g. ADMINGPT_EMAIL_BACKEND=chat."""
+DEFAULT_BACKENDS = {"cli": "assistants", "email": "assistants"}
+"""Sampling temperature, the same as the registered Assistants'."""
+TEMPERATURE = 0.05
+"""Tool call rounds a Chat Completions run may take before it gives up."""
+MAX_TOOL_ROUNDS = 10
+
+
+class Conversation:
+    """
+    A conversation with the assistant, run by one execution backend.
+
+    Attributes:
+    id (str): Identifies the conversation, the thread id for the Assistants backend.
+    client: The OpenAI or AsyncOpenAI client.
+    state (dict): Backend specific state, e.g. the Assistant and thread, or the messages.
+    """
+
+    def __init__(self, id, client, model, debug=False, interface="cli", **state):
+        self.id = id
+        self.client = client
+        self.model = model
+        self.debug = debug
+        self.interface = interface
+        self.state = state
+
+
+class AssistantsBackend:
+    """
+    Runs prompts on an OpenAI Assistant and a server-side thread.
+
+    Conversations survive the process, so they can be resumed by their thread id.
+    """
+
+    name = "assistants"
+    supports_resume = True
+
+    def create(self, debug=False, model=None, interface="cli", conversation_id=None, client=None):
+        """
+        Starts a conversation, or continues the thread conversation_id.
+
+        Raises:
+        openai.NotFoundError: If the thread doesn't exist.
+        """
+        client, assistant, thread = create_client(
+            debug, model, interface, thread_id=conversation_id, client=client
+        )
+        return Conversation(
+            thread.id, client, model, debug, interface, assistant=assistant, thread=thread
+        )
+
+    def execute(
+        self, conversation, prompt, stream=True, additional_instructions=None, on_text=None
+    ):
+        """Runs a prompt in the conversation and returns the response, see execute_prompt."""
+        return execute_prompt(
+            prompt,
+            conversation.client,
+            conversation.state["assistant"],
+            conversation.state["thread"],
+            conversation.model,
+            conversation.debug,
+            conversation.interface,
+            stream=stream,
+            additional_instructions=additional_instructions,
+            on_text=on_text,
+        )
+
+    async def acreate(self, debug=False, model=None, interface="cli"):
+        """Async version of create."""
+        from .async_utils import acreate_client
+
+        client, assistant, thread = await acreate_client(debug, model, interface)
+        return Conversation(
+            thread.id, client, model, debug, interface, assistant=assistant, thread=thread
+        )
+
+    async def aexecute(
+        self, conversation, prompt, stream=True, additional_instructions=None, on_text=None
+    ):
+        """Async version of execute."""
+        from .async_utils import aexecute_prompt
+
+        return await aexecute_prompt(
+            prompt,
+            conversation.client,
+            conversation.state["assistant"],
+            conversation.state["thread"],
+            conversation.model,
+            conversation.debug,
+            conversation.interface,
+            stream=stream,
+            additional_instructions=additional_instructions,
+            on_text=on_text,
+        )
+
+
+class ChatCompletionsBackend:
+    """
+    Runs prompts with the Chat Completions API, keeping the messages in the conversation.
+
+    A prompt costs one request per tool call round, instead of the Assistants
+    API's message, run and tool output requests, and no Assistant or thread
+    has to be created first. The instructions and tool schemas are the same.
+    Conversations only live in the process, so they can't be resumed.
+    """
+
+    name = "chat"
+    supports_resume = False
+
+    def create(self, debug=False, model=None, interface="cli", conversation_id=None, client=None):
+        """Starts a conversation. conversation_id is not supported, and raises ValueError."""
+        if conversation_id is not None:
+            raise ValueError("Chat Completions conversations can't be resumed.")
+        return Conversation(
+            uuid.uuid4().hex,
+            client or openai_client(),
+            model,
+            debug,
+            interface,
+            instructions=build_assistant_instructions(debug=debug, interface=interface),
+            messages=[],
+        )
+
+    def _messages(self, conversation, additional_instructions):
+        # The static instructions come first, so the prompt prefix can be cached
+        return [
+            {"role": "system", "content": conversation.state["instructions"]},
+            {"role": "system", "content": additional_instructions},
+            *conversation.state["messages"],
+        ]
+
+    def _request(self, conversation, messages, stream):
+        return {
+            "model": conversation.model,
+            "messages": messages,
+            "tools": tools,
+            "temperature": TEMPERATURE,
+            "stream": stream,
+        }
+
+    def execute(
+        self, conversation, prompt, stream=True, additional_instructions=None, on_text=None
+    ):
+        """
+        Runs a prompt in the conversation and returns the response.
+
+        Parameters:
+        stream (bool): Whether to stream the response, calling on_text with its text deltas.
+        additional_instructions (str): The per-run context, built if not given.
+        """
+        if additional_instructions is None:
+            additional_instructions = build_context_instructions(interface=conversation.interface)
+        conversation.state["messages"].append({"role": "user", "content": prompt})
+
+        with rate_limits.slot(conversation.model):
+            for tool_round in range(1, MAX_TOOL_ROUNDS + 1):
+                request = self._request(
+                    conversation, self._messages(conversation, additional_instructions), stream
+                )
+                response = conversation.client.chat.completions.create(**request)
+                if stream:
+                    content, tool_calls = _accumulate(response, on_text)
+                else:
+                    message = response.choices[0].message
+                    content, tool_calls = message.content, message.tool_calls or []
+
+                if conversation.debug:
+                    print(f"Chat completion round {tool_round}: {len(tool_calls)} tool calls")
+
+                if not _record(conversation, content, tool_calls):
+                    return content if content else RUN_FAILED_RESPONSE
+
+                outputs = execute_tool_calls(tool_calls, interface=conversation.interface)
+                _record_outputs(conversation, outputs)
+
+        return RUN_FAILED_RESPONSE
+
+    async def acreate(self, debug=False, model=None, interface="cli"):
+        """Async version of create."""
+        return Conversation(
+            uuid.uuid4().hex,
+            async_openai_client(),
+            model,
+            debug,
+            interface,
+            instructions=build_assistant_instructions(debug=debug, interface=interface),
+            messages=[],
+        )
+
+    async def aexecute(
+        self, conversation, prompt, stream=True, additional_instructions=None, on_text=None
+    ):
+        """Async version of execute."""
+        from .async_utils import abuild_context_instructions, aexecute_tool_calls
+        from .tools.async_graph import AsyncGraphClient
+
+        if additional_instructions is None:
+            graph = await AsyncGraphClient.create(conversation.interface)
+            additional_instructions = await abuild_context_instructions(graph)
+        conversation.state["messages"].append({"role": "user", "content": prompt})
+
+        async with rate_limits.aslot(conversation.model):
+            for tool_round in range(1, MAX_TOOL_ROUNDS + 1):
+                request = self._request(
+                    conversation, self._messages(conversation, additional_instructions), stream
+                )
+                response = await conversation.client.chat.completions.create(**request)
+                if stream:
+                    content, tool_calls = await _aaccumulate(response, on_text)
+                else:
+                    message = response.choices[0].message
+                    content, tool_calls = message.content, message.tool_calls or []
+
+                if conversation.debug:
+                    print(f"Chat completion round {tool_round}: {len(tool_calls)} tool calls")
+
+                if not _record(conversation, content, tool_calls):
+                    return content if content else RUN_FAILED_RESPONSE
+
+                outputs = await aexecute_tool_calls(tool_calls, interface=conversation.interface)
+                _record_outputs(conversation, outputs)
+
+        return RUN_FAILED_RESPONSE
+
+
+def _add_chunk(chunk, content, tool_calls, on_text):
+    """Adds a streamed chunk's text and tool call deltas to the response being built."""
+    if not chunk.choices:
+        return
+    delta = chunk.choices[0].delta
+    if delta.content:
+        content.append(delta.content)
+        if on_text is not None:
+            on_text(delta.content)
+    for call in delta.tool_calls or []:
+        # Tool calls arrive in pieces, identified by their index
+        entry = tool_calls.setdefault(call.index, {"id": "", "name": "", "arguments": ""})
+        entry["id"] = call.id or entry["id"]
+        if call.function is not None:
+            entry["name"] += call.function.name or ""
+            entry["arguments"] += call.function.arguments or ""
+
+
+def _finish(content, tool_calls):
+    return "".join(content), [
+        ChatCompletionMessageToolCall(
+            id=call["id"],
+            type="function",
+            function={"name": call["name"], "arguments": call["arguments"]},
+        )
+        for _, call in sorted(tool_calls.items())
+    ]
+
+
+def _accumulate(stream, on_text=None):
+    """Consumes a streamed completion, returning its text and tool calls."""
+    content, tool_calls = [], {}
+    for chunk in stream:
+        _add_chunk(chunk, content, tool_calls, on_text)
+    return _finish(content, tool_calls)
+
+
+async def _aaccumulate(stream, on_text=None):
+    """Async version of _accumulate."""
+    content, tool_calls = [], {}
+    async for chunk in stream:
+        _add_chunk(chunk, content, tool_calls, on_text)
+    return _finish(content, tool_calls)
+
+
+def _record(conversation, content, tool_calls):
+    """Adds the assistant's message to the conversation, returning whether it called tools."""
+    message = {"role": "assistant", "content": content or None}
+    if tool_calls:
+        message["tool_calls"] = [
+            {
+                "id": call.id,
+                "type": "function",
+                "function": {"name": call.function.name, "arguments": call.function.arguments},
+            }
+            for call in tool_calls
+        ]
+    conversation.state["messages"].append(message)
+    return bool(tool_calls)
+
+
+def _record_outputs(conversation, outputs):
+    conversation.state["messages"].extend(
+        {"role": "tool", "tool_call_id": output["tool_call_id"], "content": output["output"]}
+        for output in outputs
+    )
+
+
+"""Execution backends by name."""
+BACKENDS = {backend.name: backend for backend in (AssistantsBackend(), ChatCompletionsBackend())}
+
+
+def get_backend(interface="cli", name=None):
+    """
+    Returns the execution backend of an interface.
+
+    Parameters:
+    name (str): A backend to use instead of the interface's configured one.
+
+    Raises:
+    ValueError: If the backend doesn't exist.
+    """
+    name = name or os.environ.get(f"ADMINGPT_{interface.upper()}_BACKEND") or DEFAULT_BACKENDS[interface]
+    if name not in BACKENDS:
+        raise ValueError(
+            "Unknown execution backend " + name + ", use one of: " + ", ".join(BACKENDS)
+        )
+    return BACKENDS[name]
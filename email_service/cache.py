@@ -0,0 +1,309 @@
+import json, hashlib
+from datetime import timedelta
+from django.utils import timezone
+from requests.exceptions import HTTPError
+from .models import CachedMessage, CachedEventWindow, CachedProfile, DeltaLink
+from .tenants import current_tenant, tenant_key
+
+# How long cached data may be served at most, even if no change was reported
+MESSAGE_CACHE_TTL = timedelta(hours=6)
+EVENT_CACHE_TTL = timedelta(hours=1)
+PROFILE_CACHE_TTL = timedelta(hours=6)
+# Minimum time between two delta queries for the same resource
+DELTA_SYNC_INTERVAL = timedelta(seconds=30)
+# Changes to inbox messages are tracked for messages received in this many days
+MESSAGE_DELTA_DAYS = 30
+DELTA_PAGE_SIZE = 200
+# Least recently accessed entries are evicted above these sizes, messages per tenant
+MAX_CACHED_MESSAGES = 2000
+MAX_CACHED_EVENT_WINDOWS = 200
+
+INBOX_DELTA_RESOURCE = "messages:inbox"
+
+
+def _follow_delta(account, url, params=None):
+    """Pages through a delta query, returning the changed items and the next delta link."""
+    items = []
+    headers = {"Prefer": f"odata.maxpagesize={DELTA_PAGE_SIZE}"}
+
+    while True:
+        data = account.con.get(url, params=params, headers=headers).json()
+        items.extend(data.get("value", []))
+
+        # Next and delta links already include the query parameters
+        params = None
+        if "@odata.nextLink" in data:
+            url = data["@odata.nextLink"]
+        else:
+            return items, data.get("@odata.deltaLink")
+
+
+def _is_expired_delta(error):
+    """Whether a delta query failed because its sync state is no longer available."""
+    return error.response is not None and error.response.status_code in (404, 410)
+
+
+def _evict(model, max_entries, **filters):
+    """Deletes the least recently accessed entries matching filters above max_entries."""
+    stale = list(
+        model.objects.filter(**filters)
+        .order_by("-accessed_at")
+        .values_list("pk", flat=True)[max_entries:]
+    )
+    if stale:
+        model.objects.filter(pk__in=stale).delete()
+
+
+def _claim_sync(resource, now):
+    """
+    Claims the next delta sync of a resource, so concurrent callers don't all run it.
+
+    Returns:
+    DeltaLink: The resource's delta link, with an empty link before the initial
+        sync, or None if it was synced, or is being synced, within DELTA_SYNC_INTERVAL.
+    """
+    link, created = DeltaLink.objects.get_or_create(
+        resource=resource, defaults={"delta_link": "", "synced_at": now}
+    )
+    if created:
+        return link
+    claimed = DeltaLink.objects.filter(
+        pk=link.pk, synced_at__lt=now - DELTA_SYNC_INTERVAL
+    ).update(synced_at=now)
+    return link if claimed else None
+
+
+def sync_messages(account, initial=False):
+    """
+    Applies inbox changes reported by the messages delta query to the message cache.
+
+    Runs at most once every DELTA_SYNC_INTERVAL, by one caller at a time, while
+    the others read the cache. Changed and removed messages are evicted, so their
+    next read goes to the network.
+
+    The initial sync pages through the ids of every recent inbox message, so it
+    only runs when initial is set, by the worker (see jobs.run_maintenance),
+    never inline in a tool call.
+
+    Returns:
+    bool: Whether the inbox's changes are tracked, so cached messages can be served.
+    """
+    now = timezone.now()
+    resource = tenant_key(INBOX_DELTA_RESOURCE)
+    tracked = DeltaLink.objects.filter(resource=resource).exclude(delta_link="")
+    if not initial and not tracked.exists():
+        return False
+
+    link = _claim_sync(resource, now)
+    if link is None:
+        return True
+
+    delta_link = link.delta_link
+    if delta_link:
+        try:
+            changed, delta_link = _follow_delta(account, delta_link)
+            CachedMessage.objects.filter(
+                tenant=current_tenant(), message_id__in=[item["id"] for item in changed]
+            ).delete()
+        except HTTPError as e:
+            if not _is_expired_delta(e):
+                raise
+            # Changes since the last sync are unknown, so start over
+            delta_link = None
+
+    if not delta_link:
+        # Initial sync only returns the current state, so nothing cached can be trusted
+        CachedMessage.objects.filter(tenant=current_tenant()).delete()
+        if not initial:
+            # Leave the initial sync to the worker, reading from Graph until then
+            DeltaLink.objects.filter(pk=link.pk).update(delta_link="")
+            return False
+        since = (now - timedelta(days=MESSAGE_DELTA_DAYS)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        _, delta_link = _follow_delta(
+            account,
+            account.mailbox().build_url("/mailFolders/inbox/messages/delta"),
+            params={"$select": "id", "$filter": f"receivedDateTime ge {since}"},
+        )
+
+    DeltaLink.objects.filter(pk=link.pk).update(delta_link=delta_link, synced_at=now)
+    return True
+
+
+def _store_message(message_id, data, now):
+    CachedMessage.objects.update_or_create(
+        tenant=current_tenant(),
+        message_id=message_id,
+        defaults={"data": data, "fetched_at": now, "accessed_at": now},
+    )
+
+
+def get_message(account, message_id, fetch):
+    """
+    Returns a message's output dict from the cache, or from fetch() on a miss,
+    or before the worker's initial sync of the inbox.
+
+    Parameters:
+    account (Account): The authenticated account used for delta queries.
+    message_id (str): The message_id of the message.
+    fetch (callable): Retrieves the message's output dict from Microsoft Graph.
+    """
+    if not sync_messages(account):
+        return fetch()
+    now = timezone.now()
+
+    cached = CachedMessage.objects.filter(
+        tenant=current_tenant(), message_id=message_id, fetched_at__gte=now - MESSAGE_CACHE_TTL
+    ).first()
+    if cached is not None:
+        CachedMessage.objects.filter(pk=cached.pk).update(accessed_at=now)
+        return cached.data
+
+    data = fetch()
+    _store_message(message_id, data, now)
+    _evict(CachedMessage, MAX_CACHED_MESSAGES, tenant=current_tenant())
+    return data
+
+
+def get_messages(account, message_ids, fetch_many):
+    """
+    Returns the output dicts of several messages, fetching only the cache misses.
+
+    Parameters:
+    fetch_many (callable): Retrieves the output dicts of a list of message_ids, in order.
+    """
+    if not sync_messages(account):
+        return fetch_many(message_ids)
+    now = timezone.now()
+    tenant = current_tenant()
+
+    cached = {
+        record.message_id: record.data
+        for record in CachedMessage.objects.filter(
+            tenant=tenant, message_id__in=message_ids, fetched_at__gte=now - MESSAGE_CACHE_TTL
+        )
+    }
+    CachedMessage.objects.filter(tenant=tenant, message_id__in=list(cached)).update(
+        accessed_at=now
+    )
+
+    missing = [message_id for message_id in message_ids if message_id not in cached]
+    if missing:
+        for message_id, data in zip(missing, fetch_many(missing)):
+            # Don't cache failed lookups
+            if "error" not in data:
+                _store_message(message_id, data, now)
+            cached[message_id] = data
+        _evict(CachedMessage, MAX_CACHED_MESSAGES, tenant=tenant)
+
+    return [cached[message_id] for message_id in message_ids]
+
+
+def get_events(account, start_datetime, end_datetime, options, fetch):
+    """
+    Returns the output of an events search from the cache, or from fetch() on a miss.
+
+    A window read again is kept fresh with a calendarView delta query, and served
+    as long as the query reports no changes in it. Windows only start to be
+    tracked once they are reused, as a delta query can't $select fields, so its
+    initial sync downloads every event of the window in full.
+
+    Parameters:
+    start_datetime (datetime): Start of the calendar window.
+    end_datetime (datetime): End of the calendar window.
+    options (dict): Any other search parameters that change the output.
+    fetch (callable): Runs the search against Microsoft Graph.
+    """
+    key = hashlib.sha256(
+        json.dumps(
+            [tenant_key(""), start_datetime.isoformat(), end_datetime.isoformat(), options],
+            sort_keys=True,
+        ).encode()
+    ).hexdigest()
+    now = timezone.now()
+
+    window = CachedEventWindow.objects.filter(key=key).first()
+    if window is not None and now - window.fetched_at < EVENT_CACHE_TTL:
+        if now - window.synced_at < DELTA_SYNC_INTERVAL:
+            CachedEventWindow.objects.filter(pk=window.pk).update(accessed_at=now)
+            return window.data
+
+        changed = None
+        if window.delta_link:
+            try:
+                changed, delta_link = _follow_delta(account, window.delta_link)
+            except HTTPError as e:
+                if not _is_expired_delta(e):
+                    raise
+
+        if changed == []:
+            CachedEventWindow.objects.filter(pk=window.pk).update(
+                delta_link=delta_link, synced_at=now, accessed_at=now
+            )
+            return window.data
+
+    delta_link = ""
+    if window is not None:
+        # The window is read again, so track its changes from now on. Start
+        # tracking before fetching, so none are missed in between.
+        _, delta_link = _follow_delta(
+            account,
+            account.schedule().build_url("/calendarView/delta"),
+            params={
+                "startDateTime": start_datetime.isoformat(),
+                "endDateTime": end_datetime.isoformat(),
+            },
+        )
+
+    data = fetch()
+    # Don't cache failed searches, e.g. an invalid page_token
+    if isinstance(data, dict) and "error" in data:
+        return data
+    CachedEventWindow.objects.update_or_create(
+        key=key,
+        defaults={
+            "start_datetime": start_datetime,
+            "end_datetime": end_datetime,
+            "data": data,
+            "delta_link": delta_link,
+            "fetched_at": now,
+            "synced_at": now,
+            "accessed_at": now,
+        },
+    )
+    _evict(CachedEventWindow, MAX_CACHED_EVENT_WINDOWS)
+    return data
+
+
+def invalidate_events(start_datetime, end_datetime):
+    """
+    Drops the cached event windows overlapping a period, e.g. after creating an
+    event in it, so the next search of the period goes to the network.
+    """
+    CachedEventWindow.objects.filter(
+        start_datetime__lt=end_datetime, end_datetime__gt=start_datetime
+    ).delete()
+
+
+def get_profile(key, fetch):
+    """
+    Returns a cached user profile, or the output of fetch() on a miss.
+
+    Profiles rarely change, so they're served for PROFILE_CACHE_TTL unless
+    invalidate_profile is called.
+    """
+    key = tenant_key(key)
+    now = timezone.now()
+    profile = CachedProfile.objects.filter(
+        key=key, fetched_at__gte=now - PROFILE_CACHE_TTL
+    ).first()
+    if profile is not None:
+        return profile.data
+
+    data = fetch()
+    CachedProfile.objects.update_or_create(key=key, defaults={"data": data, "fetched_at": now})
+    return data
+
+
+def invalidate_profile(key):
+    """Drops a cached user profile, so the next read goes to the network."""
+    CachedProfile.objects.filter(key=tenant_key(key)).delete()
@@ -0,0 +1,411 @@
+import asyncio, threading, time
+from contextlib import asynccontextmanager, contextmanager
+from asgiref.sync import sync_to_async
+from datetime import timedelta
+from django.db import connection
+from django.db.models import Count, F, Min, Q
+from django.utils import timezone
+from .models import EmailJob, ProcessedEmail, Tenant
+from .tenants import active_tenants, current_tenant, graph_budget, tenant_context
+from .cache import sync_messages
+from .tools.utils import authenticate
+from .processing import (
+    EMAIL_MODEL,
+    LEASE_DURATION,
+    find_prompt_emails,
+    process_email,
+    aprocess_email,
+    renew_lease,
+    worker_id,
+)
+
+# A claimed job is handed to another worker if not finished within this time
+VISIBILITY_TIMEOUT = LEASE_DURATION
+# Running jobs renew their lease this often, so jobs waiting for an OpenAI slot
+# behind other runs aren't taken over by another worker
+HEARTBEAT_INTERVAL = VISIBILITY_TIMEOUT / 4
+MAX_ATTEMPTS = 3
+# Delay before the first retry, doubled on every further attempt
+RETRY_DELAY = timedelta(seconds=30)
+# Candidates fetched per claim, so concurrent workers rarely race for the same job
+CLAIM_BATCH_SIZE = 5
+# How often workers run the background upkeep of every tenant, see run_maintenance
+MAINTENANCE_INTERVAL = timedelta(minutes=5)
+
+
+def enqueue_email(message_id):
+    """
+    Queues a request email for processing by a worker.
+
+    Enqueueing is idempotent: a message already in the queue keeps its job.
+    The job belongs to the current tenant.
+
+    Returns:
+    tuple: The job, and whether it was created by this call.
+    """
+    return EmailJob.objects.get_or_create(
+        message_id=message_id,
+        defaults={"available_at": timezone.now(), "tenant": current_tenant()},
+    )
+
+
+def enqueue_pending_emails():
+    """
+    Queues every request email in the current tenant's inbox that was not processed
+    or queued yet.
+
+    Returns:
+    list: The message_ids queued by this call, oldest first.
+    """
+    # Oldest first, so the backlog is answered in the order it arrived
+    message_ids = find_prompt_emails()[::-1]
+
+    known = set(
+        ProcessedEmail.objects.filter(message_id__in=message_ids).values_list(
+            "message_id", flat=True
+        )
+    )
+    known.update(
+        EmailJob.objects.filter(message_id__in=message_ids).values_list(
+            "message_id", flat=True
+        )
+    )
+    new_ids = [message_id for message_id in message_ids if message_id not in known]
+
+    now = timezone.now()
+    tenant = current_tenant()
+    EmailJob.objects.bulk_create(
+        [
+            EmailJob(message_id=message_id, available_at=now, tenant=tenant)
+            for message_id in new_ids
+        ],
+        ignore_conflicts=True,
+    )
+    return new_ids
+
+
+def enqueue_all_pending_emails():
+    """Queues the pending request emails of every active tenant, see enqueue_pending_emails."""
+    message_ids = []
+    for tenant in active_tenants():
+        with tenant_context(tenant):
+            message_ids.extend(enqueue_pending_emails())
+    return message_ids
+
+
+def _claimable(now):
+    """Pending jobs that are due, and running jobs whose worker stopped responding."""
+    return Q(status=EmailJob.PENDING, available_at__lte=now) | Q(
+        status=EmailJob.RUNNING, locked_until__lt=now
+    )
+
+
+def _tenant_order(now):
+    """
+    Returns the tenants with claimable jobs in the order they should be served.
+
+    Tenants running the fewest jobs come first, then those whose oldest job has
+    waited longest, so one tenant's backlog can't starve the others. Inactive
+    tenants, tenants running max_concurrency jobs and tenants out of Graph budget
+    are skipped. Jobs without a tenant are served as one more tenant, without limits.
+    """
+    oldest = dict(
+        EmailJob.objects.filter(_claimable(now))
+        .values_list("tenant")
+        .annotate(oldest=Min("available_at"))
+        .order_by()
+    )
+    if not oldest:
+        return []
+
+    running = dict(
+        EmailJob.objects.filter(status=EmailJob.RUNNING, locked_until__gte=now)
+        .values_list("tenant")
+        .annotate(count=Count("pk"))
+        .order_by()
+    )
+    tenants = Tenant.objects.in_bulk([pk for pk in oldest if pk is not None])
+
+    order = []
+    for pk, available_at in oldest.items():
+        tenant = tenants.get(pk)
+        if pk is not None:
+            if tenant is None or not tenant.is_active:
+                continue
+            if running.get(pk, 0) >= tenant.max_concurrency:
+                continue
+            if graph_budget(tenant).available() == 0:
+                continue
+        order.append((running.get(pk, 0), available_at, pk))
+
+    return [pk for _, _, pk in sorted(order, key=lambda entry: entry[:2])]
+
+
+def claim_job(worker):
+    """
+    Atomically claims the next available job for a worker.
+
+    Jobs are claimed fairly across tenants, see _tenant_order. The claim is a
+    conditional UPDATE that only succeeds if the job is still claimable, so it is
+    safe across workers on any database backend. Workers claiming at the same
+    time can briefly exceed a tenant's max_concurrency by one job each.
+
+    Returns:
+    EmailJob: The claimed job, with its tenant, or None if no job is available.
+    """
+    now = timezone.now()
+    for tenant_pk in _tenant_order(now):
+        candidates = EmailJob.objects.filter(_claimable(now), tenant=tenant_pk).order_by(
+            "available_at", "pk"
+        )
+        for pk in candidates.values_list("pk", flat=True)[:CLAIM_BATCH_SIZE]:
+            claimed = (
+                EmailJob.objects.filter(_claimable(now), pk=pk).update(
+                    status=EmailJob.RUNNING,
+                    attempts=F("attempts") + 1,
+                    locked_by=worker,
+                    locked_until=now + VISIBILITY_TIMEOUT,
+                )
+            )
+            if claimed:
+                return EmailJob.objects.select_related("tenant").get(pk=pk)
+    return None
+
+
+def _finish_job(job, result=None, error=None):
+    """
+    Marks a processed job done, or schedules a retry if it failed.
+
+    Results are only saved while the worker still holds the job, so a job that
+    timed out and was claimed by another worker is left to that worker.
+    """
+    owned = EmailJob.objects.filter(pk=job.pk, locked_by=job.locked_by)
+    if error is None:
+        owned.update(status=EmailJob.DONE, result=result, locked_until=None)
+    elif job.attempts >= MAX_ATTEMPTS:
+        owned.update(status=EmailJob.FAILED, last_error=str(error), locked_until=None)
+    else:
+        owned.update(
+            status=EmailJob.PENDING,
+            last_error=str(error),
+            locked_until=None,
+            available_at=timezone.now() + RETRY_DELAY * 2 ** (job.attempts - 1),
+        )
+
+
+def _renew_job(job):
+    """
+    Extends a running job's visibility timeout, and the lease of its email, while
+    the worker still holds it.
+
+    Returns:
+    bool: Whether the worker still holds the job.
+    """
+    renewed = EmailJob.objects.filter(
+        pk=job.pk, locked_by=job.locked_by, status=EmailJob.RUNNING
+    ).update(locked_until=timezone.now() + VISIBILITY_TIMEOUT)
+    if renewed:
+        renew_lease(job.message_id, job.locked_by)
+    return bool(renewed)
+
+
+def _beat(job):
+    try:
+        _renew_job(job)
+    except Exception as e:
+        print("Error: Could not renew the lease of job " + job.message_id + ": " + str(e))
+
+
+@contextmanager
+def _heartbeat(job):
+    """Renews a job's lease every HEARTBEAT_INTERVAL while the block runs."""
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(HEARTBEAT_INTERVAL.total_seconds()):
+                _beat(job)
+        finally:
+            # The heartbeat thread has its own database connection
+            connection.close()
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+@asynccontextmanager
+async def _aheartbeat(job):
+    """Async version of _heartbeat."""
+
+    async def beat():
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL.total_seconds())
+            await sync_to_async(_beat)(job)
+
+    task = asyncio.ensure_future(beat())
+    try:
+        yield
+    finally:
+        task.cancel()
+
+
+def _job_model(job):
+    """The OpenAI model answering a job's email."""
+    return job.tenant.model if job.tenant is not None else EMAIL_MODEL
+
+
+def run_job(job):
+    """Processes a claimed job for its tenant, then marks it done or schedules a retry."""
+    try:
+        with tenant_context(job.tenant), _heartbeat(job):
+            result = process_email(job.message_id, model=_job_model(job), worker=job.locked_by)
+    except Exception as e:
+        print("Error: Could not process email " + job.message_id + ": " + str(e))
+        _finish_job(job, error=e)
+        return None
+
+    _finish_job(job, result=result)
+    return result
+
+
+async def arun_job(job):
+    """Async version of run_job."""
+    try:
+        # Each job runs in its own task, so the tenant stays local to it
+        with tenant_context(job.tenant):
+            async with _aheartbeat(job):
+                result = await aprocess_email(
+                    job.message_id, model=_job_model(job), worker=job.locked_by
+                )
+    except Exception as e:
+        print("Error: Could not process email " + job.message_id + ": " + str(e))
+        await sync_to_async(_finish_job)(job, error=e)
+        return None
+
+    await sync_to_async(_finish_job)(job, result=result)
+    return result
+
+
+def work(once=False, poll_interval=1.0, stop=None):
+    """
+    Claims and runs jobs until stopped.
+
+    Parameters:
+    once (bool): Return as soon as no job is available, instead of waiting for more.
+    poll_interval (float): Seconds to wait before checking an empty queue again.
+    stop (threading.Event): Set to stop the worker after its current job.
+
+    Returns:
+    int: The number of jobs run.
+    """
+    worker = worker_id()
+    count = 0
+    try:
+        while stop is None or not stop.is_set():
+            job = claim_job(worker)
+            if job is None:
+                if once:
+                    break
+                if stop is not None:
+                    stop.wait(poll_interval)
+                else:
+                    time.sleep(poll_interval)
+                continue
+
+            run_job(job)
+            count += 1
+    finally:
+        # Each worker thread has its own database connection
+        connection.close()
+    return count
+
+
+async def awork(concurrency, once=False, poll_interval=1.0, stop=None):
+    """
+    Async version of work: runs up to concurrency jobs at a time on one event loop.
+
+    Parameters:
+    stop (asyncio.Event): Set to stop claiming jobs, the running ones still finish.
+
+    Returns:
+    int: The number of jobs run.
+    """
+    worker = worker_id()
+    claim = sync_to_async(claim_job)
+    running = set()
+    count = 0
+
+    while stop is None or not stop.is_set():
+        # Each job gets its own lease owner, as they run independently
+        job = await claim(f"{worker}:{count}") if len(running) < concurrency else None
+        if job is not None:
+            running.add(asyncio.ensure_future(arun_job(job)))
+            count += 1
+            continue
+
+        if not running and once:
+            break
+
+        # Wait for a job to finish, or poll the queue again
+        if running:
+            done, running = await asyncio.wait(
+                running, timeout=poll_interval, return_when=asyncio.FIRST_COMPLETED
+            )
+        else:
+            await asyncio.sleep(poll_interval)
+
+    if running:
+        await asyncio.wait(running)
+    return count
+
+
+def run_maintenance():
+    """
+    Background upkeep of every active tenant, run by the worker instead of requests:
+    renews the Graph subscription before it expires, and syncs the inbox message
+    cache, including its initial sync.
+    """
+    # Subscriptions queue the emails they're notified of, so import them when used
+    from .subscriptions import maintain_subscription
+
+    for tenant in active_tenants():
+        with tenant_context(tenant):
+            try:
+                maintain_subscription()
+            except Exception as e:
+                print("Error: Could not renew the Graph subscription: " + str(e))
+            try:
+                account = authenticate(interface="email")
+                if account is not None:
+                    sync_messages(account, initial=True)
+            except Exception as e:
+                print("Error: Could not sync the inbox cache: " + str(e))
+
+
+def maintain(stop, interval=MAINTENANCE_INTERVAL):
+    """
+    Runs run_maintenance every interval until stopped.
+
+    Parameters:
+    stop (threading.Event): Set to stop after the current run.
+    """
+    try:
+        while not stop.is_set():
+            run_maintenance()
+            stop.wait(interval.total_seconds())
+    finally:
+        connection.close()
+
+
+def job_stats():
+    """Returns the number of jobs in each status."""
+    counts = dict(
+        EmailJob.objects.values_list("status").annotate(count=Count("pk")).order_by()
+    )
+    return {status: counts.get(status, 0) for status, _ in EmailJob.STATUS_CHOICES}
+
@@ -0,0 +1,212 @@
+import json, time, uuid, threading, statistics
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from ...backends import BACKENDS
+from ...openai_clients import openai_client
+from ...utils import format_context_instructions
+
+"""Tool the stub server asks for. It isn't registered, so it's answered without Microsoft Graph."""
+STUB_TOOL = "benchmark_lookup"
+STUB_RESPONSE = "Hi,<br><br>Here is the answer to your request.<br><br>Best,<br><br>Monica A. Ingenio"
+
+
+class StubOpenAI(BaseHTTPRequestHandler):
+    """
+    Minimal stand-in for the Assistants and Chat Completions endpoints.
+
+    Every request takes latency seconds, like a round trip to the API, and every
+    model turn takes generation seconds more. A prompt first asks for tool_rounds
+    tool calls, then streams STUB_RESPONSE.
+    """
+
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    generation = 0.0
+    tool_rounds = 1
+    requests = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        with self.lock:
+            type(self).requests += 1
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        time.sleep(self.latency)
+        path = self.path.split("?")[0].rstrip("/")
+        parts = path.split("/")
+
+        if path.endswith("/chat/completions"):
+            # The conversation's tool messages tell which round this is
+            rounds = sum(1 for message in body["messages"] if message["role"] == "tool")
+            return self.chat_completion(body.get("model"), rounds < self.tool_rounds)
+        if path.endswith("/assistants"):
+            return self.json({"id": "asst_" + uuid.uuid4().hex, "object": "assistant", **body})
+        if path.endswith("/threads"):
+            return self.json({"id": "thread_" + uuid.uuid4().hex, "object": "thread"})
+        if path.endswith("/messages"):
+            return self.json({"id": "msg_" + uuid.uuid4().hex, "object": "thread.message"})
+        if path.endswith("/runs"):
+            return self.run(parts[-2], "run_" + uuid.uuid4().hex, tool_round=0)
+        if path.endswith("/submit_tool_outputs"):
+            # The run id counts the tool rounds it went through
+            run_id, _, rounds = parts[-2].partition(".")
+            return self.run(parts[-4], run_id, tool_round=int(rounds or 0) + 1)
+        self.json({"error": {"message": "Not found: " + path}}, status=404)
+
+    def json(self, data, status=200):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def stream(self, events):
+        time.sleep(self.generation)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for event, data in events:
+            if event is not None:
+                self.wfile.write(f"event: {event}\n".encode())
+            self.wfile.write(f"data: {json.dumps(data) if data != '[DONE]' else data}\n\n".encode())
+        self.close_connection = True
+
+    def run(self, thread_id, run_id, tool_round):
+        run = {
+            "id": run_id if tool_round == 0 else run_id.partition(".")[0],
+            "object": "thread.run",
+            "thread_id": thread_id,
+            "status": "in_progress",
+        }
+        if tool_round < self.tool_rounds:
+            required = {
+                **run,
+                "id": f"{run['id']}.{tool_round}",
+                "status": "requires_action",
+                "required_action": {
+                    "type": "submit_tool_outputs",
+                    "submit_tool_outputs": {
+                        "tool_calls": [
+                            {
+                                "id": "call_" + uuid.uuid4().hex,
+                                "type": "function",
+                                "function": {"name": STUB_TOOL, "arguments": "{}"},
+                            }
+                        ]
+                    },
+                },
+            }
+            events = [("thread.run.created", run), ("thread.run.requires_action", required)]
+        else:
+            message = {
+                "id": "msg_" + uuid.uuid4().hex,
+                "object": "thread.message",
+                "thread_id": thread_id,
+                "role": "assistant",
+                "status": "in_progress",
+                "content": [],
+            }
+            text = {"type": "text", "text": {"value": STUB_RESPONSE, "annotations": []}}
+            events = [
+                ("thread.run.created", run),
+                ("thread.message.created", message),
+                (
+                    "thread.message.delta",
+                    {"id": message["id"], "object": "thread.message.delta",
+                     "delta": {"content": [{"index": 0, **text}]}},
+                ),
+                ("thread.message.completed", {**message, "status": "completed", "content": [text]}),
+                ("thread.run.completed", {**run, "status": "completed"}),
+            ]
+        self.stream(events + [("done", "[DONE]")])
+
+    def chat_completion(self, model, call_tool):
+        chunk = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+        if call_tool:
+            delta = {
+                "role": "assistant",
+                "tool_calls": [
+                    {
+                        "index": 0,
+                        "id": "call_" + uuid.uuid4().hex,
+                        "type": "function",
+                        "function": {"name": STUB_TOOL, "arguments": "{}"},
+                    }
+                ],
+            }
+            finish_reason = "tool_calls"
+        else:
+            delta = {"role": "assistant", "content": STUB_RESPONSE}
+            finish_reason = "stop"
+        self.stream(
+            [
+                (None, {**chunk, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}),
+                (None, {**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]}),
+                (None, "[DONE]"),
+            ]
+        )
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the latency of answering an email request with each execution backend, "
+        "against a local stub of the OpenAI API that adds a fixed latency per request."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=10)
+        parser.add_argument("--latency-ms", type=float, default=150, help="Latency of each API request.")
+        parser.add_argument("--generation-ms", type=float, default=400, help="Time of each model turn.")
+        parser.add_argument("--tool-rounds", type=int, default=1)
+        parser.add_argument("--model", default="gpt-4o")
+        parser.add_argument("--backend", choices=list(BACKENDS), action="append")
+
+    def handle(self, *args, **options):
+        StubOpenAI.latency = options["latency_ms"] / 1000
+        StubOpenAI.generation = options["generation_ms"] / 1000
+        StubOpenAI.tool_rounds = options["tool_rounds"]
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StubOpenAI)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        client = openai_client("benchmark", base_url=f"http://127.0.0.1:{server.server_port}/v1")
+        context = format_context_instructions(
+            "Benchmark User", "benchmark@example.com", "America/New_York", "Monday, January 06, 2025"
+        )
+        prompt = "From: benchmark@example.com\nBody: Hi Monica, what's on my calendar today?"
+
+        try:
+            # The Assistants registry is rolled back, leaving the database as it was
+            with transaction.atomic():
+                for name in options["backend"] or list(BACKENDS):
+                    self.benchmark(BACKENDS[name], client, context, prompt, options)
+                transaction.set_rollback(True)
+        finally:
+            server.shutdown()
+
+    def benchmark(self, backend, client, context, prompt, options):
+        latencies, requests = [], []
+
+        # The first prompt registers the Assistant, which later ones reuse
+        for i in range(options["iterations"] + 1):
+            StubOpenAI.requests = 0
+            start = time.perf_counter()
+            conversation = backend.create(model=options["model"], interface="email", client=client)
+            response = backend.execute(conversation, prompt, additional_instructions=context)
+            if i == 0:
+                if response != STUB_RESPONSE:
+                    self.stderr.write(f"{backend.name}: unexpected response {response!r}")
+                continue
+            latencies.append(time.perf_counter() - start)
+            requests.append(StubOpenAI.requests)
+
+        self.stdout.write(
+            f"{backend.name:>10}: mean latency {statistics.mean(latencies) * 1000:.0f}ms, "
+            f"p50 {statistics.median(latencies) * 1000:.0f}ms, "
+            f"max {max(latencies) * 1000:.0f}ms, "
+            f"{statistics.mean(requests):.1f} API requests per prompt"
+        )
@@ -0,0 +1,150 @@
+import os, time, random, statistics
+from django.core.management.base import BaseCommand
+from ...tools.body import extract_text, etree
+
+
+def bs4_clean_body(body):
+    """The previous clean_body, the reference for output and timings."""
+    from bs4 import BeautifulSoup
+
+    body = BeautifulSoup(str(body), "html.parser").get_text()
+    body = "".join(body.splitlines())
+    return " ".join(body.split())
+
+
+def newsletter_email(rng, sections=40):
+    """A long marketing email: nested layout tables, inline styles, tracking links."""
+    rows = []
+    for i in range(sections):
+        words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 120)))
+        rows.append(
+            f'<tr><td style="padding:12px 24px;font-family:Arial,sans-serif;color:#333">'
+            f'<table role="presentation" width="100%"><tr><td><h2 style="margin:0">Story {i}</h2>'
+            f'<p style="line-height:1.5">{words}&nbsp;&mdash; '
+            f'<a href="https://links.example.com/c/{rng.getrandbits(64):x}?utm_source=newsletter">'
+            f"Read more &raquo;</a></p></td></tr></table></td></tr>\n"
+        )
+    return (
+        '<html><head><meta charset="utf-8"><title>Weekly digest</title>'
+        "<style>td{font-size:14px}@media (max-width:600px){.col{width:100%!important}}</style>"
+        '</head><body><!--[if mso]><table><tr><td><![endif]-->'
+        '<table width="600" align="center" cellpadding="0" cellspacing="0">'
+        + "".join(rows)
+        + '</table><img src="https://t.example.com/open.gif" width="1" height="1">'
+        "<script>track()</script></body></html>"
+    )
+
+
+def outlook_reply_email(rng, depth=6):
+    """An Outlook reply with the quoted history of the thread below it."""
+    body = ""
+    for i in range(depth):
+        words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 80)))
+        body += (
+            f'<div dir="ltr"><p class="MsoNormal">{words}</p></div>'
+            '<div id="appendonsend"></div><hr style="display:inline-block;width:98%">'
+            '<div id="divRplyFwdMsg" dir="ltr"><font face="Calibri" style="font-size:11pt">'
+            f"<b>From:</b> Person {i} &lt;person{i}@example.com&gt;<br><b>Sent:</b> Monday, "
+            f"March {i + 1}, 2024 10:00 AM<br><b>To:</b> Team &lt;team@example.com&gt;<br>"
+            "<b>Subject:</b> RE: Quarterly planning</font><div>&nbsp;</div></div>"
+        )
+    return f"<html><body>{body}</body></html>"
+
+
+def gmail_forward_email(rng):
+    """A Gmail forward, whose quoted content is the email to act on."""
+    words = " ".join(rng.choice(WORDS) for _ in range(60))
+    return (
+        '<div dir="ltr">Hi Monica, can you find a time?<br><br>'
+        '<div class="gmail_quote"><div dir="ltr" class="gmail_attr">---------- Forwarded '
+        "message ---------<br>From: <strong>Guest</strong> &lt;guest@example.com&gt;<br>"
+        "Subject: Meeting<br></div><br><br>"
+        f'<div dir="ltr">{words}</div></div></div>'
+    )
+
+
+def plain_text_email(rng):
+    """A plain text body, as returned for text/plain messages."""
+    return "\n\n".join(
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(10, 40))) for _ in range(8)
+    )
+
+
+WORDS = (
+    "meeting schedule tomorrow available quarterly budget review please confirm "
+    "update agenda notes attached thanks regards team project deadline call "
+    "availability proposal draft customer launch café résumé 10:30 a.m. $1,200"
+).split()
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures clean_body over a corpus of real-world-shaped HTML emails, comparing "
+        "the previous BeautifulSoup implementation with the streaming extractor."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=20)
+        parser.add_argument(
+            "--corpus-dir", help="Directory of .html or .txt bodies to use instead of the built-in corpus."
+        )
+        parser.add_argument("--limit", type=int, default=150)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def corpus(self, options):
+        if options["corpus_dir"]:
+            corpus = {}
+            for name in sorted(os.listdir(options["corpus_dir"])):
+                if name.endswith((".html", ".htm", ".txt")):
+                    with open(os.path.join(options["corpus_dir"], name), encoding="utf-8") as f:
+                        corpus[name] = f.read()
+            return corpus
+
+        rng = random.Random(options["seed"])
+        return {
+            "newsletter": newsletter_email(rng),
+            "outlook reply": outlook_reply_email(rng),
+            "gmail forward": gmail_forward_email(rng),
+            "plain text": plain_text_email(rng),
+        }
+
+    def handle(self, *args, **options):
+        try:
+            import bs4  # noqa: F401
+
+            variants = {"bs4 (previous)": bs4_clean_body}
+        except ImportError:
+            variants = {}
+        for backend in ("html.parser", "lxml"):
+            if backend == "lxml" and etree is None:
+                continue
+            variants[backend] = lambda body, b=backend: extract_text(body, backend=b)
+            variants[f"{backend} limit={options['limit']}"] = lambda body, b=backend: extract_text(
+                body, limit=options["limit"], backend=b
+            )
+            variants[f"{backend} strip_quotes"] = lambda body, b=backend: extract_text(
+                body, strip_quotes=True, backend=b
+            )
+
+        for name, body in self.corpus(options).items():
+            self.stdout.write(f"{name} ({len(body):,} characters)")
+            reference = bs4_clean_body(body) if "bs4 (previous)" in variants else None
+
+            for variant, function in variants.items():
+                timings = []
+                for _ in range(options["iterations"]):
+                    start = time.perf_counter()
+                    output = function(body)
+                    timings.append(time.perf_counter() - start)
+
+                if reference is None or "strip_quotes" in variant:
+                    match = ""
+                elif "limit=" in variant:
+                    match = " matches" if output == reference[: options["limit"]] else " differs"
+                else:
+                    match = " matches" if output == reference else " differs"
+
+                self.stdout.write(
+                    f"  {variant:<28} median {statistics.median(timings) * 1000:8.3f} ms"
+                    f"  {len(output):>7,} characters{match}"
+                )
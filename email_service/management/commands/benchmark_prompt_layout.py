@@ -0,0 +1,94 @@
+import os, time, statistics
+from datetime import datetime as dt, timedelta
+from django.core.management.base import BaseCommand
+from openai import OpenAI
+from ...assistants import ASSISTANT_NAME, get_or_create_assistant
+from ...tools.o365_toolkit import tools
+from ...utils import (
+    build_assistant_instructions,
+    format_context_instructions,
+    poll_for_response,
+    run_prompt,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares request latency and token usage of the inline prompt layout "
+        "(context baked into the Assistant instructions) with the split layout "
+        "(static Assistant plus per-run additional instructions)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--model", default="gpt-4o")
+        parser.add_argument("--iterations", type=int, default=5)
+        parser.add_argument(
+            "--prompt", default="Reply with the word OK and nothing else."
+        )
+
+    def handle(self, *args, **options):
+        client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+        model = options["model"]
+        instructions = build_assistant_instructions(interface="email")
+
+        for layout in ("inline", "split"):
+            latencies, prompt_tokens, completion_tokens = [], [], []
+
+            for i in range(options["iterations"]):
+                # Use a different day per iteration, as consecutive requests would see
+                context = format_context_instructions(
+                    "Benchmark User",
+                    "benchmark@example.com",
+                    "America/New_York",
+                    (dt.now() + timedelta(days=i)).strftime("%A, %B %d, %Y"),
+                )
+
+                start = time.perf_counter()
+                if layout == "inline":
+                    # Previous behavior: a new Assistant with the context in its instructions
+                    assistant = client.beta.assistants.create(
+                        name=ASSISTANT_NAME,
+                        instructions=context + instructions,
+                        model=model,
+                        tools=tools,
+                        temperature=0.05,
+                    )
+                    additional_instructions = ""
+                else:
+                    assistant = get_or_create_assistant(
+                        client,
+                        instructions=instructions,
+                        model=model,
+                        tools=tools,
+                        temperature=0.05,
+                        interface="email",
+                    )
+                    additional_instructions = context
+
+                thread = client.beta.threads.create()
+                run = run_prompt(
+                    options["prompt"],
+                    client,
+                    assistant,
+                    thread,
+                    interface="email",
+                    additional_instructions=additional_instructions,
+                )
+                poll_for_response(client, thread, run, model, interface="email")
+                latencies.append(time.perf_counter() - start)
+
+                run = client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
+                if run.usage:
+                    prompt_tokens.append(run.usage.prompt_tokens)
+                    completion_tokens.append(run.usage.completion_tokens)
+
+                if layout == "inline":
+                    client.beta.assistants.delete(assistant.id)
+
+            self.stdout.write(
+                f"{layout:>6}: mean latency {statistics.mean(latencies):.2f}s, "
+                f"p50 {statistics.median(latencies):.2f}s, "
+                f"max {max(latencies):.2f}s, "
+                f"mean prompt tokens {statistics.mean(prompt_tokens or [0]):.0f}, "
+                f"mean completion tokens {statistics.mean(completion_tokens or [0]):.0f}"
+            )
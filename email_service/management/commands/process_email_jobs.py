@@ -0,0 +1,83 @@
+import asyncio, signal, threading
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from ...jobs import enqueue_all_pending_emails, maintain, work, awork
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs queued email jobs. Each of the --concurrency worker threads claims and "
+        "processes one email at a time. To drain a backlog, e.g. after an outage, run "
+        "with --enqueue-pending --once."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=4)
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once the queue is empty instead of waiting for new jobs.",
+        )
+        parser.add_argument("--poll-interval", type=float, default=1.0)
+        parser.add_argument(
+            "--enqueue-pending",
+            action="store_true",
+            help="First queue every request email in the inboxes that was not processed yet.",
+        )
+        parser.add_argument(
+            "--async",
+            action="store_true",
+            dest="use_async",
+            help="Run the jobs on one event loop instead of threads, allowing a much "
+            "higher --concurrency as runs mostly wait on OpenAI and Microsoft Graph. "
+            "Runs of each model are still capped by OPENAI_MODEL_CONCURRENCY.",
+        )
+
+    def handle(self, *args, **options):
+        if options["enqueue_pending"]:
+            message_ids = enqueue_all_pending_emails()
+            self.stdout.write(f"Queued {len(message_ids)} pending emails")
+
+        # Long-running workers also keep the tenants' subscriptions alive and
+        # their inbox caches in sync
+        stop = threading.Event()
+        if not options["once"]:
+            threading.Thread(target=maintain, args=(stop,), daemon=True).start()
+
+        if options["use_async"]:
+            count = asyncio.run(self.handle_async(options))
+            stop.set()
+            self.stdout.write(f"Processed {count} email jobs")
+            return
+
+        # Let the workers finish their current job on shutdown
+        signal.signal(signal.SIGTERM, lambda *args: stop.set())
+        signal.signal(signal.SIGINT, lambda *args: stop.set())
+
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as executor:
+            futures = [
+                executor.submit(
+                    work,
+                    once=options["once"],
+                    poll_interval=options["poll_interval"],
+                    stop=stop,
+                )
+                for _ in range(options["concurrency"])
+            ]
+            count = sum(future.result() for future in futures)
+
+        self.stdout.write(f"Processed {count} email jobs")
+
+    async def handle_async(self, options):
+        # Let the running jobs finish on shutdown
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        loop.add_signal_handler(signal.SIGINT, stop.set)
+
+        return await awork(
+            options["concurrency"],
+            once=options["once"],
+            poll_interval=options["poll_interval"],
+            stop=stop,
+        )
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+from ...subscriptions import create_subscription, ensure_subscription
+from ...tenants import active_tenants, tenant_context
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates the Microsoft Graph subscription for new inbox messages of each "
+        "tenant, or renews it if it is about to expire. The process_email_jobs "
+        "worker renews subscriptions too, so only schedule it without a worker."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--notification-url",
+            help="Public HTTPS url of the notifications endpoint (default is GRAPH_NOTIFICATION_URL).",
+        )
+        parser.add_argument(
+            "--recreate",
+            action="store_true",
+            help="Replace the stored subscription even if it is still valid.",
+        )
+        parser.add_argument(
+            "--tenant",
+            help="Only the subscription of the tenant with this slug.",
+        )
+
+    def handle(self, *args, **options):
+        tenants = active_tenants()
+        if options["tenant"]:
+            tenants = [t for t in tenants if t is not None and t.slug == options["tenant"]]
+            if not tenants:
+                raise CommandError(f"No active tenant {options['tenant']}")
+
+        for tenant in tenants:
+            with tenant_context(tenant):
+                if options["recreate"]:
+                    subscription = create_subscription(options["notification_url"])
+                else:
+                    subscription = ensure_subscription(options["notification_url"])
+
+            self.stdout.write(
+                (f"{tenant.slug}: " if tenant is not None else "")
+                + f"Subscription {subscription.subscription_id} on {subscription.resource} "
+                f"expires at {subscription.expires_at}"
+            )
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_service', '0004_alter_authenticationstate_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AssistantRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('assistant_id', models.CharField(max_length=255)),
+                ('model', models.CharField(max_length=255)),
+                ('instructions_hash', models.CharField(max_length=64)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField()),
+            ],
+        ),
+    ]
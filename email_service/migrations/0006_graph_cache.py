@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_service', '0005_assistantrecord'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedEventWindow',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('start_datetime', models.DateTimeField()),
+                ('end_datetime', models.DateTimeField()),
+                ('data', models.JSONField()),
+                ('delta_link', models.TextField()),
+                ('fetched_at', models.DateTimeField()),
+                ('synced_at', models.DateTimeField()),
+                ('accessed_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CachedMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_id', models.CharField(max_length=255, unique=True)),
+                ('data', models.JSONField()),
+                ('fetched_at', models.DateTimeField()),
+                ('accessed_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DeltaLink',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource', models.CharField(max_length=255, unique=True)),
+                ('delta_link', models.TextField()),
+                ('synced_at', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_service', '0006_graph_cache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GraphSubscription',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subscription_id', models.CharField(max_length=255, unique=True)),
+                ('resource', models.CharField(max_length=255)),
+                ('notification_url', models.URLField(max_length=500)),
+                ('client_state', models.CharField(max_length=128)),
+                ('expires_at', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 13:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_service', '0008_emailjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processedemail',
+            name='claimed_by',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='processedemail',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='processedemail',
+            name='status',
+            field=models.CharField(choices=[('claimed', 'Claimed'), ('in_progress', 'In progress'), ('replied', 'Replied'), ('deleted', 'Deleted'), ('skipped', 'Skipped'), ('failed', 'Failed')], default='deleted', max_length=16),
+        ),
+    ]
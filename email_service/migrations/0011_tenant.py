@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-17 13:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_service', '0010_cachedprofile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tenant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slug', models.SlugField(max_length=100, unique=True)),
+                ('assistant_first_name', models.CharField(default='Monica', max_length=100)),
+                ('assistant_last_name', models.CharField(default='Ingenio', max_length=100)),
+                ('model', models.CharField(default='gpt-4o', max_length=100)),
+                ('max_concurrency', models.PositiveIntegerField(default=2)),
+                ('graph_requests_per_minute', models.PositiveIntegerField(default=600)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='authenticationstate',
+            name='tenant',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='email_service.tenant'),
+        ),
+        migrations.AddField(
+            model_name='emailjob',
+            name='tenant',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='email_service.tenant'),
+        ),
+        migrations.AddField(
+            model_name='graphsubscription',
+            name='tenant',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='email_service.tenant'),
+        ),
+        migrations.AddField(
+            model_name='tokenmodel',
+            name='tenant',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='tokens', to='email_service.tenant'),
+        ),
+    ]
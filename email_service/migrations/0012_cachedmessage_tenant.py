@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-17 13:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_service', '0011_tenant'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cachedmessage',
+            name='tenant',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='email_service.tenant'),
+        ),
+        migrations.AlterField(
+            model_name='cachedmessage',
+            name='message_id',
+            field=models.CharField(max_length=255),
+        ),
+        migrations.AddConstraint(
+            model_name='cachedmessage',
+            constraint=models.UniqueConstraint(fields=('tenant', 'message_id'), name='unique_tenant_cached_message'),
+        ),
+        migrations.AddConstraint(
+            model_name='cachedmessage',
+            constraint=models.UniqueConstraint(condition=models.Q(('tenant__isnull', True)), fields=('message_id',), name='unique_default_cached_message'),
+        ),
+    ]
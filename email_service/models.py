@@ -2,13 +2,53 @@ from django.db import models
 
 
 class ProcessedEmail(models.Model):
+    CLAIMED = "claimed"
+    IN_PROGRESS = "in_progress"
+    REPLIED = "replied"
+    DELETED = "deleted"
+    SKIPPED = "skipped"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (CLAIMED, "Claimed"),
+        (IN_PROGRESS, "In progress"),
+        (REPLIED, "Replied"),
+        (DELETED, "Deleted"),
+        (SKIPPED, "Skipped"),
+        (FAILED, "Failed"),
+    ]
+
     message_id = models.CharField(max_length=255, unique=True)
+    # Emails recorded before processing was tracked were fully processed
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=DELETED)
+    claimed_by = models.CharField(max_length=255, blank=True, default="")
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
     processed_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
-        return self.message_id
+        return f"{self.message_id} ({self.status})"
+
+class Tenant(models.Model):
+    """An executive whose mailbox the deployment serves, with their assistant's persona and limits."""
+
+    slug = models.SlugField(max_length=100, unique=True)
+    assistant_first_name = models.CharField(max_length=100, default="Monica")
+    assistant_last_name = models.CharField(max_length=100, default="Ingenio")
+    model = models.CharField(max_length=100, default="gpt-4o")
+    # Maximum number of this tenant's emails processed at the same time
+    max_concurrency = models.PositiveIntegerField(default=2)
+    # Microsoft Graph requests per minute, across all the tenant's jobs in a process
+    graph_requests_per_minute = models.PositiveIntegerField(default=600)
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.slug
 
 class TokenModel(models.Model):
+    # Tokens without a tenant belong to a deployment without tenants
+    tenant = models.ForeignKey(
+        Tenant, null=True, blank=True, on_delete=models.CASCADE, related_name="tokens"
+    )
     token = models.JSONField()
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -17,8 +57,112 @@ class TokenModel(models.Model):
         return f"Token for {self.token.get('client_id', 'unknown')}"
 
 class AuthenticationState(models.Model):
-    state = models.CharField(max_length=255)
+    tenant = models.ForeignKey(Tenant, null=True, blank=True, on_delete=models.CASCADE)
+    state = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return self.state
+
+class AssistantRecord(models.Model):
+    key = models.CharField(max_length=64, unique=True)
+    assistant_id = models.CharField(max_length=255)
+    model = models.CharField(max_length=255)
+    instructions_hash = models.CharField(max_length=64)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.assistant_id} ({self.model})"
+
+class CachedMessage(models.Model):
+    # Each tenant caches the messages of their own mailbox
+    tenant = models.ForeignKey(Tenant, null=True, blank=True, on_delete=models.CASCADE)
+    message_id = models.CharField(max_length=255)
+    data = models.JSONField()
+    fetched_at = models.DateTimeField()
+    accessed_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["tenant", "message_id"], name="unique_tenant_cached_message"
+            ),
+            # NULL tenants never collide above, so the default mailbox needs its own
+            models.UniqueConstraint(
+                fields=["message_id"],
+                condition=models.Q(tenant__isnull=True),
+                name="unique_default_cached_message",
+            ),
+        ]
+
+    def __str__(self):
+        return self.message_id
+
+class CachedEventWindow(models.Model):
+    key = models.CharField(max_length=64, unique=True)
+    start_datetime = models.DateTimeField()
+    end_datetime = models.DateTimeField()
+    data = models.JSONField()
+    delta_link = models.TextField()
+    fetched_at = models.DateTimeField()
+    synced_at = models.DateTimeField()
+    accessed_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"Events from {self.start_datetime} to {self.end_datetime}"
+
+class CachedProfile(models.Model):
+    key = models.CharField(max_length=255, unique=True)
+    data = models.JSONField()
+    fetched_at = models.DateTimeField()
+
+    def __str__(self):
+        return self.key
+
+class DeltaLink(models.Model):
+    resource = models.CharField(max_length=255, unique=True)
+    delta_link = models.TextField()
+    synced_at = models.DateTimeField()
+
+    def __str__(self):
+        return self.resource
+
+class GraphSubscription(models.Model):
+    tenant = models.ForeignKey(Tenant, null=True, blank=True, on_delete=models.CASCADE)
+    subscription_id = models.CharField(max_length=255, unique=True)
+    resource = models.CharField(max_length=255)
+    notification_url = models.URLField(max_length=500)
+    client_state = models.CharField(max_length=128)
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.resource} until {self.expires_at}"
+
+class EmailJob(models.Model):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    tenant = models.ForeignKey(Tenant, null=True, blank=True, on_delete=models.CASCADE)
+    message_id = models.CharField(max_length=255, unique=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField(db_index=True)
+    locked_by = models.CharField(max_length=255, blank=True, default="")
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default="")
+    result = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.message_id} ({self.status})"
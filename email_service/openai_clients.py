@@ -0,0 +1,308 @@
+import os, re, time, asyncio, threading, weakref, contextvars
+from contextlib import asynccontextmanager, contextmanager
+from openai import (
+    DEFAULT_CONNECTION_LIMITS,
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    DefaultHttpxClient,
+    OpenAI,
+)
+
+"""Connection pool of the shared OpenAI clients. Runs stream, so keep connections warm."""
+OPENAI_MAX_CONNECTIONS = 100
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = 20
+OPENAI_KEEPALIVE_EXPIRY_SECONDS = 60
+"""Retries of failed requests by the OpenAI SDK, which honors Retry-After on 429s."""
+OPENAI_MAX_RETRIES = 4
+"""Runs of one model in flight at a time, configurable with OPENAI_MODEL_CONCURRENCY=gpt-4o=8,gpt-4o-mini=16."""
+DEFAULT_MODEL_CONCURRENCY = 8
+# Requests wait for the rate limit window to reset once fewer requests or tokens remain
+MIN_REMAINING_REQUESTS = 1
+MIN_REMAINING_TOKENS = 4000
+"""Longest a request waits for a rate limit window to reset."""
+MAX_RATE_LIMIT_WAIT_SECONDS = 60
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_SECONDS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+# The model of the run sending the current request, set by RateLimitScheduler.slot
+_current_model = contextvars.ContextVar("openai_model", default=None)
+
+
+def model_concurrency():
+    """Parses OPENAI_MODEL_CONCURRENCY into {model: maximum runs in flight}."""
+    caps = {}
+    for entry in os.environ.get("OPENAI_MODEL_CONCURRENCY", "").split(","):
+        model, _, value = entry.partition("=")
+        if model.strip() and value.strip().isdigit():
+            caps[model.strip()] = max(1, int(value))
+    return caps
+
+
+def parse_duration(value):
+    """Parses a rate limit reset header like 6m0s, 1.5s or 20ms into seconds."""
+    if not value:
+        return None
+    parts = _DURATION.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_SECONDS[unit] for number, unit in parts)
+
+
+def _retry_after(headers):
+    """Seconds until a throttled request can be retried, from its retry-after(-ms) header."""
+    try:
+        return float(headers["retry-after-ms"]) / 1000
+    except (KeyError, TypeError, ValueError):
+        pass
+    try:
+        return float(headers["retry-after"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class ModelLimits:
+    """Rate limit state and concurrency slots of one model."""
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        # asyncio semaphores belong to one event loop, so keep them per loop
+        self.async_semaphores = weakref.WeakKeyDictionary()
+        self.remaining_requests = None
+        self.remaining_tokens = None
+        self.requests_reset_at = 0.0
+        self.tokens_reset_at = 0.0
+        self.in_flight = 0
+        self.queued = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+
+
+class RateLimitScheduler:
+    """
+    Coordinates the runs of every OpenAI client in the process.
+
+    Runs take one of their model's concurrency slots, queueing when all are
+    taken. Every response updates the model's remaining requests and tokens
+    from its x-ratelimit-* headers, and requests wait for the window to reset
+    once they are nearly exhausted, instead of running into 429s.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models = {}
+
+    def limits(self, model):
+        with self._lock:
+            limits = self._models.get(model)
+            if limits is None:
+                concurrency = model_concurrency().get(model, DEFAULT_MODEL_CONCURRENCY)
+                limits = self._models[model] = ModelLimits(concurrency)
+            return limits
+
+    @contextmanager
+    def slot(self, model):
+        """Holds one of the model's concurrency slots, and tags its requests with the model."""
+        limits = self.limits(model)
+        with self._lock:
+            limits.queued += 1
+        limits.semaphore.acquire()
+        with self._lock:
+            limits.queued -= 1
+            limits.in_flight += 1
+        token = _current_model.set(model)
+        try:
+            yield limits
+        finally:
+            _current_model.reset(token)
+            with self._lock:
+                limits.in_flight -= 1
+            limits.semaphore.release()
+
+    @asynccontextmanager
+    async def aslot(self, model):
+        """Async version of slot, queueing on the running event loop."""
+        limits = self.limits(model)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            semaphore = limits.async_semaphores.get(loop)
+            if semaphore is None:
+                semaphore = limits.async_semaphores[loop] = asyncio.Semaphore(limits.concurrency)
+            limits.queued += 1
+        await semaphore.acquire()
+        with self._lock:
+            limits.queued -= 1
+            limits.in_flight += 1
+        token = _current_model.set(model)
+        try:
+            yield limits
+        finally:
+            _current_model.reset(token)
+            with self._lock:
+                limits.in_flight -= 1
+            semaphore.release()
+
+    def delay(self, model):
+        """
+        Returns the seconds a request of the model should wait before it is sent.
+
+        Requests are counted against the last known remaining requests, so
+        concurrent runs don't all spend the same remaining budget.
+        """
+        limits = self.limits(model)
+        now = time.monotonic()
+        with self._lock:
+            wait = 0.0
+            if limits.remaining_requests is not None:
+                if now >= limits.requests_reset_at:
+                    limits.remaining_requests = None
+                elif limits.remaining_requests <= MIN_REMAINING_REQUESTS:
+                    wait = limits.requests_reset_at - now
+                else:
+                    limits.remaining_requests -= 1
+            if limits.remaining_tokens is not None:
+                if now >= limits.tokens_reset_at:
+                    limits.remaining_tokens = None
+                elif limits.remaining_tokens <= MIN_REMAINING_TOKENS:
+                    wait = max(wait, limits.tokens_reset_at - now)
+            wait = min(wait, MAX_RATE_LIMIT_WAIT_SECONDS)
+            limits.wait_seconds += wait
+            return wait
+
+    def observe(self, model, status_code, headers):
+        """Updates a model's rate limit state from a response."""
+        limits = self.limits(model)
+        now = time.monotonic()
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        reset_requests = parse_duration(headers.get("x-ratelimit-reset-requests"))
+        reset_tokens = parse_duration(headers.get("x-ratelimit-reset-tokens"))
+
+        with self._lock:
+            if remaining_requests is not None and remaining_requests.isdigit():
+                limits.remaining_requests = int(remaining_requests)
+                limits.requests_reset_at = now + (reset_requests or 0)
+            if remaining_tokens is not None and remaining_tokens.isdigit():
+                limits.remaining_tokens = int(remaining_tokens)
+                limits.tokens_reset_at = now + (reset_tokens or 0)
+
+            if status_code == 429:
+                # Hold the model's other requests until the SDK's retry is due
+                limits.throttled += 1
+                retry_after = _retry_after(headers)
+                limits.remaining_requests = 0
+                limits.requests_reset_at = max(
+                    limits.requests_reset_at, now + (retry_after or 1)
+                )
+
+    def stats(self):
+        """Return each model's rate limit state, queue and counters."""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                model: {
+                    "concurrency": limits.concurrency,
+                    "in_flight": limits.in_flight,
+                    "queued": limits.queued,
+                    "remaining_requests": limits.remaining_requests,
+                    "remaining_tokens": limits.remaining_tokens,
+                    "resets_in_seconds": round(
+                        max(0.0, limits.requests_reset_at - now, limits.tokens_reset_at - now), 3
+                    ),
+                    "throttled": limits.throttled,
+                    "wait_seconds": round(limits.wait_seconds, 3),
+                }
+                for model, limits in self._models.items()
+            }
+
+
+"""Process-wide scheduler shared by the sync and async OpenAI clients."""
+rate_limits = RateLimitScheduler()
+
+
+def _on_request(request):
+    model = _current_model.get()
+    if model is not None:
+        delay = rate_limits.delay(model)
+        if delay:
+            time.sleep(delay)
+
+
+def _on_response(response):
+    model = _current_model.get()
+    if model is not None:
+        rate_limits.observe(model, response.status_code, response.headers)
+
+
+async def _aon_request(request):
+    model = _current_model.get()
+    if model is not None:
+        delay = rate_limits.delay(model)
+        if delay:
+            await asyncio.sleep(delay)
+
+
+async def _aon_response(response):
+    _on_response(response)
+
+
+def _limits():
+    # Build the limits type of the SDK's own HTTP library, whichever it ships on
+    return type(DEFAULT_CONNECTION_LIMITS)(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY_SECONDS,
+    )
+
+
+_clients = {}
+# Async HTTP clients can't be shared across event loops, so keep one per loop
+_async_clients = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+
+def openai_client(api_key=None, base_url=None):
+    """
+    Returns the process-wide OpenAI client for an API key (default is OPENAI_API_KEY),
+    and API url (default is OPENAI_BASE_URL, or OpenAI's).
+
+    Reusing one client keeps its connections, and their TLS sessions, alive
+    between runs, and routes every request through rate_limits.
+    """
+    api_key = api_key or os.environ.get("OPENAI_API_KEY")
+    with _clients_lock:
+        client = _clients.get((api_key, base_url))
+        if client is None:
+            client = OpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                max_retries=OPENAI_MAX_RETRIES,
+                http_client=DefaultHttpxClient(
+                    limits=_limits(),
+                    event_hooks={"request": [_on_request], "response": [_on_response]},
+                ),
+            )
+            _clients[api_key, base_url] = client
+        return client
+
+
+def async_openai_client(api_key=None, base_url=None):
+    """Async version of openai_client, shared by the runs of the running event loop."""
+    api_key = api_key or os.environ.get("OPENAI_API_KEY")
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get((api_key, base_url))
+        if client is None:
+            client = AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                max_retries=OPENAI_MAX_RETRIES,
+                http_client=DefaultAsyncHttpxClient(
+                    limits=_limits(),
+                    event_hooks={"request": [_aon_request], "response": [_aon_response]},
+                ),
+            )
+            clients[api_key, base_url] = client
+        return client
@@ -0,0 +1,339 @@
+import os, socket, threading, uuid
+from datetime import timedelta
+from email.utils import parseaddr
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import ProcessedEmail
+from .utils import assistant_names
+from .backends import get_backend
+from .tools.utils import authenticate
+from .tools.profile import get_profile
+from .tools.o365_toolkit import (
+    o365search_email,
+    o365reply_message,
+    o365delete_message,
+)
+
+"""Model used to answer requests received by email."""
+EMAIL_MODEL = "gpt-4o"
+"""Number of messages requested per page when listing request emails."""
+SEARCH_PAGE_SIZE = 100
+# A claimed email can be taken over by another worker once its lease expires
+LEASE_DURATION = timedelta(minutes=10)
+
+
+def get_client_email():
+    """Returns the email address of the authenticated mailbox owner."""
+    account = authenticate(interface="email")
+    return get_profile(account, "email")["email"]
+
+
+def _address(recipient):
+    """Extracts the lowercase email address from a 'Name <address>' string."""
+    return parseaddr(recipient)[1].lower()
+
+
+def is_prompt_email(email, client_email):
+    """
+    Whether an email is a request to the assistant: sent by the client to themselves,
+    with the assistant's call in the body.
+    """
+    client_email = client_email.lower()
+    first_name = assistant_names("email")[0]
+    return (
+        _address(email["from"]) == client_email
+        and client_email in [_address(recipient) for recipient in email["to"]]
+        and f"Hi {first_name}," in email["body"]
+    )
+
+
+def find_prompt_emails():
+    """
+    Returns the message_ids of every request email in the inbox, newest first.
+
+    Pages through all search results, only requesting the message ids.
+    """
+    client_email = get_client_email()
+    account = authenticate(interface="email")
+    inbox = account.mailbox().inbox_folder()
+    first_name = assistant_names("email")[0]
+
+    query = inbox.q().select("id").search(
+        f"from:{client_email} to:{client_email} body:'Hi {first_name}, '"
+    )
+    messages = inbox.get_messages(limit=None, batch=SEARCH_PAGE_SIZE, query=query)
+
+    return [message.object_id for message in messages]
+
+
+def worker_id():
+    """Identifies one worker thread across hosts and processes."""
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}:{uuid.uuid4().hex[:8]}"
+
+
+class LeaseLost(Exception):
+    """Raised when another worker took over an email whose lease expired."""
+
+
+def claim_email(message_id, worker):
+    """
+    Atomically claims an email for processing by one worker.
+
+    New emails are claimed by inserting their record. Emails whose lease expired
+    while claimed, in progress or replied (their worker crashed), and failed
+    emails, can be claimed again. Replied emails keep their status when
+    reclaimed, so the new worker only deletes them instead of replying twice.
+
+    Parameters:
+    message_id (str): The message_id of the email.
+    worker (str): Identifies the claiming worker.
+
+    Returns:
+    ProcessedEmail: The claimed record, or None if another worker holds the email
+                    or it was already processed.
+    """
+    now = timezone.now()
+    lease_expires_at = now + LEASE_DURATION
+
+    try:
+        with transaction.atomic():
+            return ProcessedEmail.objects.create(
+                message_id=message_id,
+                status=ProcessedEmail.CLAIMED,
+                claimed_by=worker,
+                lease_expires_at=lease_expires_at,
+            )
+    except IntegrityError:
+        # The email already has a record
+        pass
+
+    reclaimable = ProcessedEmail.objects.filter(
+        Q(
+            status__in=[
+                ProcessedEmail.CLAIMED,
+                ProcessedEmail.IN_PROGRESS,
+                ProcessedEmail.REPLIED,
+            ],
+            lease_expires_at__lt=now,
+        )
+        | Q(status=ProcessedEmail.FAILED),
+        message_id=message_id,
+    )
+
+    if connection.features.has_select_for_update_skip_locked:
+        # Postgres: lock the row, skipping it if another worker is claiming it
+        with transaction.atomic():
+            record = reclaimable.select_for_update(skip_locked=True).first()
+            if record is None:
+                return None
+            record.claimed_by = worker
+            record.lease_expires_at = lease_expires_at
+            record.save(update_fields=["claimed_by", "lease_expires_at"])
+            return record
+
+    # SQLite serializes writes, so a conditional update claims atomically
+    if not reclaimable.update(claimed_by=worker, lease_expires_at=lease_expires_at):
+        return None
+    return ProcessedEmail.objects.get(message_id=message_id)
+
+
+def _transition(record, status, lease_expires_at=None):
+    """
+    Moves a claimed email to a new status, renewing its lease.
+
+    Raises:
+    LeaseLost: If the worker no longer holds the email.
+    """
+    updated = ProcessedEmail.objects.filter(
+        pk=record.pk, claimed_by=record.claimed_by
+    ).update(
+        status=status,
+        lease_expires_at=lease_expires_at or timezone.now() + LEASE_DURATION,
+    )
+    if not updated:
+        raise LeaseLost(f"Email {record.message_id} was claimed by another worker.")
+    record.status = status
+
+
+def renew_lease(message_id, worker):
+    """
+    Extends the lease of an email a worker is answering, e.g. while it waits for
+    an OpenAI slot. Replied emails keep their lease, as only their deletion is left.
+
+    Returns:
+    bool: Whether the worker still holds the email.
+    """
+    return bool(
+        ProcessedEmail.objects.filter(
+            message_id=message_id,
+            claimed_by=worker,
+            status__in=[ProcessedEmail.CLAIMED, ProcessedEmail.IN_PROGRESS],
+        ).update(lease_expires_at=timezone.now() + LEASE_DURATION)
+    )
+
+
+def is_processed(message_id):
+    """Whether an email was answered and deleted, or skipped."""
+    return ProcessedEmail.objects.filter(
+        message_id=message_id,
+        status__in=[ProcessedEmail.DELETED, ProcessedEmail.SKIPPED],
+    ).exists()
+
+
+def process_email(message_id, client_email=None, model=EMAIL_MODEL, worker=None):
+    """
+    Answers a request email: runs it through the assistant, replies to the sender
+    with the response and deletes the request.
+
+    The email is claimed first, so concurrent workers never reply to it twice.
+
+    Parameters:
+    message_id (str): The message_id of the email to process.
+    client_email (str): The mailbox owner's address, looked up if not given.
+    model (str): The OpenAI model used to answer the request.
+    worker (str): Identifies the processing worker (default is this thread).
+
+    Returns:
+    dict: The processing status, and the reply confirmation or the reason for skipping.
+    """
+    # Check if the email has already been processed
+    if is_processed(message_id):
+        return {"status": "skipped", "message": "Email has already been processed."}
+
+    email = o365search_email(message_id=message_id, interface="email")
+
+    if not is_prompt_email(email, client_email or get_client_email()):
+        return {"status": "skipped", "message": "Email is not a request."}
+
+    record = claim_email(message_id, worker or worker_id())
+    if record is None:
+        return {
+            "status": "skipped",
+            "message": "Email is being processed or has already been processed.",
+        }
+
+    try:
+        # Check if the email prompt starts with the call, e.g. "Hi Monica,"
+        if not email["body"].startswith(f"Hi {assistant_names('email')[0]},"):
+            _transition(record, ProcessedEmail.SKIPPED)
+
+            return {
+                "status": "skipped",
+                "message": "Email includes call, but does not start with it.",
+            }
+
+        reply = "Reply already sent."
+        if record.status != ProcessedEmail.REPLIED:
+            _transition(record, ProcessedEmail.IN_PROGRESS)
+
+            # Start a conversation on the email interface's execution backend
+            backend = get_backend("email")
+            conversation = backend.create(debug=False, model=model, interface="email")
+
+            # Run prompt and stream the response
+            response = backend.execute(conversation, str(email))
+
+            # Make sure no other worker took over while the assistant was running
+            _transition(record, ProcessedEmail.IN_PROGRESS)
+
+            # Reply to the email
+            reply = o365reply_message(
+                message_id,
+                response,
+                interface="email",
+                reply_to_sender=True,
+            )
+            _transition(record, ProcessedEmail.REPLIED)
+
+        # Delete the processed email
+        o365delete_message(message_id, interface="email")
+        _transition(record, ProcessedEmail.DELETED)
+
+    except LeaseLost:
+        raise
+    except Exception:
+        if record.status == ProcessedEmail.REPLIED:
+            # Release the lease so the deletion is retried, but never the reply
+            _transition(record, ProcessedEmail.REPLIED, lease_expires_at=timezone.now())
+        else:
+            _transition(record, ProcessedEmail.FAILED)
+        raise
+
+    return {"status": "success", "reply": reply}
+
+
+async def aprocess_email(message_id, client_email=None, model=EMAIL_MODEL, worker=None):
+    """
+    Async version of process_email, with async OpenAI and Microsoft Graph requests.
+
+    Only the short database updates of the lease run on threads, so one event loop
+    can process many emails that are waiting on the assistant.
+    """
+    # The async path needs the openai SDK's HTTP client, so only import it when used
+    from .tools.async_graph import AsyncGraphClient
+
+    # Check if the email has already been processed
+    if await sync_to_async(is_processed)(message_id):
+        return {"status": "skipped", "message": "Email has already been processed."}
+
+    graph = await AsyncGraphClient.create(interface="email")
+    email = await graph.get_message(message_id)
+
+    if client_email is None:
+        client_email = (await sync_to_async(get_profile)(graph.account, "email"))["email"]
+    if not is_prompt_email(email, client_email):
+        return {"status": "skipped", "message": "Email is not a request."}
+
+    record = await sync_to_async(claim_email)(message_id, worker or worker_id())
+    if record is None:
+        return {
+            "status": "skipped",
+            "message": "Email is being processed or has already been processed.",
+        }
+
+    transition = sync_to_async(_transition)
+    try:
+        # Check if the email prompt starts with the call, e.g. "Hi Monica,"
+        if not email["body"].startswith(f"Hi {assistant_names('email')[0]},"):
+            await transition(record, ProcessedEmail.SKIPPED)
+
+            return {
+                "status": "skipped",
+                "message": "Email includes call, but does not start with it.",
+            }
+
+        reply = "Reply already sent."
+        if record.status != ProcessedEmail.REPLIED:
+            await transition(record, ProcessedEmail.IN_PROGRESS)
+
+            # Start a conversation on the email interface's execution backend
+            backend = get_backend("email")
+            conversation = await backend.acreate(debug=False, model=model, interface="email")
+
+            # Run prompt and stream the response
+            response = await backend.aexecute(conversation, str(email))
+
+            # Make sure no other worker took over while the assistant was running
+            await transition(record, ProcessedEmail.IN_PROGRESS)
+
+            # Reply to the email
+            reply = await graph.reply_message(message_id, response, reply_to_sender=True)
+            await transition(record, ProcessedEmail.REPLIED)
+
+        # Delete the processed email
+        await graph.delete_message(message_id)
+        await transition(record, ProcessedEmail.DELETED)
+
+    except LeaseLost:
+        raise
+    except Exception:
+        if record.status == ProcessedEmail.REPLIED:
+            # Release the lease so the deletion is retried, but never the reply
+            await transition(record, ProcessedEmail.REPLIED, lease_expires_at=timezone.now())
+        else:
+            await transition(record, ProcessedEmail.FAILED)
+        raise
+
+    return {"status": "success", "reply": reply}
@@ -0,0 +1,201 @@
+import os, hmac, secrets
+from datetime import timedelta
+from django.db import connection
+from django.utils import timezone
+from requests.exceptions import HTTPError
+from .models import GraphSubscription
+from .jobs import enqueue_pending_emails
+from .tenants import current_tenant, tenant_context
+from .tools.utils import authenticate
+
+"""Inbox messages are the only resource the assistant needs notifications for."""
+SUBSCRIPTION_RESOURCE = "me/mailFolders('inbox')/messages"
+# Graph allows message subscriptions to last just under 7 days
+SUBSCRIPTION_LIFETIME = timedelta(days=6)
+# Subscriptions expiring within this window are renewed
+RENEW_BEFORE = timedelta(days=2)
+# Public HTTPS url of GraphNotificationView, derived from the Heroku host name if not set
+NOTIFICATION_URL = os.environ.get("GRAPH_NOTIFICATION_URL") or (
+    "https://" + os.environ["HEROKU_HOST_NAME"] + "/notifications/"
+    if os.environ.get("HEROKU_HOST_NAME")
+    else None
+)
+
+
+def _subscriptions_url(account, subscription_id=None):
+    url = account.protocol.service_url + "subscriptions"
+    if subscription_id:
+        url += "/" + subscription_id
+    return url
+
+
+def _subscriptions():
+    """The current tenant's stored subscriptions."""
+    return GraphSubscription.objects.filter(tenant=current_tenant())
+
+
+def _expiration():
+    expires_at = timezone.now() + SUBSCRIPTION_LIFETIME
+    return expires_at, expires_at.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def create_subscription(notification_url=None):
+    """
+    Subscribes to new inbox messages of the current tenant, replacing its stored subscription.
+
+    Parameters:
+    notification_url (str): Public HTTPS url Graph posts notifications to (default is NOTIFICATION_URL).
+
+    Returns:
+    GraphSubscription: The new subscription.
+    """
+    notification_url = notification_url or NOTIFICATION_URL
+    if not notification_url:
+        raise ValueError(
+            "Set the GRAPH_NOTIFICATION_URL or HEROKU_HOST_NAME environmental variable "
+            "to receive Microsoft Graph notifications."
+        )
+
+    account = authenticate(interface="email")
+    client_state = secrets.token_urlsafe(32)
+    expires_at, expiration = _expiration()
+
+    # Graph validates the notification url before answering, see GraphNotificationView
+    response = account.con.post(
+        _subscriptions_url(account),
+        data={
+            "changeType": "created",
+            "notificationUrl": notification_url,
+            "lifecycleNotificationUrl": notification_url,
+            "resource": SUBSCRIPTION_RESOURCE,
+            "expirationDateTime": expiration,
+            "clientState": client_state,
+        },
+    )
+    data = response.json()
+
+    _subscriptions().delete()
+    return GraphSubscription.objects.create(
+        tenant=current_tenant(),
+        subscription_id=data["id"],
+        resource=SUBSCRIPTION_RESOURCE,
+        notification_url=notification_url,
+        client_state=client_state,
+        expires_at=expires_at,
+    )
+
+
+def renew_subscription(subscription):
+    """Extends a subscription's expiration, recreating it if Graph no longer has it."""
+    account = authenticate(interface="email")
+    expires_at, expiration = _expiration()
+
+    try:
+        account.con.patch(
+            _subscriptions_url(account, subscription.subscription_id),
+            data={"expirationDateTime": expiration},
+        )
+    except HTTPError as e:
+        if e.response is None or e.response.status_code != 404:
+            raise
+        return create_subscription(subscription.notification_url)
+
+    GraphSubscription.objects.filter(pk=subscription.pk).update(expires_at=expires_at)
+    subscription.expires_at = expires_at
+    return subscription
+
+
+def ensure_subscription(notification_url=None):
+    """
+    Makes sure the current tenant's inbox subscription exists and is not about to expire.
+
+    Cheap when nothing needs to change, so it can be called opportunistically.
+    """
+    subscription = _subscriptions().first()
+    if subscription is None or (
+        notification_url and subscription.notification_url != notification_url
+    ):
+        return create_subscription(notification_url)
+
+    if subscription.expires_at - timezone.now() < RENEW_BEFORE:
+        return renew_subscription(subscription)
+
+    return subscription
+
+
+def maintain_subscription():
+    """
+    Ensures the current tenant's subscription when the deployment receives
+    notifications, i.e. it has a notification url or a stored subscription.
+    Called periodically by the worker, as quiet inboxes get no notifications
+    to renew their subscription on.
+
+    Returns:
+    GraphSubscription: The subscription, or None for deployments without notifications.
+    """
+    if not NOTIFICATION_URL and not _subscriptions().exists():
+        return None
+    return ensure_subscription()
+
+
+def is_valid_notification(notification):
+    """
+    Checks that a notification belongs to a stored subscription and carries its clientState.
+
+    Returns:
+    GraphSubscription: The notification's subscription, with its tenant, or None if it's not valid.
+    """
+    subscription = GraphSubscription.objects.select_related("tenant").filter(
+        subscription_id=notification.get("subscriptionId")
+    ).first()
+    if subscription is not None and hmac.compare_digest(
+        subscription.client_state, notification.get("clientState") or ""
+    ):
+        return subscription
+    return None
+
+
+def needs_renewal():
+    """Whether the current tenant's subscription expires within RENEW_BEFORE."""
+    subscription = _subscriptions().first()
+    return (
+        subscription is not None
+        and subscription.expires_at - timezone.now() < RENEW_BEFORE
+    )
+
+
+def handle_lifecycle_events(lifecycle_events, tenant=None):
+    """
+    Keeps the subscription alive in response to Graph lifecycle notifications,
+    and renews it if it is about to expire. Runs outside the request, as Graph
+    expects a response within seconds.
+
+    Parameters:
+    lifecycle_events (list): The lifecycleEvent values of lifecycle notifications.
+    tenant (Tenant): The tenant whose subscription received them.
+    """
+    try:
+        with tenant_context(tenant):
+            _handle_lifecycle_events(lifecycle_events)
+    finally:
+        connection.close()
+
+
+def _handle_lifecycle_events(lifecycle_events):
+    for event in lifecycle_events:
+        try:
+            subscription = _subscriptions().first()
+            if event == "reauthorizationRequired" and subscription is not None:
+                renew_subscription(subscription)
+            elif event == "subscriptionRemoved":
+                create_subscription(subscription and subscription.notification_url)
+            elif event == "missed":
+                # Some notifications were dropped, so fall back to a search
+                enqueue_pending_emails()
+        except Exception as e:
+            print("Error: Could not handle " + event + " notification: " + str(e))
+
+    try:
+        ensure_subscription()
+    except Exception as e:
+        print("Error: Could not renew the Graph subscription: " + str(e))
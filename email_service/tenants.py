@@ -0,0 +1,126 @@
+import contextvars, threading, time
+from contextlib import contextmanager
+from O365.utils import DjangoTokenBackend
+from .models import Tenant
+from .tools.throttling import GraphAccount, ThrottledConnection, TokenBucket
+
+"""Seconds of a tenant's Graph budget that can be spent in a burst."""
+GRAPH_BUDGET_BURST_SECONDS = 10
+
+# The tenant whose mailbox the current job or request works on. Context variables
+# follow sync_to_async and asyncio tasks, so each job sees its own tenant.
+_current_tenant = contextvars.ContextVar("tenant", default=None)
+
+
+def current_tenant():
+    """Returns the current tenant, or None in a deployment without tenants."""
+    return _current_tenant.get()
+
+
+@contextmanager
+def tenant_context(tenant):
+    """Makes tenant the current tenant within the block."""
+    token = _current_tenant.set(tenant)
+    try:
+        yield tenant
+    finally:
+        _current_tenant.reset(token)
+
+
+def tenant_key(key):
+    """Scopes a cache key or resource name to the current tenant."""
+    tenant = current_tenant()
+    return key if tenant is None else f"{tenant.slug}:{key}"
+
+
+def active_tenants():
+    """
+    Returns the tenants to serve.
+
+    A deployment without any Tenant rows serves the one mailbox of the default
+    token, represented by None.
+    """
+    tenants = list(Tenant.objects.filter(is_active=True).order_by("pk"))
+    if tenants or Tenant.objects.exists():
+        return tenants
+    return [None]
+
+
+class GraphBudget(TokenBucket):
+    """
+    Token bucket limiting a tenant's Microsoft Graph requests per minute.
+
+    Graph throttles each mailbox separately, so a busy tenant spends its own
+    budget instead of getting other tenants' requests throttled.
+    """
+
+    def __init__(self, requests_per_minute):
+        self.requests_per_minute = requests_per_minute
+        rate = requests_per_minute / 60
+        super().__init__(rate, capacity=rate * GRAPH_BUDGET_BURST_SECONDS)
+
+
+_budgets = {}
+_budgets_lock = threading.Lock()
+
+
+def graph_budget(tenant):
+    """Returns the process-wide Graph budget of a tenant."""
+    with _budgets_lock:
+        budget = _budgets.get(tenant.pk)
+        if budget is None or budget.requests_per_minute != tenant.graph_requests_per_minute:
+            budget = GraphBudget(tenant.graph_requests_per_minute)
+            _budgets[tenant.pk] = budget
+        return budget
+
+
+class TenantTokenBackend(DjangoTokenBackend):
+    """Django token backend that keeps each tenant's tokens separate."""
+
+    def __init__(self, token_model, tenant):
+        super().__init__(token_model=token_model)
+        self.tenant = tenant
+
+    def _tokens(self):
+        return self.token_model.objects.filter(tenant=self.tenant)
+
+    def load_token(self):
+        record = self._tokens().order_by("-created_at").first()
+        if record is None:
+            return None
+        return self.token_constructor(self.serializer.loads(record.token))
+
+    def save_token(self):
+        if self.token is None:
+            raise ValueError('You have to set the "token" first.')
+        self.token_model.objects.create(
+            tenant=self.tenant, token=self.serializer.dumps(self.token)
+        )
+        return True
+
+    def delete_token(self):
+        record = self._tokens().order_by("-created_at").first()
+        if record is None:
+            return False
+        record.delete()
+        return True
+
+    def check_token(self):
+        return self._tokens().exists()
+
+
+class BudgetedConnection(ThrottledConnection):
+    """O365 connection that waits for its tenant's Graph budget before every request."""
+
+    budget = None
+
+    def _check_delay(self):
+        if self.budget is not None:
+            delay = self.budget.reserve()
+            if delay:
+                time.sleep(delay)
+        super()._check_delay()
+
+
+class TenantAccount(GraphAccount):
+    connection_constructor = BudgetedConnection
@@ -1,3 +1,1833 @@
-from django.test import TestCase
+import os, json, pprint, random, asyncio, threading, time as time_module
+from datetime import date, datetime, time, timedelta, timezone
+from zoneinfo import ZoneInfo
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipIf
+from pydantic import BaseModel
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone as django_timezone
+from openai import APIConnectionError, NotFoundError
+from O365.connection import MSGraphProtocol
+from O365.utils.token import BaseTokenBackend, Token
+from requests.exceptions import HTTPError
+from . import assistants, cache, jobs, processing, subscriptions, utils, views
+from .backends import ChatCompletionsBackend, get_backend
+from .jobs import claim_job
+from .models import AssistantRecord, CachedMessage, EmailJob, GraphSubscription, ProcessedEmail, Tenant
+from .openai_clients import (
+    OPENAI_MAX_RETRIES,
+    RateLimitScheduler,
+    async_openai_client,
+    openai_client,
+    parse_duration,
+)
+from .tenants import GraphBudget, current_tenant, tenant_context, tenant_key
+from .tools.body import etree, extract_text
+from .tools.profile import fetch_profile, iana_timezone, profile_business_hours
+from .tools.serialize import BASELINE_SAMPLE_RATE, OutputStats, count_tokens, serialize_output
+from .tools.pagination import collect, decode_page_token, iter_pages
+from .tools.registry import ToolRegistry
+from .tools.utils import TOKEN_VERSION_CHECK_SECONDS, AccountPool
+from .tools.o365_toolkit import o365search_email_batch
+from .tools.throttling import (
+    MAX_THROTTLE_RETRIES,
+    GraphAccount,
+    ThrottlingAdapter,
+    backoff_delay,
+    mailbox_of,
+    throttle_stats,
+)
+from .tools.freebusy import BUSINESS_HOURS, _availability_view_busy, free_slots, merge_intervals
 
-# Create your tests here.
+NEW_YORK = ZoneInfo("America/New_York")
+
+
+def brute_force_free_slots(busy, start, end, tz, business_hours, min_duration):
+    """Reference implementation marking every minute of the window busy or free."""
+    minute = timedelta(minutes=1)
+    busy_minutes = set()
+    for busy_start, busy_end in busy:
+        while busy_start < busy_end:
+            busy_minutes.add(busy_start)
+            busy_start += minute
+
+    days = []
+    day = start.astimezone(tz).date()
+    while day <= end.astimezone(tz).date():
+        hours = business_hours.get(day.weekday())
+        if hours is not None:
+            window_start = max(datetime.combine(day, hours[0], tzinfo=tz), start)
+            window_end = min(datetime.combine(day, hours[1], tzinfo=tz), end)
+
+        if hours is not None and window_start < window_end:
+            slots = []
+            current = window_start
+            while current < window_end:
+                if current not in busy_minutes:
+                    if slots and slots[-1][1] == current:
+                        slots[-1][1] = current + minute
+                    else:
+                        slots.append([current, current + minute])
+                current += minute
+
+            days.append((day, [(s, e) for s, e in slots if e - s >= min_duration]))
+        day += timedelta(days=1)
+    return days
+
+
+class MergeIntervalsTests(SimpleTestCase):
+    def test_merges_overlapping_touching_and_nested(self):
+        t = lambda hour: datetime(2024, 3, 4, hour, tzinfo=timezone.utc)
+        intervals = [(t(12), t(13)), (t(9), t(11)), (t(10), t(12)), (t(14), t(16)), (t(14), t(15))]
+
+        self.assertEqual(merge_intervals(intervals), [(t(9), t(13)), (t(14), t(16))])
+
+    def test_empty(self):
+        self.assertEqual(merge_intervals([]), [])
+
+
+class FreeSlotsTests(SimpleTestCase):
+    business_hours = {weekday: (time(9), time(17)) for weekday in range(5)}
+
+    def test_clips_to_business_hours_and_skips_weekends(self):
+        # Friday 08:00 to Monday 12:00, with a meeting on Friday 10:00 to 11:00
+        start = datetime(2024, 3, 1, 8, tzinfo=NEW_YORK)
+        end = datetime(2024, 3, 4, 12, tzinfo=NEW_YORK)
+        busy = [(datetime(2024, 3, 1, 10, tzinfo=NEW_YORK), datetime(2024, 3, 1, 11, tzinfo=NEW_YORK))]
+
+        days = free_slots(busy, start, end, NEW_YORK, self.business_hours)
+
+        self.assertEqual([day for day, _ in days], [date(2024, 3, 1), date(2024, 3, 4)])
+        self.assertEqual(
+            days[0][1],
+            [
+                (datetime(2024, 3, 1, 9, tzinfo=NEW_YORK), datetime(2024, 3, 1, 10, tzinfo=NEW_YORK)),
+                (datetime(2024, 3, 1, 11, tzinfo=NEW_YORK), datetime(2024, 3, 1, 17, tzinfo=NEW_YORK)),
+            ],
+        )
+        self.assertEqual(
+            days[1][1],
+            [(datetime(2024, 3, 4, 9, tzinfo=NEW_YORK), datetime(2024, 3, 4, 12, tzinfo=NEW_YORK))],
+        )
+
+    def test_event_spanning_several_days(self):
+        start = datetime(2024, 3, 4, 0, tzinfo=NEW_YORK)
+        end = datetime(2024, 3, 7, 0, tzinfo=NEW_YORK)
+        busy = [(datetime(2024, 3, 4, 15, tzinfo=NEW_YORK), datetime(2024, 3, 6, 10, tzinfo=NEW_YORK))]
+
+        days = free_slots(busy, start, end, NEW_YORK, self.business_hours)
+
+        self.assertEqual(
+            [slots for _, slots in days],
+            [
+                [(datetime(2024, 3, 4, 9, tzinfo=NEW_YORK), datetime(2024, 3, 4, 15, tzinfo=NEW_YORK))],
+                [],
+                [(datetime(2024, 3, 6, 10, tzinfo=NEW_YORK), datetime(2024, 3, 6, 17, tzinfo=NEW_YORK))],
+            ],
+        )
+
+    def test_minimum_duration(self):
+        start = datetime(2024, 3, 4, 9, tzinfo=NEW_YORK)
+        end = datetime(2024, 3, 4, 17, tzinfo=NEW_YORK)
+        busy = [
+            (datetime(2024, 3, 4, 9, 30, tzinfo=NEW_YORK), datetime(2024, 3, 4, 12, tzinfo=NEW_YORK)),
+            (datetime(2024, 3, 4, 12, 45, tzinfo=NEW_YORK), datetime(2024, 3, 4, 16, tzinfo=NEW_YORK)),
+        ]
+
+        days = free_slots(busy, start, end, NEW_YORK, self.business_hours, timedelta(hours=1))
+
+        self.assertEqual(
+            days[0][1],
+            [(datetime(2024, 3, 4, 16, tzinfo=NEW_YORK), datetime(2024, 3, 4, 17, tzinfo=NEW_YORK))],
+        )
+
+    def test_busy_intervals_in_other_time_zones(self):
+        start = datetime(2024, 3, 4, 9, tzinfo=NEW_YORK)
+        end = datetime(2024, 3, 4, 17, tzinfo=NEW_YORK)
+        # 15:00 to 16:00 UTC is 10:00 to 11:00 in New York
+        busy = [(datetime(2024, 3, 4, 15, tzinfo=timezone.utc), datetime(2024, 3, 4, 16, tzinfo=timezone.utc))]
+
+        days = free_slots(busy, start, end, NEW_YORK, self.business_hours)
+
+        self.assertEqual(
+            [(s.hour, e.hour) for s, e in days[0][1]], [(9, 10), (11, 17)]
+        )
+
+    def test_thousands_of_events_match_brute_force(self):
+        rng = random.Random(1234)
+        # Four weeks across the March daylight saving time change
+        start = datetime(2024, 2, 26, 0, tzinfo=NEW_YORK)
+        end = datetime(2024, 3, 25, 0, tzinfo=NEW_YORK)
+        business_hours = {
+            0: (time(8), time(17)),
+            1: (time(9), time(17)),
+            2: (time(9), time(12, 30)),
+            3: (time(9), time(17)),
+            4: (time(10), time(15)),
+        }
+
+        # Short events on a minute grid leave many gaps of varying length
+        busy = []
+        for _ in range(5000):
+            busy_start = start + timedelta(minutes=rng.randrange(28 * 24 * 60))
+            busy_end = busy_start + timedelta(minutes=rng.choice([1, 2, 5, 10, 30]))
+            busy.append((busy_start, busy_end))
+        # Events that span midnight and whole days
+        busy.append((datetime(2024, 3, 12, 23, tzinfo=NEW_YORK), datetime(2024, 3, 13, 10, tzinfo=NEW_YORK)))
+        busy.append((datetime(2024, 3, 19, 6, tzinfo=NEW_YORK), datetime(2024, 3, 20, 18, tzinfo=NEW_YORK)))
+
+        for min_duration in (timedelta(0), timedelta(minutes=15)):
+            expected = brute_force_free_slots(
+                busy, start, end, NEW_YORK, business_hours, min_duration
+            )
+            actual = free_slots(busy, start, end, NEW_YORK, business_hours, min_duration)
+            self.assertEqual(actual, expected)
+
+
+class AvailabilityViewTests(SimpleTestCase):
+    def test_busy_codes_become_merged_intervals(self):
+        start = datetime(2024, 3, 4, 14, tzinfo=timezone.utc)
+        t = lambda minutes: start + timedelta(minutes=minutes)
+
+        # Free, tentative, busy, working elsewhere, out of office
+        busy = _availability_view_busy("0122403", start, timedelta(minutes=15))
+
+        self.assertEqual(busy, [(t(15), t(60)), (t(90), t(105))])
+
+
+class ExtractTextTests(SimpleTestCase):
+    backend = "html.parser"
+
+    def extract(self, body, **kwargs):
+        return extract_text(body, backend=self.backend, **kwargs)
+
+    def test_normalizes_like_get_text(self):
+        body = (
+            "<html><head><title>T</title><style>p{}</style></head><body><!--c-->"
+            "<script>x=1</script><p>Hello</p>\n<p>W&amp;orld&nbsp;!</p>  <p> Again </p></body></html>"
+        )
+
+        self.assertEqual(self.extract(body), "THelloW&orld ! Again")
+
+    def test_stops_at_limit(self):
+        body = "<table>" + "<tr><td>word </td></tr>" * 10000 + "</table>"
+
+        self.assertEqual(self.extract(body, limit=12), "word word wo")
+
+    def test_plain_text(self):
+        self.assertEqual(self.extract("  Hi Monica,\r\n\r\nAre you free?  "), "Hi Monica,Are you free?")
+
+    def test_strips_reply_history(self):
+        body = (
+            "<div>See you then.</div><hr><div id='divRplyFwdMsg'><b>From:</b> Guest"
+            "<br><b>Subject:</b> RE: Meeting</div><div>Does 10:00 work?</div>"
+        )
+
+        self.assertEqual(self.extract(body, strip_quotes=True), "See you then.")
+        self.assertIn("Does 10:00 work?", self.extract(body))
+
+    def test_keeps_text_after_a_quote(self):
+        body = (
+            "<div>Hi,</div><div class='gmail_quote'><div>On Monday, Guest wrote:</div>"
+            "<blockquote type='cite'><div>Does 10:00 work?</div>" + "<div>Old reply</div>" * 200
+            + "</blockquote></div><div>10:00 works for me.</div>"
+        )
+
+        self.assertEqual(self.extract(body, strip_quotes=True), "Hi,10:00 works for me.")
+
+    def test_keeps_forwarded_content(self):
+        body = (
+            "<div>Hi Monica, can you find a time?<div class='gmail_quote'>"
+            "---------- Forwarded message ---------<br>From: Guest</div>"
+            "<div>Does 10:00 work?</div></div>"
+        )
+
+        self.assertTrue(self.extract(body, strip_quotes=True).endswith("Does 10:00 work?"))
+
+
+@skipIf(etree is None, "lxml is not installed")
+class LxmlExtractTextTests(ExtractTextTests):
+    backend = "lxml"
+
+
+class SerializeOutputTests(SimpleTestCase):
+    def email(self, message_id, body, cc=()):
+        return {
+            "from": "Guest <guest@example.com>",
+            "body": body,
+            "subject": "Meeting",
+            "message_id": message_id,
+            "to": ["Monica <monica@example.com>"],
+            "cc": list(cc),
+            "bcc": [],
+        }
+
+    def test_orders_fields_and_drops_empty_recipients(self):
+        output = serialize_output([self.email("m1", "Hi", cc=["Team <team@example.com>"])])
+
+        self.assertEqual(
+            output,
+            '[{"message_id":"m1","subject":"Meeting","from":"Guest <guest@example.com>",'
+            '"to":["Monica <monica@example.com>"],"cc":["Team <team@example.com>"],"body":"Hi"}]',
+        )
+
+    def test_compacts_json_strings_and_keeps_plain_strings(self):
+        self.assertEqual(serialize_output(json.dumps({"a": [1, 2]}, indent=4)), '{"a":[1,2]}')
+        self.assertEqual(serialize_output("Message sent: Meeting"), "Message sent: Meeting")
+
+    def test_trims_longest_bodies_to_budget(self):
+        emails = [self.email("m1", "word " * 5000), self.email("m2", "Short body")]
+
+        output = serialize_output(emails, token_budget=1000)
+
+        self.assertLessEqual(count_tokens(output), 1000)
+        trimmed, short = json.loads(output)
+        self.assertTrue(trimmed["body"].endswith("[trimmed]"))
+        self.assertEqual(short["body"], "Short body")
+
+    def test_tokenizes_the_baseline_of_sampled_outputs_only(self):
+        stats = OutputStats()
+        with mock.patch("email_service.tools.serialize.output_stats", stats), mock.patch(
+            "email_service.tools.serialize.pprint.pformat", wraps=pprint.pformat
+        ) as pformat:
+            for _ in range(BASELINE_SAMPLE_RATE + 1):
+                serialize_output([self.email("m1", "Hi")], name="search_emails")
+
+        self.assertEqual(pformat.call_count, 2)
+        search = stats.stats()["search_emails"]
+        self.assertEqual(search["calls"], BASELINE_SAMPLE_RATE + 1)
+        self.assertEqual(search["sampled"], 2)
+        self.assertGreater(search["mean_tokens_saved"], 0)
+        self.assertEqual(
+            search["tokens_saved"], round(search["mean_tokens_saved"] * search["calls"])
+        )
+
+
+
+class FakePagedConnection:
+    """Serves a Graph collection in pages, recording the requested urls."""
+
+    service_url = "https://graph.microsoft.com/v1.0/"
+
+    def __init__(self, items, page_size):
+        self.items = items
+        self.page_size = page_size
+        self.requests = []
+
+    def get(self, url, params=None, headers=None):
+        self.requests.append(url)
+        start = int(url.rsplit("skip=", 1)[1]) if "skip=" in url else 0
+        data = {"value": self.items[start:start + self.page_size]}
+        if start + self.page_size < len(self.items):
+            data["@odata.nextLink"] = f"{self.service_url}me/messages?skip={start + self.page_size}"
+        return SimpleNamespace(json=lambda: data)
+
+
+class PaginationTests(SimpleTestCase):
+    url = FakePagedConnection.service_url + "me/messages"
+
+    def search(self, con, max_results, page_token=None, byte_budget=16000):
+        cursor = (
+            decode_page_token(page_token, con.service_url)
+            if page_token
+            else {"url": self.url, "params": {"$top": 3}, "skip": 0}
+        )
+        return collect(
+            iter_pages(con, cursor["url"], cursor["params"], cursor["skip"]),
+            lambda item: {"id": item},
+            max_results,
+            byte_budget=byte_budget,
+        )
+
+    def test_full_pages_do_not_request_the_next_one(self):
+        con = FakePagedConnection([f"m{i}" for i in range(7)], page_size=3)
+
+        outputs, token = self.search(con, max_results=3)
+
+        self.assertEqual(outputs, [{"id": "m0"}, {"id": "m1"}, {"id": "m2"}])
+        self.assertEqual(con.requests, [self.url])
+        self.assertEqual(decode_page_token(token, con.service_url)["url"], self.url.replace("messages", "messages?skip=3"))
+
+    def test_page_tokens_resume_where_the_search_stopped(self):
+        con = FakePagedConnection([f"m{i}" for i in range(7)], page_size=3)
+        results = []
+        token = None
+
+        # Stops mid-page, and at page boundaries
+        for max_results in (2, 2, 2, 2):
+            outputs, token = self.search(con, max_results, token)
+            results += [output["id"] for output in outputs]
+
+        self.assertEqual(results, [f"m{i}" for i in range(7)])
+        self.assertIsNone(token)
+
+    def test_byte_budget_stops_the_search_but_keeps_one_item(self):
+        con = FakePagedConnection(["m0", "m1", "m2"], page_size=3)
+
+        outputs, token = self.search(con, max_results=3, byte_budget=1)
+
+        self.assertEqual(outputs, [{"id": "m0"}])
+        self.assertEqual(decode_page_token(token, con.service_url)["skip"], 1)
+
+    def test_tokens_outside_graph_are_rejected(self):
+        token = self.search(FakePagedConnection(["m0", "m1"], page_size=3), max_results=1)[1]
+
+        with self.assertRaises(ValueError):
+            decode_page_token(token, "https://graph.microsoft.us/v1.0/")
+        with self.assertRaises(ValueError):
+            decode_page_token("not a token", FakePagedConnection.service_url)
+
+class ProfileTests(SimpleTestCase):
+    def account(self, user):
+        response = SimpleNamespace(json=lambda: user)
+        con = SimpleNamespace(get=lambda url, params=None: response)
+        mailbox = SimpleNamespace(build_url=lambda path: "https://graph.microsoft.com/v1.0/me" + path)
+        return SimpleNamespace(con=con, mailbox=lambda: mailbox)
+
+    def test_windows_time_zones_map_to_canonical_zones(self):
+        self.assertEqual(iana_timezone("Central Standard Time"), "America/Chicago")
+        self.assertEqual(iana_timezone("Europe/Madrid"), "Europe/Madrid")
+        self.assertEqual(iana_timezone("Customized Time Zone"), "America/New_York")
+
+    def test_working_hours_from_mailbox_settings(self):
+        profile = fetch_profile(
+            self.account(
+                {
+                    "displayName": "Ana",
+                    "mail": "ana@example.com",
+                    "mailboxSettings": {
+                        "timeZone": "Pacific Standard Time",
+                        "workingHours": {
+                            "daysOfWeek": ["tuesday", "monday"],
+                            "startTime": "08:00:00.0000000",
+                            "endTime": "16:30:00.0000000",
+                            "timeZone": {"name": "Pacific Standard Time"},
+                        },
+                    },
+                }
+            )
+        )
+
+        business_hours, hours_timezone = profile_business_hours(profile)
+        self.assertEqual(profile["timezone"], "America/Los_Angeles")
+        self.assertEqual(business_hours, {0: (time(8), time(16, 30)), 1: (time(8), time(16, 30))})
+        self.assertEqual(hours_timezone, ZoneInfo("America/Los_Angeles"))
+
+    def test_defaults_without_mailbox_settings(self):
+        profile = fetch_profile(self.account({"displayName": "Ana", "userPrincipalName": "ana@example.com"}))
+
+        business_hours, hours_timezone = profile_business_hours(profile)
+        self.assertEqual(profile["email"], "ana@example.com")
+        self.assertEqual(business_hours, BUSINESS_HOURS)
+        self.assertEqual(hours_timezone, NEW_YORK)
+
+
+class TenantTests(TestCase):
+    def job(self, message_id, tenant, minutes_ago):
+        return EmailJob.objects.create(
+            message_id=message_id,
+            tenant=tenant,
+            available_at=django_timezone.now() - timedelta(minutes=minutes_ago),
+        )
+
+    def test_jobs_are_claimed_fairly_across_tenants(self):
+        busy = Tenant.objects.create(slug="busy", max_concurrency=2)
+        quiet = Tenant.objects.create(slug="quiet", max_concurrency=2)
+        for i in range(5):
+            self.job(f"busy-{i}", busy, minutes_ago=10 - i)
+        self.job("quiet-0", quiet, minutes_ago=1)
+
+        claimed = [claim_job("worker") for _ in range(4)]
+
+        # The quiet tenant's job isn't stuck behind the busy backlog, and the busy
+        # tenant never runs more than max_concurrency jobs
+        self.assertEqual([job.message_id for job in claimed[:3]], ["busy-0", "quiet-0", "busy-1"])
+        self.assertIsNone(claimed[3])
+        self.assertEqual(
+            EmailJob.objects.filter(tenant=busy, status=EmailJob.RUNNING).count(), 2
+        )
+
+    def test_keys_are_scoped_to_the_current_tenant(self):
+        self.assertEqual(tenant_key("inbox"), "inbox")
+        with tenant_context(Tenant(slug="alex")):
+            self.assertEqual(tenant_key("inbox"), "alex:inbox")
+
+    def test_graph_budget_delays_requests_beyond_the_burst(self):
+        budget = GraphBudget(requests_per_minute=60)
+        waits = [budget.reserve() for _ in range(11)]
+
+        self.assertEqual(waits[:10], [0.0] * 10)
+        self.assertAlmostEqual(waits[10], 1.0, places=2)
+        self.assertEqual(budget.available(), 0)
+
+
+class ThrottlingTests(SimpleTestCase):
+    def response(self, status, retry_after=None):
+        headers = {"Retry-After": retry_after} if retry_after else {}
+        return SimpleNamespace(status_code=status, headers=headers, close=lambda: None)
+
+    def send(self, method, responses):
+        adapter = ThrottlingAdapter(SimpleNamespace(mailbox_key="tests"))
+        request = SimpleNamespace(method=method, url="https://graph.microsoft.com/v1.0/me/messages")
+        with mock.patch("requests.adapters.HTTPAdapter.send", side_effect=responses) as send, \
+                mock.patch("email_service.tools.throttling.time.sleep") as sleep:
+            response = adapter.send(request)
+        return response, send.call_count, [call.args[0] for call in sleep.call_args_list]
+
+    def test_retry_after_is_honored(self):
+        throttle_stats.reset()
+        response, sends, sleeps = self.send(
+            "POST", [self.response(429, "2"), self.response(429, "1"), self.response(202)]
+        )
+
+        self.assertEqual((response.status_code, sends, sleeps), (202, 3, [2.0, 1.0]))
+        self.assertEqual(throttle_stats.stats()["retries"], 2)
+
+    def test_unavailable_writes_are_not_retried(self):
+        response, sends, _ = self.send("POST", [self.response(503), self.response(202)])
+        self.assertEqual((response.status_code, sends), (503, 1))
+
+    def test_backoff_is_jittered_and_capped(self):
+        delays = [backoff_delay(3) for _ in range(100)]
+        self.assertTrue(all(0 <= delay <= 4 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+        self.assertEqual(backoff_delay(0, "600"), 60)
+
+    def test_users_urls_target_their_mailbox(self):
+        self.assertEqual(mailbox_of("https://graph.microsoft.com/v1.0/users/Ana@x.com/events", "me"), "users/ana@x.com")
+        self.assertEqual(mailbox_of("https://graph.microsoft.com/v1.0/me/events", "alex"), "alex")
+
+
+class RateLimitSchedulerTests(SimpleTestCase):
+    def test_reset_durations(self):
+        self.assertEqual(parse_duration("6m0s"), 360)
+        self.assertAlmostEqual(parse_duration("1.5s"), 1.5)
+        self.assertAlmostEqual(parse_duration("20ms"), 0.02)
+        self.assertIsNone(parse_duration(None))
+
+    def test_requests_wait_once_the_window_is_nearly_spent(self):
+        scheduler = RateLimitScheduler()
+        scheduler.observe(
+            "gpt-4o",
+            200,
+            {"x-ratelimit-remaining-requests": "3", "x-ratelimit-reset-requests": "30s"},
+        )
+
+        waits = [scheduler.delay("gpt-4o") for _ in range(3)]
+
+        # Requests in flight are counted against the remaining requests
+        self.assertEqual(waits[:2], [0.0, 0.0])
+        self.assertAlmostEqual(waits[2], 30, delta=1)
+
+    def test_throttled_model_holds_its_requests(self):
+        scheduler = RateLimitScheduler()
+        scheduler.observe("gpt-4o", 429, {"retry-after-ms": "2000"})
+
+        self.assertAlmostEqual(scheduler.delay("gpt-4o"), 2, delta=0.5)
+        self.assertEqual(scheduler.delay("gpt-4o-mini"), 0.0)
+        self.assertEqual(scheduler.stats()["gpt-4o"]["throttled"], 1)
+
+    def test_concurrency_caps_are_configurable_per_model(self):
+        with mock.patch.dict("os.environ", {"OPENAI_MODEL_CONCURRENCY": "gpt-4o=2"}):
+            scheduler = RateLimitScheduler()
+            with scheduler.slot("gpt-4o"), scheduler.slot("gpt-4o"):
+                self.assertFalse(scheduler.limits("gpt-4o").semaphore.acquire(blocking=False))
+                self.assertEqual(scheduler.stats()["gpt-4o"]["in_flight"], 2)
+
+
+
+class OpenAIClientTests(SimpleTestCase):
+    def test_clients_are_built_once_per_key(self):
+        client = openai_client(api_key="key", base_url="http://127.0.0.1:9/v1")
+
+        self.assertIs(openai_client(api_key="key", base_url="http://127.0.0.1:9/v1"), client)
+        self.assertIsNot(openai_client(api_key="other", base_url="http://127.0.0.1:9/v1"), client)
+        self.assertEqual(client.max_retries, OPENAI_MAX_RETRIES)
+
+    def test_async_clients_are_built_once_per_event_loop(self):
+        async def build():
+            return async_openai_client(api_key="key"), async_openai_client(api_key="key")
+
+        first, again = asyncio.run(build())
+        other_loop, _ = asyncio.run(build())
+
+        self.assertIs(first, again)
+        self.assertIsNot(first, other_loop)
+
+class ChatCompletionsBackendTests(SimpleTestCase):
+    def openai_client(self, responses):
+        self.requests = []
+
+        def create(**request):
+            self.requests.append(request)
+            return responses.pop(0)
+
+        return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    def chunk(self, content=None, tool_calls=None):
+        delta = SimpleNamespace(content=content, tool_calls=tool_calls)
+        return SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+    def tool_call_delta(self, index, id=None, name=None, arguments=None):
+        return SimpleNamespace(
+            index=index, id=id, function=SimpleNamespace(name=name, arguments=arguments)
+        )
+
+    def test_tool_calls_round_trip_in_the_local_history(self):
+        streamed = []
+        client = self.openai_client(
+            [
+                [
+                    self.chunk(tool_calls=[self.tool_call_delta(0, "call_1", "unknown_tool", '{"a"')]),
+                    self.chunk(tool_calls=[self.tool_call_delta(0, arguments=": 1}")]),
+                ],
+                [self.chunk("Hello, "), self.chunk("Ana.")],
+            ]
+        )
+        backend = ChatCompletionsBackend()
+        conversation = backend.create(model="gpt-4o", interface="email", client=client)
+
+        response = backend.execute(
+            conversation, "Hi Monica,", additional_instructions="Context.", on_text=streamed.append
+        )
+
+        self.assertEqual(response, "Hello, Ana.")
+        self.assertEqual(streamed, ["Hello, ", "Ana."])
+        messages = self.requests[1]["messages"]
+        self.assertEqual([m["role"] for m in messages], ["system", "system", "user", "assistant", "tool"])
+        self.assertEqual(messages[3]["tool_calls"][0]["function"]["arguments"], '{"a": 1}')
+        self.assertEqual(messages[4]["tool_call_id"], "call_1")
+        self.assertIn("no tool called unknown_tool", messages[4]["content"])
+
+    def test_backend_is_selected_per_interface(self):
+        self.assertEqual(get_backend("cli").name, "assistants")
+        self.assertEqual(get_backend("email").name, "assistants")
+        with mock.patch.dict("os.environ", {"ADMINGPT_EMAIL_BACKEND": "chat"}):
+            self.assertEqual(get_backend("email").name, "chat")
+        with self.assertRaises(ValueError):
+            get_backend("cli", "threads")
+
+
+class AccountPoolTests(SimpleTestCase):
+    def account(self, expired=False):
+        token = SimpleNamespace(is_access_expired=expired)
+        con = SimpleNamespace(token_backend=SimpleNamespace(token=token))
+
+        def refresh_token():
+            con.token_backend.token = SimpleNamespace(is_access_expired=False)
+            return True
+
+        con.refresh_token = mock.Mock(side_effect=refresh_token)
+        return SimpleNamespace(con=con)
+
+    def test_accounts_are_reused_after_the_first_miss(self):
+        pool = AccountPool()
+        factory = mock.Mock(side_effect=[self.account(), self.account()])
+
+        first = pool.get(("email", "id"), factory)
+        second = pool.get(("email", "id"), factory)
+
+        self.assertIs(first, second)
+        self.assertEqual(factory.call_count, 1)
+        self.assertEqual((pool.stats()["hits"], pool.stats()["misses"]), (1, 1))
+
+    def test_failed_authentication_is_not_pooled(self):
+        pool = AccountPool()
+        factory = mock.Mock(side_effect=[None, self.account()])
+
+        self.assertIsNone(pool.get(("email", "id"), factory))
+        self.assertIsNotNone(pool.get(("email", "id"), factory))
+        self.assertEqual(pool.stats()["accounts"], 1)
+
+    def test_expired_tokens_are_refreshed_once(self):
+        pool = AccountPool()
+        account = self.account(expired=True)
+
+        pool.get(("email", "id"), lambda: account)
+        pool.get(("email", "id"), lambda: account)
+
+        self.assertEqual(account.con.refresh_token.call_count, 1)
+        self.assertEqual(pool.stats()["refreshes"], 1)
+
+    def test_accounts_are_rebuilt_when_another_process_replaces_the_token(self):
+        pool = AccountPool()
+        version = ["token-1"]
+        token_version = mock.Mock(side_effect=lambda: version[0])
+        stale, fresh = self.account(), self.account()
+        factory = mock.Mock(side_effect=[stale, fresh])
+        now = [100.0]
+
+        with mock.patch("email_service.tools.utils.time.monotonic", side_effect=lambda: now[0]):
+            pool.get(("email", "id"), factory, token_version=token_version)
+            # A re-authentication in the web process saves a new token
+            version[0] = "token-2"
+            # Pool hits don't read the stored token until the check is due
+            self.assertIs(pool.get(("email", "id"), factory, token_version=token_version), stale)
+            self.assertEqual(token_version.call_count, 1)
+
+            now[0] += TOKEN_VERSION_CHECK_SECONDS
+            account = pool.get(("email", "id"), factory, token_version=token_version)
+
+        self.assertIs(account, fresh)
+        self.assertEqual(pool.stats()["reloads"], 1)
+        self.assertIs(pool.get(("email", "id"), factory, token_version=token_version), fresh)
+
+    def test_expired_and_rechecked_accounts_read_the_stored_token_first(self):
+        pool = AccountPool()
+        version = ["token-1"]
+        stale, fresh = self.account(), self.account()
+        factory = mock.Mock(side_effect=[stale, fresh])
+
+        pool.get(("email", "id"), factory, token_version=lambda: version[0])
+        version[0] = "token-2"
+        # A 401 makes the next use check the stored token
+        pool.recheck("email")
+        self.assertIs(pool.get(("email", "id"), factory, token_version=lambda: version[0]), fresh)
+
+        # An expired token is never refreshed over a newer stored one
+        fresh.con.token_backend.token = SimpleNamespace(is_access_expired=True)
+        version[0] = "token-3"
+        account = pool.get(("email", "id"), lambda: self.account(), token_version=lambda: version[0])
+
+        self.assertIsNot(account, fresh)
+        fresh.con.refresh_token.assert_not_called()
+
+    def test_a_slow_factory_does_not_block_other_keys(self):
+        pool = AccountPool()
+        authenticating, release = threading.Event(), threading.Event()
+
+        def slow_factory():
+            authenticating.set()
+            release.wait(5)
+            return self.account()
+
+        thread = threading.Thread(target=pool.get, args=(("cli", "slow"), slow_factory))
+        thread.start()
+        authenticating.wait(5)
+        try:
+            # Another tenant's account is created while the first still authenticates
+            self.assertIsNotNone(pool.get(("email", "other"), self.account))
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(pool.stats()["accounts"], 2)
+
+
+class AssistantRegistryTests(TestCase):
+    def setUp(self):
+        assistants._verified_at.clear()
+        self.deleted = set()
+        self.created = 0
+
+        def create(**config):
+            self.created += 1
+            return SimpleNamespace(id=f"asst_{self.created}", **config)
+
+        def retrieve(assistant_id):
+            if assistant_id in self.deleted:
+                response = SimpleNamespace(request=None, status_code=404, headers={})
+                raise NotFoundError("No assistant found", response=response, body=None)
+            return SimpleNamespace(id=assistant_id)
+
+        self.client = SimpleNamespace(
+            beta=SimpleNamespace(
+                assistants=SimpleNamespace(create=create, retrieve=retrieve, delete=self.deleted.add)
+            )
+        )
+
+    def assistant(self):
+        return assistants.get_or_create_assistant(
+            self.client, "Instructions.", "gpt-4o", [], 0.05, interface="email"
+        )
+
+    def test_registered_assistants_are_reused(self):
+        first = self.assistant()
+        second = self.assistant()
+
+        self.assertEqual((first.id, second.id, self.created), ("asst_1", "asst_1", 1))
+        self.assertEqual(AssistantRecord.objects.get().assistant_id, "asst_1")
+
+    def test_assistants_deleted_outside_the_registry_are_recreated(self):
+        self.assistant()
+        self.deleted.add("asst_1")
+        assistants._verified_at.clear()
+
+        self.assertEqual(self.assistant().id, "asst_2")
+        self.assertEqual(AssistantRecord.objects.get().assistant_id, "asst_2")
+
+    def test_runs_failing_on_a_missing_assistant_drop_its_record(self):
+        self.assistant()
+        self.deleted.add("asst_1")
+
+        self.assertTrue(assistants.forget_missing_assistant(self.client, "asst_1", "email"))
+        self.assertFalse(AssistantRecord.objects.exists())
+        self.assertEqual(self.assistant().id, "asst_2")
+
+    def test_assistants_created_concurrently_keep_the_first_registered(self):
+        create = self.client.beta.assistants.create
+
+        def create_while_another_process_registers(**config):
+            # Another process misses the registry at the same time, and saves first
+            AssistantRecord.objects.create(
+                key=assistants.assistant_key("Instructions.", "gpt-4o", [], 0.05),
+                assistant_id="asst_other",
+                model="gpt-4o",
+                instructions_hash="",
+                last_used_at=django_timezone.now(),
+            )
+            return create(**config)
+
+        self.client.beta.assistants.create = create_while_another_process_registers
+
+        self.assertEqual(self.assistant().id, "asst_other")
+        # Our Assistant is deleted instead of orphaned
+        self.assertEqual(self.deleted, {"asst_1"})
+        self.assertEqual(AssistantRecord.objects.get().assistant_id, "asst_other")
+
+    def test_cli_registry_lives_in_the_home_directory(self):
+        self.assertEqual(
+            assistants.REGISTRY_FILE, os.path.expanduser("~/.admingpt_assistants.json")
+        )
+
+
+class FakeStream:
+    """Stream manager yielding events, optionally breaking after them like a dropped connection."""
+
+    def __init__(self, events, breaks=False):
+        self.events = events
+        self.breaks = breaks
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __iter__(self):
+        yield from self.events
+        if self.breaks:
+            raise APIConnectionError(request=None)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def __aiter__(self):
+        for event in self:
+            yield event
+
+
+class StreamForResponseTests(SimpleTestCase):
+    thread = SimpleNamespace(id="thread_1")
+
+    def event(self, name, data):
+        return SimpleNamespace(event=name, data=data)
+
+    def run_object(self, status, tool_calls=None):
+        required_action = None
+        if tool_calls is not None:
+            required_action = SimpleNamespace(
+                type="submit_tool_outputs",
+                submit_tool_outputs=SimpleNamespace(tool_calls=tool_calls),
+            )
+        return SimpleNamespace(id="run_1", status=status, required_action=required_action)
+
+    def text(self, value):
+        return SimpleNamespace(type="text", text=SimpleNamespace(value=value))
+
+    def test_tool_calls_are_dispatched_on_requires_action(self):
+        tool_calls = [SimpleNamespace(id="call_1")]
+        answer = FakeStream(
+            [
+                self.event("thread.message.delta", SimpleNamespace(delta=SimpleNamespace(content=[self.text("Hi")]))),
+                self.event("thread.message.completed", SimpleNamespace(content=[self.text("Hi Ana")])),
+                self.event("thread.run.completed", self.run_object("completed")),
+            ]
+        )
+        submit = mock.Mock(return_value=answer)
+        client = SimpleNamespace(
+            beta=SimpleNamespace(threads=SimpleNamespace(runs=SimpleNamespace(submit_tool_outputs_stream=submit)))
+        )
+        streamed = []
+        outputs = [{"tool_call_id": "call_1", "output": "[]"}]
+
+        with mock.patch("email_service.utils.execute_tool_calls", return_value=outputs) as execute:
+            response = utils.stream_for_response(
+                client,
+                self.thread,
+                FakeStream(
+                    [
+                        self.event("thread.run.created", self.run_object("queued")),
+                        self.event("thread.run.requires_action", self.run_object("requires_action", tool_calls)),
+                    ]
+                ),
+                "gpt-4o",
+                on_text=streamed.append,
+            )
+
+        self.assertEqual(response, "Hi Ana")
+        self.assertEqual(streamed, ["Hi"])
+        execute.assert_called_once_with(tool_calls, interface="cli")
+        submit.assert_called_once_with(thread_id="thread_1", run_id="run_1", tool_outputs=outputs)
+
+    def test_broken_stream_falls_back_to_polling_the_run(self):
+        stream = FakeStream([self.event("thread.run.created", self.run_object("in_progress"))], breaks=True)
+
+        with mock.patch("email_service.utils.poll_for_response", return_value="Polled") as poll:
+            response = utils.stream_for_response(None, self.thread, stream, "gpt-4o")
+
+        self.assertEqual(response, "Polled")
+        self.assertEqual(poll.call_args.args[2].id, "run_1")
+
+    def test_stream_breaking_before_the_run_is_created_raises(self):
+        with self.assertRaises(APIConnectionError):
+            utils.stream_for_response(None, self.thread, FakeStream([], breaks=True), "gpt-4o")
+
+    def test_polling_backs_off_until_the_status_changes(self):
+        statuses = iter(["queued", "in_progress", "in_progress", "in_progress", "completed"])
+        message = SimpleNamespace(content=[self.text("Done")])
+        runs = SimpleNamespace(retrieve=lambda thread_id, run_id: self.run_object(next(statuses)))
+        messages = SimpleNamespace(list=lambda thread_id: SimpleNamespace(data=[message]))
+        client = SimpleNamespace(beta=SimpleNamespace(threads=SimpleNamespace(runs=runs, messages=messages)))
+
+        with mock.patch("email_service.utils.time.sleep") as sleep:
+            response = utils.poll_for_response(client, self.thread, self.run_object("queued"), "gpt-4o")
+
+        minimum = utils.POLL_MIN_DELAY_SECONDS
+        self.assertEqual(response, "Done")
+        self.assertEqual(
+            [call.args[0] for call in sleep.call_args_list],
+            [minimum, minimum, minimum * 2, minimum * 4],
+        )
+
+
+    def test_async_streams_share_the_event_handling(self):
+        from . import async_utils
+
+        tool_calls = [SimpleNamespace(id="call_1")]
+        submit = mock.Mock(return_value=FakeStream([], breaks=True))
+        client = SimpleNamespace(
+            beta=SimpleNamespace(threads=SimpleNamespace(runs=SimpleNamespace(submit_tool_outputs_stream=submit)))
+        )
+        outputs = [{"tool_call_id": "call_1", "output": "[]"}]
+
+        with mock.patch("email_service.async_utils.aexecute_tool_calls", return_value=outputs), mock.patch(
+            "email_service.async_utils.apoll_for_response", return_value="Polled"
+        ) as poll:
+            response = asyncio.run(
+                async_utils.astream_for_response(
+                    client,
+                    self.thread,
+                    FakeStream([self.event("thread.run.requires_action", self.run_object("requires_action", tool_calls))]),
+                    "gpt-4o",
+                )
+            )
+
+        # The submitted stream broke, so the run is polled
+        self.assertEqual(response, "Polled")
+        submit.assert_called_once_with(thread_id="thread_1", run_id="run_1", tool_outputs=outputs)
+        self.assertEqual(poll.call_args.args[2].id, "run_1")
+
+    def test_async_polling_backs_off_like_polling(self):
+        from . import async_utils
+
+        statuses = iter(["queued", "queued", "failed"])
+
+        async def retrieve(thread_id, run_id):
+            return self.run_object(next(statuses))
+
+        client = SimpleNamespace(
+            beta=SimpleNamespace(threads=SimpleNamespace(runs=SimpleNamespace(retrieve=retrieve)))
+        )
+
+        with mock.patch("email_service.async_utils.asyncio.sleep") as sleep:
+            response = asyncio.run(
+                async_utils.apoll_for_response(client, self.thread, self.run_object("queued"), "gpt-4o")
+            )
+
+        minimum = utils.POLL_MIN_DELAY_SECONDS
+        self.assertEqual(response, utils.RUN_FAILED_RESPONSE)
+        self.assertEqual([call.args[0] for call in sleep.call_args_list][-2:], [minimum, minimum * 2])
+
+class SleepParameters(BaseModel):
+    seconds: float = 0
+
+
+class ExecuteToolCallsTests(SimpleTestCase):
+    def setUp(self):
+        self.registry = ToolRegistry()
+        self.writes = []
+
+        def read(seconds, interface="cli"):
+            time_module.sleep(seconds)
+            return f"slept {seconds}"
+
+        def fail(seconds, interface="cli"):
+            raise ConnectionError("Graph is unreachable")
+
+        def write(seconds, interface="cli"):
+            self.writes.append(seconds)
+            return f"wrote {seconds}"
+
+        self.registry.register("read", read, SleepParameters, "Reads.", read_only=True)
+        self.registry.register("fail", fail, SleepParameters, "Fails.", read_only=True)
+        self.registry.register("write", write, SleepParameters, "Writes.")
+
+    def call(self, id, name, seconds=0):
+        return SimpleNamespace(
+            id=id, function=SimpleNamespace(name=name, arguments=json.dumps({"seconds": seconds}))
+        )
+
+    def execute(self, tool_calls):
+        with mock.patch("email_service.utils.toolkit_registry", self.registry):
+            return utils.execute_tool_calls(tool_calls)
+
+    def test_outputs_keep_the_order_of_the_calls(self):
+        tool_calls = [
+            self.call("call_1", "read", 0.2),
+            self.call("call_2", "write", 1),
+            self.call("call_3", "read", 0.2),
+            self.call("call_4", "write", 2),
+            self.call("call_5", "read", 0),
+        ]
+
+        start = time_module.perf_counter()
+        outputs = self.execute(tool_calls)
+        elapsed = time_module.perf_counter() - start
+
+        self.assertEqual([output["tool_call_id"] for output in outputs], [f"call_{i}" for i in range(1, 6)])
+        self.assertEqual(outputs[1]["output"], "wrote 1.0")
+        # Reads overlap, while writes run one at a time in the requested order
+        self.assertLess(elapsed, 0.35)
+        self.assertEqual(self.writes, [1, 2])
+
+    def test_a_failing_tool_does_not_drop_the_other_outputs(self):
+        outputs = self.execute(
+            [self.call("call_1", "read"), self.call("call_2", "fail"), self.call("call_3", "read")]
+        )
+
+        self.assertEqual(len(outputs), 3)
+        self.assertEqual(outputs[0]["output"], "slept 0.0")
+        self.assertIn("Graph is unreachable", outputs[1]["output"])
+        self.assertEqual(outputs[2]["output"], "slept 0.0")
+        self.assertEqual(self.registry.stats()["fail"]["errors"], 1)
+
+
+class ToolRegistryTests(SimpleTestCase):
+    def setUp(self):
+        self.registry = ToolRegistry()
+        self.registry.register(
+            "sleep", lambda seconds, interface="cli": f"slept {seconds}", SleepParameters, "Sleeps."
+        )
+
+    def test_arguments_are_validated_against_the_parameter_model(self):
+        self.assertEqual(self.registry.dispatch("sleep", '{"seconds": 2}'), "slept 2.0")
+        self.assertEqual(self.registry.dispatch("sleep", ""), "slept 0")
+
+        output = self.registry.dispatch("sleep", '{"seconds": "soon"}')
+
+        self.assertTrue(output.startswith("Error: Invalid arguments for sleep"))
+        self.assertEqual(self.registry.stats()["sleep"]["errors"], 1)
+
+    def test_unknown_tools_are_reported_to_the_model(self):
+        self.assertEqual(self.registry.dispatch("nap", "{}"), "Error: There is no tool called nap")
+        self.assertNotIn("nap", self.registry.stats())
+
+    def test_schemas_come_from_the_parameter_models(self):
+        schema = self.registry.schemas()[0]["function"]
+        self.assertEqual(schema["name"], "sleep")
+        self.assertIn("seconds", schema["parameters"]["properties"])
+
+    def test_stats_count_calls_and_latency_buckets(self):
+        with mock.patch("email_service.tools.registry.time.perf_counter", side_effect=[0, 0.03, 0, 0.2]):
+            self.registry.dispatch("sleep", "{}")
+            self.registry.dispatch("sleep", "{}")
+
+        stats = self.registry.stats()["sleep"]
+        self.assertEqual(stats["calls"], 2)
+        self.assertEqual(stats["histogram_ms"]["50"], 1)
+        self.assertEqual(stats["histogram_ms"]["250"], 1)
+        self.assertEqual(stats["p95_ms"], 200)
+
+
+class ToolStatsViewTests(TestCase):
+    def test_stats_require_staff_or_the_admin_token(self):
+        self.assertEqual(self.client.get("/tool-stats/").status_code, 403)
+
+        with mock.patch.dict("os.environ", {"ADMINGPT_ADMIN_TOKEN": "secret"}):
+            self.assertEqual(
+                self.client.get("/tool-stats/", HTTP_AUTHORIZATION="Bearer wrong").status_code, 403
+            )
+            response = self.client.get("/tool-stats/", HTTP_AUTHORIZATION="Bearer secret")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("tools", response.json())
+
+        staff = User.objects.create_user("admin", password="x", is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get("/tool-stats/").status_code, 200)
+
+
+class MemoryTokenBackend(BaseTokenBackend):
+    def load_token(self):
+        return self.token
+
+    def save_token(self):
+        return True
+
+    def check_token(self):
+        return self.token is not None
+
+
+class FakeGraph(BaseHTTPRequestHandler):
+    """
+    Local stand-in for the Microsoft Graph message and $batch endpoints.
+
+    Requests for a message id in throttle get that many 429 responses first.
+    """
+
+    protocol_version = "HTTP/1.1"
+    messages = {}
+    throttle = {}
+    batches = []
+
+    def log_message(self, *args):
+        pass
+
+    def message_response(self, url):
+        message_id = url.split("?")[0].rstrip("/").split("/")[-1]
+        if self.throttle.get(message_id):
+            self.throttle[message_id] -= 1
+            return 429, {"Retry-After": "1"}, {"error": {"code": "TooManyRequests", "message": "Throttled"}}
+        if message_id not in self.messages:
+            return 404, {}, {"error": {"code": "ErrorItemNotFound", "message": "Not found"}}
+        return 200, {}, self.messages[message_id]
+
+    def send_json(self, status, data, headers=None):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        status, headers, body = self.message_response(self.path)
+        self.send_json(status, body, headers)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if not self.path.endswith("/$batch"):
+            return self.send_json(404, {"error": {"message": "Not found"}})
+        self.batches.append([request["url"] for request in body["requests"]])
+        responses = []
+        # Answer out of order, like Graph may
+        for request in reversed(body["requests"]):
+            status, headers, item = self.message_response(request["url"])
+            responses.append({"id": request["id"], "status": status, "headers": headers, "body": item})
+        self.send_json(200, {"responses": responses})
+
+    @classmethod
+    def message(cls, message_id, subject):
+        cls.messages[message_id] = {
+            "id": message_id,
+            "subject": subject,
+            "body": {"contentType": "html", "content": f"<p>{subject} body</p>"},
+            "from": {"emailAddress": {"name": "Guest", "address": "guest@example.com"}},
+            "lastModifiedDateTime": "2024-03-04T10:00:00Z",
+            "toRecipients": [],
+            "ccRecipients": [],
+            "bccRecipients": [],
+        }
+
+
+class FakeGraphTestCase(SimpleTestCase):
+    """Runs a FakeGraph server, with a Graph account whose requests go to it."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGraph)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        FakeGraph.messages, FakeGraph.throttle, FakeGraph.batches = {}, {}, []
+        protocol = MSGraphProtocol()
+        protocol.service_url = f"http://127.0.0.1:{self.server.server_port}/v1.0/"
+        token_backend = MemoryTokenBackend()
+        token_backend.token = Token(
+            {"access_token": "token", "token_type": "Bearer", "expires_at": time_module.time() + 3600}
+        )
+        self.account = GraphAccount(("client", "secret"), protocol=protocol, token_backend=token_backend)
+        for patcher in (
+            # The fake server is plain http
+            mock.patch.dict("os.environ", {"OAUTHLIB_INSECURE_TRANSPORT": "1"}),
+            mock.patch("email_service.tools.o365_toolkit.authenticate", return_value=self.account),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class SearchEmailBatchTests(FakeGraphTestCase):
+    def test_emails_come_back_in_order_across_batches(self):
+        message_ids = [f"m{i}" for i in range(25)]
+        for message_id in message_ids[:-1]:
+            FakeGraph.message(message_id, "Subject " + message_id)
+
+        emails = o365search_email_batch(message_ids)
+
+        self.assertEqual([len(batch) for batch in FakeGraph.batches], [20, 5])
+        self.assertEqual([email["message_id"] for email in emails], message_ids)
+        self.assertEqual(emails[3]["subject"], "Subject m3")
+        self.assertEqual(emails[3]["body"], "Subject m3 body")
+        self.assertEqual(emails[-1]["error"], "Not found")
+
+    def test_throttled_requests_are_retried_after_their_retry_after(self):
+        for message_id in ("m1", "m2", "m3"):
+            FakeGraph.message(message_id, "Subject " + message_id)
+        FakeGraph.throttle["m2"] = 2
+
+        with mock.patch("email_service.tools.o365_toolkit.time.sleep") as sleep:
+            emails = o365search_email_batch(["m1", "m2", "m3"])
+
+        self.assertEqual([email["subject"] for email in emails], ["Subject m1", "Subject m2", "Subject m3"])
+        # Only the throttled request is sent again
+        self.assertEqual(FakeGraph.batches[1:], [["/me/messages/m2"], ["/me/messages/m2"]])
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [1.0, 1.0])
+
+    def test_requests_throttled_beyond_the_retries_report_an_error(self):
+        FakeGraph.message("m1", "Subject m1")
+        FakeGraph.throttle["m1"] = 100
+
+        with mock.patch("email_service.tools.o365_toolkit.time.sleep"):
+            emails = o365search_email_batch(["m1"])
+
+        self.assertEqual(emails, [{"message_id": "m1", "error": "Throttled"}])
+        self.assertEqual(len(FakeGraph.batches), MAX_THROTTLE_RETRIES + 1)
+
+
+
+class AsyncGraphClientTests(FakeGraphTestCase):
+    def test_messages_are_fetched_and_throttled_requests_retried(self):
+        from .tools.async_graph import AsyncGraphClient
+
+        FakeGraph.message("m1", "Subject m1")
+        FakeGraph.throttle["m1"] = 1
+
+        with mock.patch("email_service.tools.async_graph.asyncio.sleep") as sleep:
+            email = asyncio.run(AsyncGraphClient(self.account, "email").get_message("m1"))
+
+        self.assertEqual((email["subject"], email["body"]), ("Subject m1", "Subject m1 body"))
+        # The event loop also sleeps, so only look for the Retry-After wait
+        self.assertIn(mock.call(1.0), sleep.call_args_list)
+
+
+class BackgroundWorkerTests(SimpleTestCase):
+    def test_one_worker_runs_at_a_time(self):
+        started = []
+
+        async def awork(concurrency, once=False):
+            started.append(concurrency)
+            await asyncio.sleep(0)
+
+        async def poll():
+            first = views.start_background_worker()
+            # Overlapping polls reuse the running worker
+            self.assertIs(views.start_background_worker(), first)
+            await first
+            # Once it finished, the next poll starts a new one
+            await views.start_background_worker()
+
+        with mock.patch("email_service.views.awork", awork):
+            asyncio.run(poll())
+
+        self.assertEqual(started, [views.ASYNC_CONCURRENCY, views.ASYNC_CONCURRENCY])
+
+class FakeDeltaAccount:
+    """Account whose Graph GETs answer delta queries from a map of url to pages."""
+
+    base_url = "https://graph.microsoft.com/v1.0/me"
+
+    def __init__(self):
+        self.pages = {}
+        self.requests = []
+        folder = SimpleNamespace(build_url=lambda path: self.base_url + path)
+        self.mailbox = lambda: folder
+        self.schedule = lambda: folder
+        self.con = SimpleNamespace(get=self.get)
+
+    def get(self, url, params=None, headers=None):
+        self.requests.append(url.split("?")[0].replace(self.base_url, ""))
+        page = self.pages[url.split("?")[0]]
+        if isinstance(page, Exception):
+            raise page
+        return SimpleNamespace(json=lambda: page)
+
+    def delta(self, path, link, changed=()):
+        """Answers the initial delta query of path, or a delta link, with link as the next one."""
+        url = path if path.startswith("https://") else self.base_url + path
+        self.pages[url] = {"value": [{"id": id} for id in changed], "@odata.deltaLink": link}
+
+
+class CacheTests(TestCase):
+    inbox_delta = "/mailFolders/inbox/messages/delta"
+    calendar_delta = "/calendarView/delta"
+    start = datetime(2024, 3, 4, tzinfo=timezone.utc)
+    end = datetime(2024, 3, 5, tzinfo=timezone.utc)
+
+    def setUp(self):
+        self.account = FakeDeltaAccount()
+        self.now = datetime(2024, 3, 4, 9, tzinfo=timezone.utc)
+        patcher = mock.patch("email_service.cache.timezone.now", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def later(self, **delta):
+        self.now += timedelta(**delta)
+
+    def initial_sync(self, account=None):
+        """Runs the worker's initial inbox sync, answered with https://delta/1."""
+        account = account or self.account
+        account.delta(self.inbox_delta, "https://delta/1")
+        self.assertTrue(cache.sync_messages(account, initial=True))
+        self.later(minutes=1)
+
+    def test_messages_are_read_from_graph_until_the_worker_syncs_the_inbox(self):
+        fetch = mock.Mock(side_effect=[{"subject": "v1"}, {"subject": "v2"}, {"subject": "v3"}])
+
+        self.assertEqual(cache.get_message(self.account, "m1", fetch), {"subject": "v1"})
+        self.assertEqual(cache.get_message(self.account, "m1", fetch), {"subject": "v2"})
+        # Tool calls never run the initial sync
+        self.assertEqual(self.account.requests, [])
+        self.assertFalse(CachedMessage.objects.exists())
+
+        self.initial_sync()
+        self.account.delta("https://delta/1", "https://delta/2")
+        self.assertEqual(cache.get_message(self.account, "m1", fetch), {"subject": "v3"})
+        self.assertEqual(cache.get_message(self.account, "m1", fetch), {"subject": "v3"})
+
+    def test_messages_are_served_until_the_delta_query_reports_a_change(self):
+        self.initial_sync()
+        self.account.delta("https://delta/1", "https://delta/1")
+        fetch = mock.Mock(side_effect=[{"subject": "v1"}, {"subject": "v2"}])
+
+        self.assertEqual(cache.get_message(self.account, "m1", fetch), {"subject": "v1"})
+        self.later(seconds=1)
+        self.assertEqual(cache.get_message(self.account, "m1", fetch), {"subject": "v1"})
+        self.later(minutes=1)
+        self.account.delta("https://delta/1", "https://delta/2", changed=["m1"])
+        self.assertEqual(cache.get_message(self.account, "m1", fetch), {"subject": "v2"})
+
+        self.assertEqual(fetch.call_count, 2)
+        # One delta query per DELTA_SYNC_INTERVAL
+        self.assertEqual(
+            self.account.requests, [self.inbox_delta, "https://delta/1", "https://delta/1"]
+        )
+
+    def test_expired_delta_links_leave_the_initial_sync_to_the_worker(self):
+        self.initial_sync()
+        fetch = mock.Mock(side_effect=[{"subject": "v1"}, {"subject": "v2"}])
+        self.account.delta("https://delta/1", "https://delta/1")
+        cache.get_message(self.account, "m1", fetch)
+
+        self.later(minutes=1)
+        self.account.pages["https://delta/1"] = HTTPError(response=SimpleNamespace(status_code=410))
+
+        self.assertEqual(cache.get_message(self.account, "m1", fetch), {"subject": "v2"})
+        self.assertEqual(self.account.requests[-1], "https://delta/1")
+        self.assertFalse(CachedMessage.objects.exists())
+        self.assertFalse(cache.sync_messages(self.account))
+
+    def test_concurrent_callers_do_not_all_run_the_sync(self):
+        self.assertIsNotNone(cache._claim_sync("messages:inbox", self.now))
+        self.assertIsNone(cache._claim_sync("messages:inbox", self.now))
+
+        self.later(minutes=1)
+        self.assertIsNotNone(cache._claim_sync("messages:inbox", self.now))
+        self.assertIsNone(cache._claim_sync("messages:inbox", self.now))
+
+    def test_only_missing_messages_are_fetched_and_errors_are_not_cached(self):
+        self.initial_sync()
+        self.account.delta("https://delta/1", "https://delta/1")
+        cache.get_message(self.account, "m1", lambda: {"subject": "m1"})
+        fetch_many = mock.Mock(return_value=[{"subject": "m2"}, {"message_id": "m3", "error": "Not found"}])
+
+        messages = cache.get_messages(self.account, ["m1", "m2", "m3"], fetch_many)
+
+        fetch_many.assert_called_once_with(["m2", "m3"])
+        self.assertEqual([m.get("subject") for m in messages], ["m1", "m2", None])
+        self.assertEqual(
+            sorted(CachedMessage.objects.values_list("message_id", flat=True)), ["m1", "m2"]
+        )
+
+    def test_tenants_only_see_and_reset_their_own_messages(self):
+        alex = Tenant.objects.create(slug="alex")
+        sam = Tenant.objects.create(slug="sam")
+        sam_account = FakeDeltaAccount()
+        with tenant_context(alex):
+            self.initial_sync()
+        with tenant_context(sam):
+            self.initial_sync(sam_account)
+        self.account.delta("https://delta/1", "https://delta/1")
+        sam_account.delta("https://delta/1", "https://delta/1")
+
+        with tenant_context(alex):
+            cache.get_message(self.account, "m1", lambda: {"subject": "alex"})
+            cache.get_message(self.account, "m2", lambda: {"subject": "alex"})
+        with tenant_context(sam), mock.patch.object(cache, "MAX_CACHED_MESSAGES", 1):
+            # Sam's initial sync and evictions leave Alex's messages alone
+            self.assertEqual(
+                cache.get_message(sam_account, "m1", lambda: {"subject": "sam"}), {"subject": "sam"}
+            )
+            self.later(seconds=1)
+            cache.get_message(sam_account, "m3", lambda: {"subject": "sam"})
+        with tenant_context(alex):
+            self.assertEqual(
+                cache.get_messages(self.account, ["m1", "m2"], mock.Mock()),
+                [{"subject": "alex"}, {"subject": "alex"}],
+            )
+
+        self.assertEqual(
+            sorted(CachedMessage.objects.values_list("tenant__slug", "message_id")),
+            [("alex", "m1"), ("alex", "m2"), ("sam", "m3")],
+        )
+
+    def test_event_windows_are_only_tracked_once_they_are_read_again(self):
+        fetch = mock.Mock(side_effect=[["v1"], ["v2"], ["v3"]])
+        get_events = lambda: cache.get_events(self.account, self.start, self.end, {}, fetch)
+
+        # A window read once costs no delta query
+        self.assertEqual(get_events(), ["v1"])
+        self.assertEqual(self.account.requests, [])
+
+        # Reading it again starts tracking its changes
+        self.later(minutes=1)
+        self.account.delta(self.calendar_delta, "https://delta/events/1")
+        self.assertEqual(get_events(), ["v2"])
+        self.assertEqual(self.account.requests, [self.calendar_delta])
+
+        # Then it's served as long as no event changed
+        self.later(minutes=1)
+        self.account.delta("https://delta/events/1", "https://delta/events/2")
+        self.assertEqual(get_events(), ["v2"])
+        self.later(minutes=1)
+        self.account.delta("https://delta/events/2", "https://delta/events/3", changed=["e1"])
+        self.account.delta(self.calendar_delta, "https://delta/events/4")
+        self.assertEqual(get_events(), ["v3"])
+        self.assertEqual(fetch.call_count, 3)
+
+
+    def test_created_events_invalidate_the_windows_they_overlap(self):
+        fetch = mock.Mock(side_effect=[["v1"], ["other"], ["v2"]])
+        cache.get_events(self.account, self.start, self.end, {}, fetch)
+        next_day = (self.end, self.end + timedelta(days=1))
+        cache.get_events(self.account, *next_day, {}, fetch)
+
+        cache.invalidate_events(self.start + timedelta(hours=9), self.start + timedelta(hours=10))
+
+        self.assertEqual(cache.get_events(self.account, self.start, self.end, {}, fetch), ["v2"])
+        self.assertEqual(cache.get_events(self.account, *next_day, {}, fetch), ["other"])
+
+    def test_failed_event_searches_are_not_cached(self):
+        fetch = mock.Mock(side_effect=[{"error": "Invalid page_token"}, {"events": []}])
+        options = {"page_token": "bad"}
+
+        cache.get_events(self.account, self.start, self.end, options, fetch)
+
+        self.assertEqual(
+            cache.get_events(self.account, self.start, self.end, options, fetch), {"events": []}
+        )
+
+class GraphNotificationTests(TestCase):
+    def setUp(self):
+        self.subscription = GraphSubscription.objects.create(
+            subscription_id="sub-1",
+            resource="me/mailFolders('inbox')/messages",
+            notification_url="https://example.com/notifications/",
+            client_state="state-1",
+            expires_at=django_timezone.now() + timedelta(days=5),
+        )
+
+    def notify(self, *notifications):
+        return self.client.post(
+            "/notifications/", json.dumps({"value": list(notifications)}), content_type="application/json"
+        )
+
+    def created(self, message_id, client_state="state-1"):
+        return {
+            "subscriptionId": "sub-1",
+            "clientState": client_state,
+            "changeType": "created",
+            "resourceData": {"id": message_id},
+        }
+
+    def test_validation_token_is_echoed_back(self):
+        response = self.client.post("/notifications/?validationToken=Validation%3A+abc")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/plain")
+        self.assertEqual(response.content, b"Validation: abc")
+
+    def test_new_messages_are_queued_once(self):
+        response = self.notify(self.created("m1"), self.created("m1"), self.created("m2"))
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(
+            sorted(EmailJob.objects.values_list("message_id", flat=True)), ["m1", "m2"]
+        )
+
+    def test_notifications_with_another_client_state_are_ignored(self):
+        response = self.notify(
+            self.created("m1", client_state="forged"),
+            {**self.created("m2"), "subscriptionId": "unknown"},
+        )
+
+        self.assertEqual(response.status_code, 202)
+        self.assertFalse(EmailJob.objects.exists())
+
+
+class SubscriptionRenewalTests(TestCase):
+    def setUp(self):
+        self.con = mock.Mock()
+        self.con.post.return_value = SimpleNamespace(json=lambda: {"id": "sub-2"})
+        account = SimpleNamespace(
+            con=self.con, protocol=SimpleNamespace(service_url="https://graph.microsoft.com/v1.0/")
+        )
+        patcher = mock.patch("email_service.subscriptions.authenticate", return_value=account)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def subscription(self, expires_in):
+        return GraphSubscription.objects.create(
+            subscription_id="sub-1",
+            resource="me/mailFolders('inbox')/messages",
+            notification_url="https://example.com/notifications/",
+            client_state="state-1",
+            expires_at=django_timezone.now() + expires_in,
+        )
+
+    def test_subscriptions_expiring_soon_are_renewed(self):
+        self.subscription(timedelta(days=1))
+
+        renewed = subscriptions.ensure_subscription()
+
+        self.assertEqual(renewed.subscription_id, "sub-1")
+        self.assertEqual(self.con.patch.call_args.args[0], "https://graph.microsoft.com/v1.0/subscriptions/sub-1")
+        self.assertGreater(
+            GraphSubscription.objects.get().expires_at,
+            django_timezone.now() + subscriptions.SUBSCRIPTION_LIFETIME - timedelta(minutes=1),
+        )
+
+    def test_subscriptions_far_from_expiring_are_left_alone(self):
+        self.subscription(timedelta(days=5))
+
+        subscriptions.ensure_subscription()
+
+        self.con.patch.assert_not_called()
+        self.con.post.assert_not_called()
+
+    def test_subscriptions_graph_no_longer_has_are_recreated(self):
+        subscription = self.subscription(timedelta(days=1))
+        self.con.patch.side_effect = HTTPError(response=SimpleNamespace(status_code=404))
+
+        renewed = subscriptions.renew_subscription(subscription)
+
+        self.assertEqual(renewed.subscription_id, "sub-2")
+        self.assertEqual(self.con.post.call_args.kwargs["data"]["notificationUrl"], subscription.notification_url)
+        self.assertEqual(list(GraphSubscription.objects.values_list("subscription_id", flat=True)), ["sub-2"])
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        self.now = datetime(2024, 3, 4, 9, tzinfo=timezone.utc)
+        patcher = mock.patch("email_service.jobs.timezone.now", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def later(self, **delta):
+        self.now += timedelta(**delta)
+
+    def job(self, message_id="m1", **fields):
+        return EmailJob.objects.create(message_id=message_id, **{"available_at": self.now, **fields})
+
+    def test_failed_jobs_are_retried_with_backoff_until_max_attempts(self):
+        self.job()
+        delays = []
+
+        for attempt in range(1, jobs.MAX_ATTEMPTS + 1):
+            job = jobs.claim_job("worker")
+            self.assertEqual(job.attempts, attempt)
+            jobs._finish_job(job, error=ValueError("Graph is down"))
+
+            job.refresh_from_db()
+            if job.status == EmailJob.PENDING:
+                delays.append(job.available_at - self.now)
+                # Not claimable before its retry is due
+                self.assertIsNone(jobs.claim_job("worker"))
+                self.now = job.available_at
+
+        self.assertEqual(delays, [jobs.RETRY_DELAY, jobs.RETRY_DELAY * 2])
+        self.assertEqual((job.status, job.last_error), (EmailJob.FAILED, "Graph is down"))
+        self.assertIsNone(jobs.claim_job("worker"))
+
+    def test_jobs_of_unresponsive_workers_are_taken_over(self):
+        self.job()
+        stuck = jobs.claim_job("worker-1")
+
+        self.assertIsNone(jobs.claim_job("worker-2"))
+        self.later(seconds=jobs.VISIBILITY_TIMEOUT.total_seconds() + 1)
+        taken = jobs.claim_job("worker-2")
+
+        self.assertEqual((taken.pk, taken.locked_by, taken.attempts), (stuck.pk, "worker-2", 2))
+
+    def test_workers_do_not_finish_jobs_they_no_longer_own(self):
+        self.job()
+        stuck = jobs.claim_job("worker-1")
+        self.later(seconds=jobs.VISIBILITY_TIMEOUT.total_seconds() + 1)
+        jobs.claim_job("worker-2")
+
+        jobs._finish_job(stuck, result={"status": "replied"})
+
+        job = EmailJob.objects.get()
+        self.assertEqual((job.status, job.locked_by, job.result), (EmailJob.RUNNING, "worker-2", None))
+
+    def test_running_jobs_renew_their_lease_and_their_email_lease(self):
+        self.job()
+        job = jobs.claim_job("worker-1")
+        lease = django_timezone.now()
+        ProcessedEmail.objects.create(
+            message_id="m1",
+            status=ProcessedEmail.IN_PROGRESS,
+            claimed_by="worker-1",
+            lease_expires_at=lease,
+        )
+
+        # A job waiting for an OpenAI slot isn't taken over while it renews its lease
+        self.later(seconds=jobs.VISIBILITY_TIMEOUT.total_seconds() - 1)
+        self.assertTrue(jobs._renew_job(job))
+        self.later(seconds=2)
+        self.assertIsNone(jobs.claim_job("worker-2"))
+        self.assertGreater(ProcessedEmail.objects.get().lease_expires_at, lease)
+
+        # Once taken over, it no longer renews it
+        self.later(seconds=jobs.VISIBILITY_TIMEOUT.total_seconds() + 1)
+        jobs.claim_job("worker-2")
+        self.assertFalse(jobs._renew_job(job))
+
+    def test_jobs_renew_their_lease_while_they_run(self):
+        self.job()
+        job = jobs.claim_job("worker")
+        renewed = threading.Event()
+
+        def process_email(message_id, model, worker):
+            self.assertTrue(renewed.wait(5))
+            return {"status": "success"}
+
+        with mock.patch.object(jobs, "HEARTBEAT_INTERVAL", timedelta(milliseconds=1)), mock.patch(
+            "email_service.jobs._renew_job", side_effect=lambda job: renewed.set()
+        ) as renew_job, mock.patch("email_service.jobs.process_email", process_email):
+            self.assertEqual(jobs.run_job(job), {"status": "success"})
+            calls = renew_job.call_count
+
+        # The heartbeat stops with the job
+        time_module.sleep(0.01)
+        self.assertEqual(renew_job.call_count, calls)
+
+    def test_async_jobs_renew_their_lease_while_they_run(self):
+        self.job()
+        job = jobs.claim_job("worker")
+        renewed = threading.Event()
+
+        async def aprocess_email(message_id, model, worker):
+            while not renewed.is_set():
+                await asyncio.sleep(0.001)
+            return {"status": "success"}
+
+        with mock.patch.object(jobs, "HEARTBEAT_INTERVAL", timedelta(milliseconds=1)), mock.patch(
+            "email_service.jobs._renew_job", side_effect=lambda job: renewed.set()
+        ), mock.patch("email_service.jobs.aprocess_email", aprocess_email), mock.patch(
+            "email_service.jobs._finish_job"
+        ):
+            self.assertEqual(asyncio.run(jobs.arun_job(job)), {"status": "success"})
+
+    def test_tenants_are_served_by_running_jobs_then_oldest_job(self):
+        alex = Tenant.objects.create(slug="alex", max_concurrency=5)
+        sam = Tenant.objects.create(slug="sam", max_concurrency=5)
+        paused = Tenant.objects.create(slug="paused", is_active=False)
+        self.job("sam-1", tenant=sam, available_at=self.now - timedelta(minutes=5))
+        self.job("alex-1", tenant=alex, available_at=self.now - timedelta(minutes=10))
+        self.job("alex-2", tenant=alex, available_at=self.now - timedelta(minutes=9))
+        self.job("default-1", available_at=self.now - timedelta(minutes=1))
+        self.job("paused-1", tenant=paused, available_at=self.now - timedelta(minutes=20))
+
+        claimed = [jobs.claim_job("worker") for _ in range(5)]
+
+        # Once a tenant runs a job, tenants running none go first
+        self.assertEqual(
+            [job and job.message_id for job in claimed],
+            ["alex-1", "sam-1", "default-1", "alex-2", None],
+        )
+
+    def test_tenants_out_of_graph_budget_are_skipped(self):
+        tenant = Tenant.objects.create(slug="alex")
+        self.job(tenant=tenant)
+
+        with mock.patch("email_service.jobs.graph_budget") as graph_budget:
+            graph_budget.return_value.available.return_value = 0
+            self.assertIsNone(jobs.claim_job("worker"))
+        self.assertEqual(jobs.claim_job("worker").message_id, "m1")
+
+
+class MaintenanceTests(TestCase):
+    def test_workers_run_the_initial_inbox_sync_of_every_tenant(self):
+        alex = Tenant.objects.create(slug="alex")
+        Tenant.objects.create(slug="paused", is_active=False)
+        synced = []
+
+        with mock.patch("email_service.jobs.authenticate", return_value="account"), mock.patch(
+            "email_service.jobs.sync_messages",
+            side_effect=lambda account, initial: synced.append((current_tenant(), initial)),
+        ), mock.patch("email_service.subscriptions.maintain_subscription"):
+            jobs.run_maintenance()
+
+        self.assertEqual(synced, [(alex, True)])
+
+    def test_workers_renew_the_subscriptions_of_quiet_inboxes(self):
+        alex = Tenant.objects.create(slug="alex")
+        sam = Tenant.objects.create(slug="sam")
+        now = django_timezone.now()
+        for tenant, expires_at in ((alex, now + timedelta(days=1)), (sam, now + timedelta(days=5))):
+            GraphSubscription.objects.create(
+                tenant=tenant,
+                subscription_id="sub-" + tenant.slug,
+                resource=subscriptions.SUBSCRIPTION_RESOURCE,
+                notification_url="https://example.com/notifications/",
+                client_state="state",
+                expires_at=expires_at,
+            )
+        renewed = []
+
+        with mock.patch("email_service.jobs.authenticate", return_value=None), mock.patch(
+            "email_service.subscriptions.renew_subscription",
+            side_effect=lambda subscription: renewed.append(subscription.subscription_id),
+        ):
+            jobs.run_maintenance()
+
+        # Only the subscription about to expire is renewed
+        self.assertEqual(renewed, ["sub-alex"])
+
+    def test_deployments_without_notifications_are_not_subscribed(self):
+        with mock.patch.object(subscriptions, "NOTIFICATION_URL", None), mock.patch(
+            "email_service.subscriptions.create_subscription"
+        ) as create_subscription:
+            self.assertIsNone(subscriptions.maintain_subscription())
+        create_subscription.assert_not_called()
+
+    def test_failing_tenants_do_not_stop_the_others(self):
+        alex = Tenant.objects.create(slug="alex")
+        sam = Tenant.objects.create(slug="sam")
+        synced = []
+
+        def sync_messages(account, initial):
+            if current_tenant() == alex:
+                raise HTTPError("Graph is down")
+            synced.append(current_tenant())
+
+        with mock.patch("email_service.jobs.authenticate", return_value="account"), mock.patch(
+            "email_service.jobs.sync_messages", side_effect=sync_messages
+        ), mock.patch("email_service.subscriptions.maintain_subscription"):
+            jobs.run_maintenance()
+
+        self.assertEqual(synced, [sam])
+
+class EnqueueTests(TestCase):
+    def test_pending_emails_are_queued_once(self):
+        ProcessedEmail.objects.create(message_id="answered", status=ProcessedEmail.DELETED)
+
+        with mock.patch("email_service.jobs.find_prompt_emails", return_value=["m2", "m1", "answered"]):
+            first = jobs.enqueue_pending_emails()
+            second = jobs.enqueue_pending_emails()
+
+        # Oldest first, and nothing twice
+        self.assertEqual((first, second), (["m1", "m2"], []))
+        self.assertEqual(
+            sorted(EmailJob.objects.values_list("message_id", flat=True)), ["m1", "m2"]
+        )
+
+    def test_notified_emails_are_queued_once(self):
+        job, created = jobs.enqueue_email("m1")
+        again, created_again = jobs.enqueue_email("m1")
+
+        self.assertEqual((created, created_again, again.pk), (True, False, job.pk))
+        self.assertEqual(EmailJob.objects.count(), 1)
+
+
+class EmailLeaseTests(TestCase):
+    def expire(self, message_id):
+        ProcessedEmail.objects.filter(message_id=message_id).update(
+            lease_expires_at=django_timezone.now() - timedelta(seconds=1)
+        )
+
+    def test_first_claim_inserts_the_record(self):
+        record = processing.claim_email("m1", "worker-1")
+
+        self.assertEqual((record.status, record.claimed_by), (ProcessedEmail.CLAIMED, "worker-1"))
+        self.assertIsNone(processing.claim_email("m1", "worker-2"))
+
+    def test_expired_leases_are_reclaimed(self):
+        processing.claim_email("m1", "worker-1")
+        self.expire("m1")
+
+        record = processing.claim_email("m1", "worker-2")
+
+        self.assertEqual((record.status, record.claimed_by), (ProcessedEmail.CLAIMED, "worker-2"))
+        self.assertGreater(record.lease_expires_at, django_timezone.now())
+
+    def test_processed_emails_are_not_reclaimed(self):
+        for status in (ProcessedEmail.DELETED, ProcessedEmail.SKIPPED):
+            ProcessedEmail.objects.create(
+                message_id=status, status=status, lease_expires_at=django_timezone.now() - timedelta(days=1)
+            )
+            self.assertIsNone(processing.claim_email(status, "worker"))
+
+    def test_stale_transitions_raise_lease_lost(self):
+        stale = processing.claim_email("m1", "worker-1")
+        self.expire("m1")
+        processing.claim_email("m1", "worker-2")
+
+        with self.assertRaises(processing.LeaseLost):
+            processing._transition(stale, ProcessedEmail.IN_PROGRESS)
+        self.assertEqual(ProcessedEmail.objects.get().claimed_by, "worker-2")
+
+    def test_reclaimed_replied_emails_are_deleted_without_replying_again(self):
+        ProcessedEmail.objects.create(
+            message_id="m1",
+            status=ProcessedEmail.REPLIED,
+            claimed_by="crashed-worker",
+            lease_expires_at=django_timezone.now() - timedelta(seconds=1),
+        )
+        email = {"from": "Ana <ana@example.com>", "to": ["Ana <ana@example.com>"], "body": "Hi Monica, hello"}
+
+        with mock.patch("email_service.processing.o365search_email", return_value=email), \
+                mock.patch("email_service.processing.get_backend") as get_backend, \
+                mock.patch("email_service.processing.o365reply_message") as reply, \
+                mock.patch("email_service.processing.o365delete_message") as delete:
+            result = processing.process_email("m1", client_email="ana@example.com", worker="worker-2")
+
+        self.assertEqual(result, {"status": "success", "reply": "Reply already sent."})
+        get_backend.assert_not_called()
+        reply.assert_not_called()
+        delete.assert_called_once_with("m1", interface="email")
+        self.assertEqual(ProcessedEmail.objects.get().status, ProcessedEmail.DELETED)
@@ -0,0 +1,155 @@
+import asyncio, weakref
+from asgiref.sync import sync_to_async
+# The SDK's client, so Graph and OpenAI requests share one HTTP library
+from openai import DefaultAsyncHttpxClient
+from .utils import account_pool, authenticate
+from .throttling import (
+    THROTTLED_STATUSES,
+    async_mailbox_semaphore,
+    backoff_delay,
+    mailbox_of,
+    reserve,
+    should_retry,
+    throttle_stats,
+)
+from .o365_toolkit import MESSAGE_FULL_FIELDS, _full_message_output
+
+"""Timeout, in seconds, of a single Microsoft Graph request."""
+GRAPH_TIMEOUT_SECONDS = 30
+
+# HTTP clients can't be shared across event loops, so keep one per loop
+_http_clients = weakref.WeakKeyDictionary()
+
+
+def _http_client():
+    """Returns the shared HTTP client of the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _http_clients.get(loop)
+    if client is None:
+        client = DefaultAsyncHttpxClient(timeout=GRAPH_TIMEOUT_SECONDS)
+        _http_clients[loop] = client
+    return client
+
+
+class AsyncGraphClient:
+    """
+    Microsoft Graph client for the asyncio execution path.
+
+    Requests go over the openai SDK's HTTP client with the access token of the
+    pooled O365 account, so the OAuth flow, token storage and refresh stay with
+    O365. Responses are turned into O365 objects to produce the same output as
+    the toolkit functions.
+    """
+
+    def __init__(self, account, interface="cli"):
+        self.account = account
+        self.interface = interface
+        self.mailbox = account.mailbox()
+
+    @classmethod
+    async def create(cls, interface="cli"):
+        """Creates a client for the authenticated account of an interface."""
+        account = await sync_to_async(authenticate)(interface)
+        return cls(account, interface)
+
+    async def request(self, method, path, **kwargs):
+        """
+        Sends a request to a path relative to the mailbox, e.g. /messages/{id}.
+
+        Requests are paced and throttled responses retried like the sync toolkit's,
+        see ThrottlingAdapter.
+
+        Raises:
+        HTTPStatusError: Of the SDK's HTTP library, if Graph returns an error status.
+        """
+        url = self.mailbox.build_url(path)
+        mailbox = mailbox_of(url, getattr(self.account.con, "mailbox_key", None) or "me")
+        refreshed = False
+        attempt = 0
+
+        while True:
+            # Tenant accounts share their Graph budget with the sync toolkit
+            budget = getattr(self.account.con, "budget", None)
+            delay = max(reserve(mailbox), budget.reserve() if budget is not None else 0.0)
+            if delay:
+                throttle_stats.record(limiter_wait_seconds=delay)
+                await asyncio.sleep(delay)
+
+            token = self.account.con.token_backend.token
+            async with async_mailbox_semaphore(mailbox):
+                response = await _http_client().request(
+                    method,
+                    url,
+                    headers={"Authorization": "Bearer " + token["access_token"]},
+                    **kwargs,
+                )
+            throttle_stats.record(requests=1)
+
+            if response.status_code == 401 and not refreshed:
+                # The token expired during a long run, or was replaced by another
+                # process, so authenticate refreshes or reloads it
+                account_pool.recheck(self.interface)
+                self.account = await sync_to_async(authenticate)(self.interface)
+                refreshed = True
+                continue
+
+            if response.status_code in THROTTLED_STATUSES:
+                throttle_stats.record(throttled=1)
+                if should_retry(method, response.status_code, attempt):
+                    delay = backoff_delay(attempt, response.headers.get("Retry-After"))
+                    throttle_stats.record(retries=1, backoff_seconds=delay)
+                    await asyncio.sleep(delay)
+                    attempt += 1
+                    continue
+                throttle_stats.record(exhausted=1)
+
+            response.raise_for_status()
+            return response
+
+    async def get_message(self, message_id):
+        """Async version of o365search_email, without the local cache."""
+        response = await self.request(
+            "GET",
+            self.mailbox._endpoints.get("message").format(id=message_id),
+            params={
+                "$select": ",".join(
+                    self.account.protocol.convert_case(field) for field in MESSAGE_FULL_FIELDS
+                )
+            },
+        )
+        message = self.mailbox.message_constructor(
+            parent=self.mailbox, **{self.mailbox._cloud_data_key: response.json()}
+        )
+        return _full_message_output(message)
+
+    async def reply_message(self, message_id, body, reply_to_sender=False):
+        """Async version of o365reply_message, always sending the reply."""
+        response = await self.request(
+            "POST", self.mailbox._endpoints.get("message").format(id=message_id) + "/createReply"
+        )
+        reply_message = self.mailbox.message_constructor(
+            parent=self.mailbox, **{self.mailbox._cloud_data_key: response.json()}
+        )
+
+        # Assign message body value, keeping the quoted original like O365 does
+        reply_message.body = body
+        # Override 'to' field to the sender if necessary
+        if reply_to_sender:
+            reply_message.to.add(reply_message.sender)
+
+        draft_url = self.mailbox._endpoints.get("message").format(id=reply_message.object_id)
+        await self.request(
+            "PATCH",
+            draft_url,
+            json=reply_message.to_api_data(restrict_keys=reply_message._track_changes),
+        )
+        await self.request("POST", draft_url + "/send")
+
+        return "Message sent: " + str(reply_message)
+
+    async def delete_message(self, message_id):
+        """Async version of o365delete_message."""
+        await self.request(
+            "DELETE", self.mailbox._endpoints.get("message").format(id=message_id)
+        )
+        return f"Message with ID {message_id} has been deleted."
@@ -0,0 +1,195 @@
+import re
+from html.parser import HTMLParser
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+"""Parser used by extract_text: lxml when it's installed, else the standard library's."""
+HTML_BACKEND = "lxml" if etree is not None else "html.parser"
+"""Size in characters of the chunks fed to the parser, early termination is checked in between."""
+FEED_CHUNK_SIZE = 1024
+"""Elements whose text isn't part of the body."""
+SKIPPED_TAGS = ("script", "style", "template")
+
+"""Element ids and classes that start the quoted history of Outlook, Gmail, Yahoo and Thunderbird."""
+QUOTE_IDS = ("divRplyFwdMsg",)
+QUOTE_CLASSES = ("gmail_quote", "yahoo_quoted", "moz-cite-prefix")
+"""Number of characters of a quote's header searched for forwarding markers."""
+QUOTE_HEADER_CHARS = 1000
+"""Markers of forwarded content, which is kept even when quotes are stripped."""
+FORWARD_PATTERN = re.compile(
+    r"forwarded message|begin forwarded message|subject:\s*(fw|fwd):", re.IGNORECASE
+)
+
+
+def _is_quote(tag, attrs):
+    """Returns whether an element starts quoted reply history."""
+    if tag == "blockquote":
+        return attrs.get("type") == "cite"
+    if tag == "div":
+        classes = (attrs.get("class") or "").split()
+        return attrs.get("id") in QUOTE_IDS or any(c in QUOTE_CLASSES for c in classes)
+    return False
+
+
+class _TextBuilder:
+    """
+    Builds normalized body text from parser events.
+
+    Text is normalized as it arrives, the same way clean_body always did: line
+    breaks are removed and other runs of whitespace become one space. This keeps
+    the length of the output known, so parsing stops once the limit is reached.
+
+    The method names follow the lxml parser target interface.
+    """
+
+    def __init__(self, limit=None, strip_quotes=False):
+        self.limit = limit
+        self.strip_quotes = strip_quotes
+        self.done = False
+        self._parts = []
+        self._length = 0
+        self._space = False
+        self._skip = 0
+        # Raw text of a quote, until it's known whether it's a forward
+        self._quote = None
+        # Tag and nesting depth of the quote element, whose closing tag ends it
+        self._quote_tag = None
+        self._quote_depth = None
+
+    def start(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self._skip += 1
+        elif self._quote is not None:
+            if tag == self._quote_tag and self._quote_depth is not None:
+                self._quote_depth += 1
+        elif self.strip_quotes and _is_quote(tag, attrs):
+            self._quote = []
+            self._quote_tag = tag
+            # Outlook's reply header doesn't wrap the history, which runs to the end
+            self._quote_depth = None if attrs.get("id") in QUOTE_IDS else 1
+
+    def end(self, tag):
+        if tag in SKIPPED_TAGS and self._skip:
+            self._skip -= 1
+        elif self._quote is not None and tag == self._quote_tag and self._quote_depth is not None:
+            self._quote_depth -= 1
+            if self._quote_depth == 0:
+                # The quote ended without forwarded content, so drop it and keep
+                # the text after it, e.g. a bottom-posted reply
+                self._quote = None
+
+    def data(self, data):
+        if self._skip or self.done:
+            return
+
+        if self._quote is None:
+            self._append(data)
+            return
+
+        header = "".join(self._quote)
+        if len(header) >= QUOTE_HEADER_CHARS:
+            # Past the header without a forwarding marker, so the quote is dropped
+            return
+
+        self._quote.append(data)
+        header += data
+        if FORWARD_PATTERN.search(header):
+            # Forwarded emails are the content to act on, so keep all of it
+            self._quote = None
+            self.strip_quotes = False
+            self._append(header)
+        elif len(header) >= QUOTE_HEADER_CHARS and self._quote_depth is None:
+            # Reply history runs to the end of the body
+            self.done = True
+
+    def comment(self, text):
+        pass
+
+    def close(self):
+        return self.text()
+
+    def text(self):
+        text = "".join(self._parts)
+        return text if self.limit is None else text[: self.limit]
+
+    def _append(self, data):
+        text = "".join(data.splitlines())
+        if not text:
+            return
+        if text[0].isspace():
+            self._space = True
+
+        words = " ".join(text.split())
+        if words:
+            if self._space and self._length:
+                self._parts.append(" ")
+                self._length += 1
+            self._parts.append(words)
+            self._length += len(words)
+        # Words of consecutive text nodes join without a space
+        self._space = text[-1].isspace()
+
+        if self.limit is not None and self._length >= self.limit:
+            self.done = True
+
+
+class _HTMLParserAdapter(HTMLParser):
+    """Forwards the events of the standard library HTML parser to a _TextBuilder."""
+
+    def __init__(self, builder):
+        super().__init__(convert_charrefs=True)
+        self.builder = builder
+
+    def handle_starttag(self, tag, attrs):
+        self.builder.start(tag, dict(attrs))
+
+    def handle_endtag(self, tag):
+        self.builder.end(tag)
+
+    def handle_data(self, data):
+        self.builder.data(data)
+
+    def unknown_decl(self, data):
+        if data.startswith("CDATA["):
+            self.builder.data(data[len("CDATA[") :])
+
+
+def extract_text(body, limit=None, strip_quotes=False, backend=None):
+    """
+    Extracts the normalized text of an HTML or plain text body.
+
+    The body is parsed in chunks, so extraction stops early once limit characters
+    were produced, or the quoted history running to the end of the body starts.
+
+    Parameters:
+    body (str): The body of a message or event.
+    limit (int): Maximum number of characters to return (default is no limit).
+    strip_quotes (bool): Whether to drop quoted reply history, up to the end of the
+        quote element. Quotes that contain forwarded content are always kept.
+    backend (str): "lxml" or "html.parser" (default is HTML_BACKEND).
+
+    Returns:
+    str: The text, without line breaks and with runs of whitespace collapsed.
+    """
+    builder = _TextBuilder(limit, strip_quotes)
+    if "<" not in body and "&" not in body:
+        # Plain text bodies have no markup or entities to parse
+        builder.data(body)
+        return builder.text()
+
+    if (backend or HTML_BACKEND) == "lxml":
+        parser = etree.HTMLParser(target=builder)
+    else:
+        parser = _HTMLParserAdapter(builder)
+
+    for index in range(0, len(body), FEED_CHUNK_SIZE):
+        parser.feed(body[index : index + FEED_CHUNK_SIZE])
+        if builder.done:
+            return builder.text()
+
+    if body:
+        parser.close()
+    return builder.text()
@@ -0,0 +1,263 @@
+from datetime import datetime, time, timedelta, timezone
+from .utils import UTC_FORMAT
+
+"""Business hours per weekday (0 is Monday). Days without an entry have no business hours."""
+BUSINESS_HOURS = {weekday: (time(9), time(17)) for weekday in range(5)}
+"""Events with these showAs values don't block time."""
+FREE_SHOW_AS = ("free", "workingElsewhere")
+"""Number of events requested per calendarView page."""
+CALENDAR_VIEW_PAGE_SIZE = 500
+"""Maximum number of schedules in one getSchedule request."""
+GET_SCHEDULE_LIMIT = 20
+"""Length in minutes of each time slot in getSchedule availability views."""
+AVAILABILITY_VIEW_INTERVAL = 15
+"""Availability view codes that don't block time: free and working elsewhere."""
+FREE_AVAILABILITY_CODES = ("0", "4")
+
+WEEKDAY_NAMES = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+
+
+def describe_business_hours(business_hours=None):
+    """Describes business hours for the assistant, e.g. "(09:00:00 to 17:00:00, Monday to Friday)"."""
+    business_hours = BUSINESS_HOURS if business_hours is None else business_hours
+
+    # Group consecutive weekdays with the same hours
+    groups = []
+    for weekday in sorted(business_hours):
+        hours = business_hours[weekday]
+        if groups and groups[-1][1] == hours and groups[-1][0][-1] == weekday - 1:
+            groups[-1][0].append(weekday)
+        else:
+            groups.append(([weekday], hours))
+
+    parts = []
+    for weekdays, (start, end) in groups:
+        days = WEEKDAY_NAMES[weekdays[0]]
+        if len(weekdays) > 1:
+            days += " to " + WEEKDAY_NAMES[weekdays[-1]]
+        parts.append(f"{start.strftime('%H:%M:%S')} to {end.strftime('%H:%M:%S')}, {days}")
+    return "(" + "; ".join(parts) + ")"
+
+
+def merge_intervals(intervals):
+    """
+    Merges overlapping and touching intervals in one pass over the sorted intervals.
+
+    Parameters:
+    intervals (iterable): (start, end) datetime pairs, in any order.
+
+    Returns:
+    list: Disjoint (start, end) pairs sorted by start.
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+
+def free_slots(
+    busy,
+    start_datetime,
+    end_datetime,
+    tz,
+    business_hours=None,
+    min_duration=timedelta(0),
+):
+    """
+    Computes the free slots within business hours for every day of a window.
+
+    Busy intervals are merged, then walked once alongside the days of the window,
+    so the cost is dominated by sorting the busy intervals.
+
+    Parameters:
+    busy (iterable): (start, end) pairs of aware datetimes when the calendar is busy.
+    start_datetime (datetime): Aware start of the window.
+    end_datetime (datetime): Aware end of the window.
+    tz (tzinfo): Time zone of the business hours and day boundaries.
+    business_hours (dict): Maps weekdays (0 is Monday) to (start, end) times (default is BUSINESS_HOURS).
+    min_duration (timedelta): Free slots shorter than this are left out.
+
+    Returns:
+    list: (date, slots) pairs for each business day in the window, where slots is
+          a list of (start, end) datetimes in tz.
+    """
+    business_hours = BUSINESS_HOURS if business_hours is None else business_hours
+    merged = merge_intervals(busy)
+    index = 0
+
+    days = []
+    first_day = start_datetime.astimezone(tz).date()
+    last_day = end_datetime.astimezone(tz).date()
+    for offset in range((last_day - first_day).days + 1):
+        day = first_day + timedelta(days=offset)
+        hours = business_hours.get(day.weekday())
+        if hours is None:
+            continue
+
+        # Clip the day's business hours to the window
+        window_start = max(datetime.combine(day, hours[0], tzinfo=tz), start_datetime)
+        window_end = min(datetime.combine(day, hours[1], tzinfo=tz), end_datetime)
+        if window_start >= window_end:
+            continue
+
+        # Skip busy intervals that ended before this window, they can't overlap
+        # any later window either
+        while index < len(merged) and merged[index][1] <= window_start:
+            index += 1
+
+        slots = []
+        cursor = window_start
+        position = index
+        while position < len(merged) and merged[position][0] < window_end:
+            busy_start, busy_end = merged[position]
+            if busy_start > cursor:
+                slots.append((cursor, busy_start))
+            cursor = max(cursor, busy_end)
+            position += 1
+        if cursor < window_end:
+            slots.append((cursor, window_end))
+
+        days.append(
+            (
+                day,
+                [
+                    (slot_start.astimezone(tz), slot_end.astimezone(tz))
+                    for slot_start, slot_end in slots
+                    if slot_end - slot_start >= min_duration
+                ],
+            )
+        )
+
+    return days
+
+
+def _parse_graph_datetime(value):
+    """Parses a Graph dateTimeTimeZone requested in UTC."""
+    # Graph returns seven fractional digits, which older Pythons don't parse
+    return datetime.fromisoformat(value["dateTime"][:26]).replace(tzinfo=timezone.utc)
+
+
+def fetch_busy_intervals(account, start_datetime, end_datetime):
+    """
+    Lists the busy intervals of the default calendar with one paged calendarView query.
+
+    Recurring events are expanded by calendarView, and events that overlap the
+    window boundaries are included. Only the fields needed are requested.
+
+    Returns:
+    list: [start, end] pairs of ISO 8601 strings in UTC.
+    """
+    url = account.schedule().build_url("/calendar/calendarView")
+    params = {
+        "startDateTime": start_datetime.astimezone(timezone.utc).isoformat(),
+        "endDateTime": end_datetime.astimezone(timezone.utc).isoformat(),
+        "$select": "start,end,showAs,isCancelled",
+    }
+    headers = {
+        "Prefer": f'outlook.timezone="UTC", odata.maxpagesize={CALENDAR_VIEW_PAGE_SIZE}'
+    }
+
+    busy = []
+    while url:
+        data = account.con.get(url, params=params, headers=headers).json()
+        for event in data.get("value", []):
+            if event.get("isCancelled") or event.get("showAs") in FREE_SHOW_AS:
+                continue
+            busy.append(
+                [
+                    _parse_graph_datetime(event["start"]).isoformat(),
+                    _parse_graph_datetime(event["end"]).isoformat(),
+                ]
+            )
+
+        # The next link already includes the query parameters
+        url = data.get("@odata.nextLink")
+        params = None
+
+    return busy
+
+
+def _availability_view_busy(availability_view, start_datetime, interval):
+    """Turns a getSchedule availability view string into busy intervals."""
+    busy = []
+    for index, code in enumerate(availability_view):
+        if code in FREE_AVAILABILITY_CODES:
+            continue
+        slot_start = start_datetime + index * interval
+        if busy and busy[-1][1] == slot_start:
+            busy[-1][1] = slot_start + interval
+        else:
+            busy.append([slot_start, slot_start + interval])
+    return [(busy_start, busy_end) for busy_start, busy_end in busy]
+
+
+def fetch_schedules(account, schedules, start_datetime, end_datetime):
+    """
+    Retrieves the busy intervals of several users with Graph getSchedule requests.
+
+    getSchedule returns one compact availability view string per user, so many
+    calendars are checked with one request instead of listing their events.
+
+    Parameters:
+    schedules (list): Email addresses of the users, groups or resources.
+
+    Returns:
+    tuple: A dict mapping each schedule with availability to its busy
+           (start, end) intervals, and a dict mapping the others to an error message.
+    """
+    url = account.schedule().build_url("/calendar/getSchedule")
+    start_utc = start_datetime.astimezone(timezone.utc)
+    interval = timedelta(minutes=AVAILABILITY_VIEW_INTERVAL)
+
+    busy, errors = {}, {}
+    for index in range(0, len(schedules), GET_SCHEDULE_LIMIT):
+        response = account.con.post(
+            url,
+            data={
+                "schedules": schedules[index : index + GET_SCHEDULE_LIMIT],
+                "startTime": {
+                    "dateTime": start_utc.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "timeZone": "UTC",
+                },
+                "endTime": {
+                    "dateTime": end_datetime.astimezone(timezone.utc).strftime(
+                        "%Y-%m-%dT%H:%M:%S"
+                    ),
+                    "timeZone": "UTC",
+                },
+                "availabilityViewInterval": AVAILABILITY_VIEW_INTERVAL,
+            },
+        )
+        for schedule in response.json().get("value", []):
+            if "error" in schedule or "availabilityView" not in schedule:
+                errors[schedule["scheduleId"]] = schedule.get("error", {}).get(
+                    "message", "No availability information."
+                )
+            else:
+                busy[schedule["scheduleId"]] = _availability_view_busy(
+                    schedule["availabilityView"], start_utc, interval
+                )
+
+    return busy, errors
+
+
+def format_free_slots(days):
+    """Formats the output of free_slots for the assistant."""
+    return [
+        {
+            "date": day.isoformat(),
+            "weekday": WEEKDAY_NAMES[day.weekday()],
+            "free_slots": [
+                {
+                    "start_datetime": start.strftime(UTC_FORMAT),
+                    "end_datetime": end.strftime(UTC_FORMAT),
+                }
+                for start, end in slots
+            ],
+        }
+        for day, slots in days
+    ]
@@ -1,9 +1,51 @@
-import json, openai
+import json, time
 from .utils import authenticate, clean_body, UTC_FORMAT
-from datetime import datetime
+from .registry import ToolRegistry
+from .throttling import THROTTLED_STATUSES, backoff_delay, should_retry, throttle_stats
+from .freebusy import fetch_busy_intervals, fetch_schedules, free_slots, format_free_slots
+from .pagination import iter_pages, collect, decode_page_token
+from .profile import get_profile, profile_business_hours
+from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 from pydantic import BaseModel, Field
 from typing import List
+from O365.calendar import Event
+
+"""Maximum number of requests in one Microsoft Graph JSON batch."""
+GRAPH_BATCH_LIMIT = 20
+"""Maximum number of items requested per page by the search functions."""
+SEARCH_PAGE_SIZE = 25
+
+"""Fields requested with $select by the search functions."""
+MESSAGE_PREVIEW_FIELDS = (
+    "from",
+    "subject",
+    "body_preview",
+    "last_modified_date_time",
+    "to_recipients",
+    "cc_recipients",
+    "bcc_recipients",
+)
+MESSAGE_FULL_FIELDS = MESSAGE_PREVIEW_FIELDS[:2] + ("body",) + MESSAGE_PREVIEW_FIELDS[3:]
+EVENT_PREVIEW_FIELDS = (
+    "organizer",
+    "subject",
+    "body_preview",
+    "start",
+    "end",
+    "is_all_day",
+    "last_modified_date_time",
+)
+EVENT_FULL_FIELDS = EVENT_PREVIEW_FIELDS[:2] + ("body",) + EVENT_PREVIEW_FIELDS[3:]
+
+
+class PreviewEvent(Event):
+    """Event that also keeps the plain text body preview returned by Graph."""
+
+    def __init__(self, *, parent=None, con=None, **kwargs):
+        super().__init__(parent=parent, con=con, **kwargs)
+        cloud_data = kwargs.get(self._cloud_data_key, {})
+        self.body_preview = cloud_data.get(self._cc("bodyPreview"), "")
 
 toolkit_prompt = """
 1. If you need to extract times from an email or message follow these steps:
@@ -15,8 +57,9 @@ toolkit_prompt = """
         1.2.4 Only consider specific times proposed by the most recent email sender when extracting time ranges.
 2. If I ask you whether I am free at the times proposed by me or in an email:
     2.1 Extract the times by following all the steps listed under section 1, including any substeps.
-    2.2 Once you have the start and end datetimes, call the 'o365find_free_time_slots' functions once for each set of proposed times to find the times that are free on my calendar.
+    2.2 Once you have the start and end datetimes, call the 'o365find_free_time_slots' function once with the earliest start and latest end datetimes, and the meeting length as 'min_duration_minutes', to find the times that are free on my calendar. Only keep the free slots that fall within the proposed times.
     2.3 Only return the business hours where I am free.
+    2.4 If I ask when I and other people are all free, call the 'o365find_common_free_time_slots' function once with all the other attendees' email addresses instead of the 'o365find_free_time_slots' function.
 3. If I ask you to retrieve or perform a task on someone's most recent email:
     2.1 Use the 'o365search_emails' funtion to find the 5 most recent emails from the person, and extract the email's 'message_id'.
     2.2 Use the 'o365search_email' function with the correct 'message_id' to extract the email's full content.
@@ -30,7 +73,7 @@ toolkit_prompt = """
     5.3 If I am free at the extracted times:
         5.3.1 Create an event at the earliest proposed time by following all the steps listed under section 4, including any substeps.
     5.4 If I am not free at the extracted times:
-        5.4.1 Return the times I am free during business hours on two consecutive business days starting on the same day as the earliest proposed time by following all the steps listed under section 2, including any substeps.
+        5.4.1 Return the times I am free during business hours on two consecutive business days starting on the same day as the earliest proposed time, using a single 'o365find_free_time_slots' call covering both days.
 6. If I ask you to "reply to the email below", which I am including in my email to you:
     6.1. **Never reply to my email** containing the request or forward.  
     6.2. **Always locate and prioritize the forwarded email content** first by identifying lines such as "Forwarded message" or "From" and checking content immediately following those markers.
@@ -46,10 +89,12 @@ toolkit_prompt = """
         7.2.1. Search Email Inbox
             7.2.1.1. Use o365search_emails with keywords, sender, or subject.
                 - Retrieve as many results as you are able to process at a time by setting the max_results in the o365search_emails function.
+                - If the output includes a 'next_page_token', call o365search_emails again with the same parameters and that 'page_token' to get more results.
         7.2.2. Search Calendar Events
             7.2.2.1. If the information sought could be in calendar events (e.g., searching for a meeting, event details, or references to dates/times), use o365search_events.
                 - Provide a reasonable start_datetime and end_datetime in ISO 8601 format that aligns with the user's request or your inferred time range.
                 - Set an appropriate max_results and truncate as needed.
+                - If the output includes a 'next_page_token', call o365search_events again with the same parameters and that 'page_token' to get more results.
         7.2.3. If No Results Found
             7.2.3.1. Broaden your search by adjusting keywords (synonyms, partial matches).
             7.2.3.2. Expand the time frame, checking older emails or events further in the past.
@@ -57,7 +102,7 @@ toolkit_prompt = """
             7.2.3.4. Look for indirect mentions (e.g., references in CC/BCC or tentatively scheduled calendar events).
         7.2.4. Keep refining until you find relevant results or exhaust reasonable variations.
     7.3. Extract and Analyze Key Details
-        7.3.1. Use o365search_email with message_id to retrieve full email content (for email searches).
+        7.3.1. Use o365search_email_batch with all the relevant message_ids to retrieve their full email content in one call (for email searches).
         7.3.2. For calendar searches, review the returned event details (time, subject, attendees).
         7.3.3. If searching for a person, scan headers, signatures, mentions, or attendees.
     7.4. Apply Advanced Searching if Needed
@@ -106,6 +151,11 @@ class O365SearchEmailsParameters(BaseModel):
         ...,
         description="The maximum number of results to return. The default value for this parameter is 10.",
     )
+    page_token: str = Field(
+        ...,
+        description="The 'next_page_token' returned by a previous call with the same"
+        " parameters, to get the next page of results. Use an empty string for the first page.",
+    )
 
 
 o365search_email_description = (
@@ -126,6 +176,22 @@ class O365SearchEmailParameters(BaseModel):
     )
 
 
+o365search_email_batch_description = (
+    "Use this function to retrieve the full and detailed content of several"
+    " emails at once, identified by their `message_id`s. Prefer it over"
+    " calling o365search_email repeatedly whenever you need to read more"
+    " than one email, for example during a deep search after identifying the"
+    " emails of interest using the o365search_emails function."
+)
+
+
+class O365SearchEmailBatchParameters(BaseModel):
+    message_ids: List[str] = Field(
+        ...,
+        description="The list of message_ids for the emails you want to retrieve from the o365search_emails function.",
+    )
+
+
 o365parse_proposed_times_description = (
     "ALWAYS use this tool if you need to determine when someone is"
     " proposing a meeting or event in an email. This tool parses out the"
@@ -146,9 +212,9 @@ class O365ProposedTimesParameters(BaseModel):
 
 o365find_free_time_slots_description = (
     "ALWAYS use this tool to determine when the user is free by analyzing calendar events between "
-    "a start and end datetime on the same day. IMPORTANT: This tool must only be used for single-day "
-    "availability (do not use it for multi-day queries). The output is a list of free slots with their "
-    "start and end times, which can be conveyed to the user for scheduling and meeting planning."
+    "a start and end datetime, which may span several days. Call it once for the whole range instead "
+    "of once per day. The output lists each business day in the range with its free slots within "
+    "business hours, which can be conveyed to the user for scheduling and meeting planning."
 )
 
 
@@ -156,15 +222,57 @@ class O365FindFreeTimeSlotsParameters(BaseModel):
     start_datetime: str = Field(
         ...,
         description=(
-            "Start time of the search query in ISO 8601 format (e.g., '2022-03-28T15:00:00-04:00'). "
-            "Must be on the same day as end_datetime."
+            "Start time of the search query in ISO 8601 format (e.g., '2022-03-28T15:00:00-04:00')."
         ),
     )
     end_datetime: str = Field(
         ...,
         description=(
-            "End time of the search query in ISO 8601 format (e.g., '2022-03-28T16:00:00-04:00'). "
-            "Must be on the same day as start_datetime."
+            "End time of the search query in ISO 8601 format (e.g., '2022-03-29T16:00:00-04:00'). "
+            "May be on a later day than start_datetime."
+        ),
+    )
+    min_duration_minutes: int = Field(
+        ...,
+        description=(
+            "Length of the meeting being scheduled in minutes. Free slots shorter than this are "
+            "left out. Use 0 to return every free slot."
+        ),
+    )
+
+
+o365find_common_free_time_slots_description = (
+    "Use this tool to find the times when the user and other attendees are all free, for example "
+    "to schedule a meeting with several people. It checks everyone's availability in one call "
+    "over a start and end datetime that may span several days. The output lists the free slots "
+    "within business hours shared by everyone for each business day, and any attendees whose "
+    "availability could not be retrieved."
+)
+
+
+class O365FindCommonFreeTimeSlotsParameters(BaseModel):
+    attendees: List[str] = Field(
+        ...,
+        description="The email addresses of the other attendees, without the user's own address.",
+    )
+    start_datetime: str = Field(
+        ...,
+        description=(
+            "Start time of the search query in ISO 8601 format (e.g., '2022-03-28T15:00:00-04:00')."
+        ),
+    )
+    end_datetime: str = Field(
+        ...,
+        description=(
+            "End time of the search query in ISO 8601 format (e.g., '2022-03-29T16:00:00-04:00'). "
+            "May be on a later day than start_datetime."
+        ),
+    )
+    min_duration_minutes: int = Field(
+        ...,
+        description=(
+            "Length of the meeting being scheduled in minutes. Free slots shorter than this are "
+            "left out. Use 0 to return every free slot."
         ),
     )
 
@@ -197,6 +305,11 @@ class O365SearchEventsParameters(BaseModel):
         ...,
         description="Whethere to truncate the results to reduce the size of the response.",
     )
+    page_token: str = Field(
+        ...,
+        description="The 'next_page_token' returned by a previous call with the same"
+        " parameters, to get the next page of results. Use an empty string for the first page.",
+    )
 
 
 o365reply_message_description = (
@@ -329,113 +442,205 @@ class O365SendEventParameters(BaseModel):
 ### END TOOL PROTOTYPES HERE
 
 
-tools = [
-    openai.pydantic_function_tool(
-        O365SearchEmailsParameters,
-        name="o365search_emails",
-        description=o365search_emails_description,
-    ),
-    openai.pydantic_function_tool(
-        O365SearchEmailParameters,
-        name="o365search_email",
-        description=o365search_email_description,
-    ),
-    openai.pydantic_function_tool(
-        O365FindFreeTimeSlotsParameters,
-        name="o365find_free_time_slots",
-        description=o365find_free_time_slots_description,
-    ),
-    openai.pydantic_function_tool(
-        O365SearchEventsParameters,
-        name="o365search_events",
-        description=o365search_events_description,
-    ),
-    openai.pydantic_function_tool(
-        O365ReplyMesssageParameters,
-        name="o365reply_message",
-        description=o365reply_message_description,
-    ),
-    openai.pydantic_function_tool(
-        O365SendMesssageParameters,
-        name="o365send_message",
-        description=o365send_message_description,
-    ),
-    openai.pydantic_function_tool(
-        O365SendEventParameters,
-        name="o365send_event",
-        description=o365send_event_description,
-    ),
-]
-
-
 def o365search_emails(
     query: str = "",
     folder: str = "inbox",
     max_results: int = 10,
     truncate: bool = True,
     truncate_limit: int = 150,
+    page_token: str = "",
     interface="cli",
 ):
+    """
+    Searches emails, streaming the results page by page.
+
+    Results are added until max_results or the output byte budget is reached, and
+    'next_page_token' continues the search where it stopped, or is None at the end.
+    """
     # Get mailbox object
     account = authenticate(interface)
     mailbox = account.mailbox()
 
-    # Pull the folder if the user wants to search in a folder
-    if folder != "":
-        mailbox = mailbox.get_folder(folder_name=folder)
-
-    # Retrieve messages based on query
-    search_query = mailbox.q().search(query)
-    if query == "":
-        messages = mailbox.get_messages(limit=max_results)
+    if page_token:
+        # The token already has the url and query of the search
+        try:
+            cursor = decode_page_token(page_token, account.protocol.service_url)
+        except ValueError as e:
+            return {"error": str(e)}
     else:
-        messages = mailbox.get_messages(limit=max_results, query=search_query)
+        # Pull the folder if the user wants to search in a folder
+        if folder != "":
+            mailbox = mailbox.get_folder(folder_name=folder)
 
-    # Generate output dict
-    output_messages = []
-    for message in messages:
-        output_message = {}
-        output_message["from"] = message.sender
+        if mailbox.root:
+            url = mailbox.build_url(mailbox._endpoints.get("root_messages"))
+        else:
+            url = mailbox.build_url(
+                mailbox._endpoints.get("folder_messages").format(id=mailbox.folder_id)
+            )
+
+        # Only request the fields included in the output
+        search_query = mailbox.q().select(
+            *(MESSAGE_PREVIEW_FIELDS if truncate else MESSAGE_FULL_FIELDS)
+        )
+        if query != "":
+            search_query = search_query.search(query)
+
+        params = {"$top": min(max_results, SEARCH_PAGE_SIZE)}
+        params.update(search_query.as_params())
+        cursor = {"url": url, "params": params, "skip": 0}
 
+    def to_output(item):
+        message = mailbox.message_constructor(
+            parent=mailbox, **{mailbox._cloud_data_key: item}
+        )
         if truncate:
-            output_message["body"] = message.body_preview[:truncate_limit]
-        else:
-            output_message["body"] = clean_body(message.body)
+            return _message_output(message, message.body_preview[:truncate_limit])
+        # Search results only need each email's own text, not the thread it quotes
+        return _message_output(message, clean_body(message.body, strip_quotes=True))
+
+    output_messages, next_page_token = collect(
+        iter_pages(account.con, cursor["url"], cursor["params"], cursor["skip"]),
+        to_output,
+        max_results,
+    )
 
-        output_message["subject"] = message.subject
+    return {"emails": output_messages, "next_page_token": next_page_token}
 
-        output_message["date"] = message.modified.strftime(UTC_FORMAT)
 
-        output_message["message_id"] = message.object_id
+def o365search_email(message_id: str, interface: str = "cli"):
+    # Get mailbox object
+    account = authenticate(interface)
+    mailbox = account.mailbox()
 
-        output_message["to"] = []
-        for recipient in message.to._recipients:
-            output_message["to"].append(str(recipient))
+    def fetch():
+        message = mailbox.get_message(object_id=message_id)
+        return _full_message_output(message)
 
-        output_message["cc"] = []
-        for recipient in message.cc._recipients:
-            output_message["cc"].append(str(recipient))
+    # Read through the local cache when the Django database is available
+    if interface == "email":
+        from ..cache import get_message
 
-        output_message["bcc"] = []
-        for recipient in message.bcc._recipients:
-            output_message["bcc"].append(str(recipient))
+        return get_message(account, message_id, fetch)
 
-        output_messages.append(output_message)
+    return fetch()
 
-    return output_messages
 
+def o365search_email_batch(message_ids: List[str], interface: str = "cli"):
+    """
+    Retrieves the full content of several emails using Microsoft Graph JSON batching.
 
-def o365search_email(message_id: str, interface: str = "cli"):
+    Parameters:
+    message_ids (List[str]): The message_ids of the emails to retrieve.
+    interface (str): Specifies the interface used for authentication (default is "cli").
+
+    Returns:
+    list: The emails in the same order as message_ids. Emails that could not be
+          retrieved include the message_id and an error instead of their content.
+    """
     # Get mailbox object
     account = authenticate(interface)
     mailbox = account.mailbox()
+    service_url = account.protocol.service_url
 
-    message = mailbox.get_message(object_id=message_id)
+    def fetch_many(ids):
+        # Batch request urls are relative to the service url, e.g. /me/messages/{id}
+        urls = [
+            mailbox.build_url(mailbox._endpoints.get("message").format(id=message_id))[
+                len(service_url) - 1 :
+            ]
+            for message_id in ids
+        ]
+
+        output_messages = []
+        for message_id, item in zip(ids, _batch_get(account, urls)):
+            if item.get("status") == 200:
+                message = mailbox.message_constructor(
+                    parent=mailbox, **{mailbox._cloud_data_key: item["body"]}
+                )
+                output_messages.append(_full_message_output(message))
+            else:
+                error = (item.get("body") or {}).get("error", {}).get("message", "Not found")
+                output_messages.append({"message_id": message_id, "error": error})
+
+        return output_messages
+
+    # Read through the local cache when the Django database is available
+    if interface == "email":
+        from ..cache import get_messages
 
+        return get_messages(account, message_ids, fetch_many)
+
+    return fetch_many(message_ids)
+
+
+def _batch_get(account, urls):
+    """
+    Sends GET requests in Microsoft Graph JSON batches of up to GRAPH_BATCH_LIMIT,
+    returning their responses in the order of urls.
+
+    Graph throttles the requests of a batch one by one, e.g. beyond the mailbox's
+    four concurrent requests, so throttled requests are sent again in a new batch
+    after the longest of their Retry-After headers, or a jittered backoff.
+
+    Parameters:
+    urls (List[str]): Request urls relative to the service url, e.g. /me/messages/{id}.
+    """
+    batch_url = account.protocol.service_url + "$batch"
+    responses = {}
+    pending = list(range(len(urls)))
+    attempt = 0
+
+    while pending:
+        retry = []
+        delay = 0.0
+        for start in range(0, len(pending), GRAPH_BATCH_LIMIT):
+            chunk = pending[start : start + GRAPH_BATCH_LIMIT]
+            response = account.con.post(
+                batch_url,
+                data={
+                    "requests": [
+                        {"id": str(index), "method": "GET", "url": urls[index]} for index in chunk
+                    ]
+                },
+            )
+
+            # Responses may arrive in any order, so match them back by request id
+            for item in response.json().get("responses", []):
+                index = int(item["id"])
+                status = item.get("status")
+                if status in THROTTLED_STATUSES:
+                    throttle_stats.record(throttled=1)
+                    if should_retry("GET", status, attempt):
+                        headers = {
+                            name.lower(): value for name, value in (item.get("headers") or {}).items()
+                        }
+                        delay = max(delay, backoff_delay(attempt, headers.get("retry-after")))
+                        retry.append(index)
+                        continue
+                    throttle_stats.record(exhausted=1)
+                responses[index] = item
+
+        if retry:
+            throttle_stats.record(retries=len(retry), backoff_seconds=delay)
+            time.sleep(delay)
+        pending = sorted(retry)
+        attempt += 1
+
+    return [responses.get(index, {}) for index in range(len(urls))]
+
+
+def _full_message_output(message):
+    """Generates the output dict with the full content of a message."""
+    return _message_output(message, clean_body(message.body))
+
+
+def _message_output(message, body):
+    """Generates the output dict of a message with the given body."""
     output_message = {}
-    output_message["from"] = message.sender
+    output_message["from"] = str(message.sender)
 
-    output_message["body"] = clean_body(message.body)
+    output_message["body"] = body
 
     output_message["subject"] = message.subject
 
@@ -458,67 +663,115 @@ def o365search_email(message_id: str, interface: str = "cli"):
     return output_message
 
 
-def o365find_free_time_slots(start_datetime, end_datetime, interface: str = "cli"):
+def o365find_free_time_slots(
+    start_datetime, end_datetime, min_duration_minutes: int = 0, interface: str = "cli"
+):
     """
-    Identifies and returns a list of available free time slots within a specified date and time range.
+    Identifies and returns the free time slots within business hours for every day of a date and time range.
 
     Parameters:
     start_datetime (str): A string in ISO 8601 format "YYYY-MM-DDTHH:MM:SS±HH:MM" representing the start of the time range.
     end_datetime (str): A string in ISO 8601 format "YYYY-MM-DDTHH:MM:SS±HH:MM" representing the end of the time range.
+    min_duration_minutes (int): Free slots shorter than this many minutes are left out (default is 0).
+    interface (str): Specifies the interface used for authentication (default is "cli").
 
     Returns:
-    str: A JSON string representing a list of free time slots within the specified range. Each slot includes a start_datetime and end_datetime.
+    str: A JSON string with one entry per business day in the range, each including the date and its free slots.
          If there are no free time slots, returns a message indicating that there are no available free times.
     """
+    account = authenticate(interface)
 
-    events = o365search_events(start_datetime = start_datetime, end_datetime = end_datetime, interface = interface)
+    # Process the date range parameters
+    start_datetime_query = datetime.strptime(start_datetime, UTC_FORMAT)
+    end_datetime_query = datetime.strptime(end_datetime, UTC_FORMAT)
+
+    def fetch():
+        return fetch_busy_intervals(account, start_datetime_query, end_datetime_query)
 
-    if not events:
-        # If there are no events, return the entire time
-        return json.dumps(
-            [{"start_datetime": start_datetime, "end_datetime": end_datetime}], indent=4
+    # Read through the local cache when the Django database is available
+    if interface == "email":
+        from ..cache import get_events
+
+        busy = get_events(
+            account, start_datetime_query, end_datetime_query, {"view": "busy"}, fetch
         )
+    else:
+        busy = fetch()
+
+    # Business hours and day boundaries follow the user's working hours
+    business_hours, hours_timezone = profile_business_hours(get_profile(account, interface))
+    days = free_slots(
+        [(datetime.fromisoformat(start), datetime.fromisoformat(end)) for start, end in busy],
+        start_datetime_query,
+        end_datetime_query,
+        hours_timezone,
+        business_hours,
+        min_duration=timedelta(minutes=min_duration_minutes),
+    )
 
-    # Sort events based on start time
-    events.sort(key=lambda x: x["start_datetime"])
+    # Format and output the response
+    if not any(slots for _, slots in days):
+        return "There are no free times for this search"
+    else:
+        return json.dumps(format_free_slots(days), indent=4)
 
-    # Set day start and end times
-    day_start = datetime.strptime(start_datetime, "%Y-%m-%dT%H:%M:%S%z")
-    day_end = datetime.strptime(end_datetime, "%Y-%m-%dT%H:%M:%S%z")
 
-    # Initialize variables
-    last_end_time = day_start
-    free_slots = []
+def o365find_common_free_time_slots(
+    attendees: List[str],
+    start_datetime: str,
+    end_datetime: str,
+    min_duration_minutes: int = 0,
+    interface: str = "cli",
+):
+    """
+    Identifies the free time slots within business hours shared by the user and other attendees.
 
-    # Identify free time slots
-    for event in events:
-        start_time = datetime.strptime(event["start_datetime"], "%Y-%m-%dT%H:%M:%S%z")
-        end_time = datetime.strptime(event["end_datetime"], "%Y-%m-%dT%H:%M:%S%z")
+    Parameters:
+    attendees (List[str]): The email addresses of the other attendees.
+    start_datetime (str): A string in ISO 8601 format "YYYY-MM-DDTHH:MM:SS±HH:MM" representing the start of the time range.
+    end_datetime (str): A string in ISO 8601 format "YYYY-MM-DDTHH:MM:SS±HH:MM" representing the end of the time range.
+    min_duration_minutes (int): Free slots shorter than this many minutes are left out (default is 0).
+    interface (str): Specifies the interface used for authentication (default is "cli").
 
-        if start_time > last_end_time:
-            free_slots.append(
-                {
-                    "start_datetime": last_end_time.strftime("%Y-%m-%dT%H:%M:%S%z"),
-                    "end_datetime": start_time.strftime("%Y-%m-%dT%H:%M:%S%z"),
-                }
-            )
+    Returns:
+    str: A JSON string with the free slots per business day when everyone is free, and the
+         attendees whose availability could not be retrieved.
+    """
+    account = authenticate(interface)
+    profile = get_profile(account, interface)
+    user_email = profile["email"]
 
-        last_end_time = max(last_end_time, end_time)
+    # Process the date range parameters
+    start_datetime_query = datetime.strptime(start_datetime, UTC_FORMAT)
+    end_datetime_query = datetime.strptime(end_datetime, UTC_FORMAT)
 
-    # Check for free time at the end of the day
-    if last_end_time < day_end:
-        free_slots.append(
-            {
-                "start_datetime": last_end_time.strftime("%Y-%m-%dT%H:%M:%S%z"),
-                "end_datetime": day_end.strftime("%Y-%m-%dT%H:%M:%S%z"),
-            }
-        )
+    schedules = [user_email] + [
+        attendee for attendee in attendees if attendee.lower() != user_email.lower()
+    ]
+    busy, errors = fetch_schedules(
+        account, schedules, start_datetime_query, end_datetime_query
+    )
 
-    # Format and output the response
-    if free_slots == []:
-        return "There are no free times for this search"
-    else:
-        return json.dumps(free_slots, indent=4)
+    # Everyone is free when nobody is busy, within the user's working hours
+    business_hours, hours_timezone = profile_business_hours(profile)
+    days = free_slots(
+        [interval for intervals in busy.values() for interval in intervals],
+        start_datetime_query,
+        end_datetime_query,
+        hours_timezone,
+        business_hours,
+        min_duration=timedelta(minutes=min_duration_minutes),
+    )
+
+    return json.dumps(
+        {
+            "common_free_slots": format_free_slots(days),
+            "unavailable_attendees": [
+                {"attendee": attendee, "error": error} for attendee, error in errors.items()
+            ],
+        },
+        indent=4,
+    )
 
 
 def o365search_events(
@@ -527,52 +780,97 @@ def o365search_events(
     max_results: int = 10,
     truncate: bool = True,
     truncate_limit: int = 150,
+    page_token: str = "",
     interface: str = "cli",
 ):
+    """
+    Searches the events of the default calendar, streaming the results page by page.
+
+    Results are added until max_results or the output byte budget is reached, and
+    'next_page_token' continues the search where it stopped, or is None at the end.
+    """
     # Get calendar object
-    # Get mailbox object
     account = authenticate(interface)
     schedule = account.schedule()
-    calendar = schedule.get_default_calendar()
+    # The default calendar's endpoints don't need its id, so skip fetching it
+    calendar = schedule.calendar_constructor(parent=schedule)
+    calendar.event_constructor = PreviewEvent
 
     # Process the date range parameters
     start_datetime_query = datetime.strptime(start_datetime, UTC_FORMAT)
     end_datetime_query = datetime.strptime(end_datetime, UTC_FORMAT)
+    # Get the time zone from the search parameters
+    time_zone = start_datetime_query.tzinfo
 
-    # Run the query
-    q = calendar.new_query("start").greater_equal(start_datetime_query)
-    q.chain("and").on_attribute("end").less_equal(end_datetime_query)
-    events = calendar.get_events(query=q, include_recurring=True, limit=max_results)
+    def to_output(item):
+        event = calendar.event_constructor(parent=calendar, **{calendar._cloud_data_key: item})
 
-    # Generate output dict
-    output_events = []
-    for event in events:
         output_event = {}
-        output_event["organizer"] = event.organizer
+        output_event["organizer"] = str(event.organizer)
 
         output_event["subject"] = event.subject
 
         if truncate:
-            output_event["body"] = clean_body(event.body)[:truncate_limit]
+            # The plain text preview avoids downloading and parsing the HTML body
+            output_event["body"] = clean_body(event.body_preview, limit=truncate_limit)
         else:
-            output_event["body"] = clean_body(event.body)
+            output_event["body"] = clean_body(event.body, strip_quotes=True)
 
-        # Get the time zone from the search parameters
-        time_zone = start_datetime_query.tzinfo
         # Assign the datetimes in the search time zone
         output_event["start_datetime"] = event.start.astimezone(time_zone).strftime(
             UTC_FORMAT
         )
-        output_event["end_datetime"] = event.end.astimezone(time_zone).strftime(
-            UTC_FORMAT
-        )
+        output_event["end_datetime"] = event.end.astimezone(time_zone).strftime(UTC_FORMAT)
         output_event["modified_date"] = event.modified.astimezone(time_zone).strftime(
             UTC_FORMAT
         )
 
-        output_events.append(output_event)
+        return output_event
 
-    return output_events
+    def fetch():
+        if page_token:
+            try:
+                cursor = decode_page_token(page_token, account.protocol.service_url)
+            except ValueError as e:
+                return {"error": str(e)}
+        else:
+            # calendarView expands recurring events, ordered so pages are stable
+            url = calendar.build_url(calendar._endpoints.get("default_events_view"))
+            params = {
+                "startDateTime": start_datetime_query.astimezone(timezone.utc).isoformat(),
+                "endDateTime": end_datetime_query.astimezone(timezone.utc).isoformat(),
+                "$top": min(max_results, SEARCH_PAGE_SIZE),
+                "$orderby": "start/dateTime",
+            }
+            # Only request the fields included in the output
+            params.update(
+                calendar.new_query()
+                .select(*(EVENT_PREVIEW_FIELDS if truncate else EVENT_FULL_FIELDS))
+                .as_params()
+            )
+            cursor = {"url": url, "params": params, "skip": 0}
+
+        output_events, next_page_token = collect(
+            iter_pages(account.con, cursor["url"], cursor["params"], cursor["skip"]),
+            to_output,
+            max_results,
+        )
+
+        return {"events": output_events, "next_page_token": next_page_token}
+
+    # Read through the local cache when the Django database is available
+    if interface == "email":
+        from ..cache import get_events
+
+        options = {
+            "max_results": max_results,
+            "truncate": truncate,
+            "truncate_limit": truncate_limit,
+            "page_token": page_token,
+        }
+        return get_events(account, start_datetime_query, end_datetime_query, options, fetch)
+
+    return fetch()
 
 
 def o365reply_message(
@@ -655,19 +953,27 @@ def o365send_event(
 
     event.body = body
     event.subject = subject
+    # Create the event in the user's time zone
+    time_zone = ZoneInfo(get_profile(account, interface)["timezone"])
     # Parse the start time string into a datetime object with time zone information
     dt = datetime.strptime(start_datetime, UTC_FORMAT)
-    # Convert the start time to UTC
-    event.start = dt.astimezone(ZoneInfo("America/New_York"))
+    # Convert the start time to the user's time zone
+    event.start = dt.astimezone(time_zone)
     # Do the same for event.end
     dt = datetime.strptime(end_datetime, UTC_FORMAT)
-    event.end = dt.astimezone(ZoneInfo("America/New_York"))
+    event.end = dt.astimezone(time_zone)
 
     for attendee in attendees:
         event.attendees.add(attendee)
 
     event.save()
 
+    # Searches of the event's period must see it, e.g. to avoid double booking
+    if interface == "email":
+        from ..cache import invalidate_events
+
+        invalidate_events(event.start, event.end)
+
     output = "Event sent: " + str(event)
     return output
 
@@ -699,3 +1005,70 @@ def o365delete_message(message_id: str, interface: str = "cli"):
         output = f"Message with ID {message_id} not found."
 
     return output
+
+
+### START TOOL REGISTRY HERE
+toolkit_registry = ToolRegistry()
+toolkit_registry.register(
+    "o365search_emails",
+    o365search_emails,
+    O365SearchEmailsParameters,
+    o365search_emails_description,
+    read_only=True,
+)
+toolkit_registry.register(
+    "o365search_email",
+    o365search_email,
+    O365SearchEmailParameters,
+    o365search_email_description,
+    read_only=True,
+)
+toolkit_registry.register(
+    "o365search_email_batch",
+    o365search_email_batch,
+    O365SearchEmailBatchParameters,
+    o365search_email_batch_description,
+    read_only=True,
+)
+toolkit_registry.register(
+    "o365find_free_time_slots",
+    o365find_free_time_slots,
+    O365FindFreeTimeSlotsParameters,
+    o365find_free_time_slots_description,
+    read_only=True,
+)
+toolkit_registry.register(
+    "o365find_common_free_time_slots",
+    o365find_common_free_time_slots,
+    O365FindCommonFreeTimeSlotsParameters,
+    o365find_common_free_time_slots_description,
+    read_only=True,
+)
+toolkit_registry.register(
+    "o365search_events",
+    o365search_events,
+    O365SearchEventsParameters,
+    o365search_events_description,
+    read_only=True,
+)
+toolkit_registry.register(
+    "o365reply_message",
+    o365reply_message,
+    O365ReplyMesssageParameters,
+    o365reply_message_description,
+)
+toolkit_registry.register(
+    "o365send_message",
+    o365send_message,
+    O365SendMesssageParameters,
+    o365send_message_description,
+)
+toolkit_registry.register(
+    "o365send_event",
+    o365send_event,
+    O365SendEventParameters,
+    o365send_event_description,
+)
+### END TOOL REGISTRY HERE
+
+tools = toolkit_registry.schemas()
@@ -0,0 +1,101 @@
+import json, base64
+
+"""Maximum size in bytes of the results returned to the model by one search call."""
+OUTPUT_BYTE_BUDGET = 16000
+
+
+def encode_page_token(cursor):
+    """Encodes a stream position as an opaque continuation token for the model."""
+    if cursor is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+
+def decode_page_token(token, service_url):
+    """
+    Decodes a continuation token returned by encode_page_token.
+
+    Raises:
+    ValueError: If the token is malformed or doesn't point to Microsoft Graph.
+    """
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(token.encode()))
+        url, skip = cursor["url"], int(cursor["skip"])
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Invalid page_token, start a new search without one.")
+
+    # Tokens are resent by the model, so never follow them outside Graph
+    if not url.startswith(service_url):
+        raise ValueError("Invalid page_token, start a new search without one.")
+    return {"url": url, "params": cursor.get("params"), "skip": skip}
+
+
+def iter_pages(con, url, params=None, skip=0, headers=None):
+    """
+    Streams the items of a Graph collection, following @odata.nextLink lazily.
+
+    Pages are only requested when the consumer reaches them, so memory stays
+    bounded by one page however large the collection is.
+
+    Parameters:
+    con (Connection): The O365 connection used for the requests.
+    url (str): The collection url.
+    params (dict): Query parameters of the first request.
+    skip (int): Number of items of the first page that were already consumed.
+
+    Yields:
+    tuple: Each item's JSON, and the cursor of the position right after it, or
+           None after the last item.
+    """
+    while url:
+        data = con.get(url, params=params, headers=headers).json()
+        items = data.get("value", [])
+        next_link = data.get("@odata.nextLink")
+
+        for index in range(skip, len(items)):
+            if index + 1 < len(items):
+                cursor = {"url": url, "params": params, "skip": index + 1}
+            elif next_link:
+                # The next link already includes the query parameters
+                cursor = {"url": next_link, "params": None, "skip": 0}
+            else:
+                cursor = None
+            yield items[index], cursor
+
+        url, params, skip = next_link, None, 0
+
+
+def collect(stream, to_output, max_results, byte_budget=OUTPUT_BYTE_BUDGET):
+    """
+    Builds a tool output from a stream of items, within a count and byte budget.
+
+    The first item is always included, so a single large item can't stall the search.
+
+    Parameters:
+    stream (iterator): (item, cursor) pairs from iter_pages.
+    to_output (callable): Turns an item's JSON into its output dict.
+    max_results (int): Maximum number of output dicts.
+    byte_budget (int): Maximum size of the serialized output dicts.
+
+    Returns:
+    tuple: The output dicts, and the continuation token of the next item, or None
+           if the stream was exhausted.
+    """
+    outputs = []
+    size = 0
+    cursor = None
+
+    for item, item_cursor in stream:
+        output = to_output(item)
+        output_size = len(json.dumps(output, default=str).encode())
+        if outputs and size + output_size > byte_budget:
+            break
+
+        outputs.append(output)
+        size += output_size
+        cursor = item_cursor
+        # Stop before advancing the stream, which could request a page for nothing
+        if cursor is None or len(outputs) >= max_results:
+            break
+
+    return outputs, encode_page_token(cursor)
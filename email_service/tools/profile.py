@@ -0,0 +1,181 @@
+import time, threading
+from datetime import time as dt_time, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from requests.exceptions import HTTPError
+from O365.utils.windows_tz import get_iana_tz
+from .freebusy import BUSINESS_HOURS
+
+"""How long the CLI keeps a profile in process memory. The email interface caches it in the database."""
+PROFILE_TTL = timedelta(hours=1)
+"""Time zone used when the mailbox settings can't be read."""
+DEFAULT_TIMEZONE = "America/New_York"
+"""User fields requested from Graph. mailboxSettings needs the MailboxSettings.Read scope."""
+PROFILE_FIELDS = "displayName,mail,userPrincipalName"
+MAILBOX_SETTINGS_FIELD = "mailboxSettings"
+
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+
+# Canonical IANA zones of common Windows time zones (CLDR windowsZones, territory
+# 001). O365's own mapping picks arbitrary aliases, e.g. US/Indiana-Starke for
+# Central Standard Time, whose daylight saving time rules differ.
+WINDOWS_TIMEZONES = {
+    "Dateline Standard Time": "Etc/GMT+12",
+    "Hawaiian Standard Time": "Pacific/Honolulu",
+    "Alaskan Standard Time": "America/Anchorage",
+    "Pacific Standard Time": "America/Los_Angeles",
+    "US Mountain Standard Time": "America/Phoenix",
+    "Mountain Standard Time": "America/Denver",
+    "Central Standard Time": "America/Chicago",
+    "Canada Central Standard Time": "America/Regina",
+    "Central America Standard Time": "America/Guatemala",
+    "Central Standard Time (Mexico)": "America/Mexico_City",
+    "Eastern Standard Time": "America/New_York",
+    "US Eastern Standard Time": "America/Indiana/Indianapolis",
+    "SA Pacific Standard Time": "America/Bogota",
+    "Atlantic Standard Time": "America/Halifax",
+    "Newfoundland Standard Time": "America/St_Johns",
+    "E. South America Standard Time": "America/Sao_Paulo",
+    "Argentina Standard Time": "America/Argentina/Buenos_Aires",
+    "Pacific SA Standard Time": "America/Santiago",
+    "UTC": "Etc/UTC",
+    "GMT Standard Time": "Europe/London",
+    "Greenwich Standard Time": "Atlantic/Reykjavik",
+    "W. Europe Standard Time": "Europe/Berlin",
+    "Romance Standard Time": "Europe/Paris",
+    "Central Europe Standard Time": "Europe/Budapest",
+    "Central European Standard Time": "Europe/Warsaw",
+    "GTB Standard Time": "Europe/Bucharest",
+    "FLE Standard Time": "Europe/Kiev",
+    "E. Europe Standard Time": "Europe/Chisinau",
+    "Turkey Standard Time": "Europe/Istanbul",
+    "Russian Standard Time": "Europe/Moscow",
+    "Israel Standard Time": "Asia/Jerusalem",
+    "Egypt Standard Time": "Africa/Cairo",
+    "South Africa Standard Time": "Africa/Johannesburg",
+    "W. Central Africa Standard Time": "Africa/Lagos",
+    "E. Africa Standard Time": "Africa/Nairobi",
+    "Arab Standard Time": "Asia/Riyadh",
+    "Arabian Standard Time": "Asia/Dubai",
+    "Pakistan Standard Time": "Asia/Karachi",
+    "India Standard Time": "Asia/Kolkata",
+    "SE Asia Standard Time": "Asia/Bangkok",
+    "China Standard Time": "Asia/Shanghai",
+    "Singapore Standard Time": "Asia/Singapore",
+    "Taipei Standard Time": "Asia/Taipei",
+    "Tokyo Standard Time": "Asia/Tokyo",
+    "Korea Standard Time": "Asia/Seoul",
+    "W. Australia Standard Time": "Australia/Perth",
+    "E. Australia Standard Time": "Australia/Brisbane",
+    "AUS Eastern Standard Time": "Australia/Sydney",
+    "New Zealand Standard Time": "Pacific/Auckland",
+}
+
+_profiles = {}
+_lock = threading.Lock()
+
+
+def iana_timezone(name, default=DEFAULT_TIMEZONE):
+    """Returns the IANA name of a Windows or IANA time zone name, or default if it's unknown."""
+    if not name:
+        return default
+    if name in WINDOWS_TIMEZONES:
+        return WINDOWS_TIMEZONES[name]
+    try:
+        return ZoneInfo(name).key
+    except (ZoneInfoNotFoundError, ValueError):
+        pass
+    try:
+        return get_iana_tz(name).key
+    except (ZoneInfoNotFoundError, ValueError):
+        return default
+
+
+def fetch_profile(account):
+    """
+    Retrieves the user's name, email address, time zone and working hours with one Graph request.
+
+    Returns:
+    dict: The profile, with IANA time zone names and working hours as
+          {"days": [0, ...], "start": "09:00:00", "end": "17:00:00", "timezone": ...},
+          where day 0 is Monday.
+    """
+    url = account.mailbox().build_url("")
+    try:
+        user = account.con.get(
+            url, params={"$select": PROFILE_FIELDS + "," + MAILBOX_SETTINGS_FIELD}
+        ).json()
+    except HTTPError:
+        # Tokens issued without the mailbox settings scope can still read the user
+        user = account.con.get(url, params={"$select": PROFILE_FIELDS}).json()
+
+    settings = user.get(MAILBOX_SETTINGS_FIELD) or {}
+    timezone = iana_timezone(settings.get("timeZone"))
+
+    working_hours = settings.get("workingHours") or {}
+    days = [
+        WEEKDAYS.index(day.lower())
+        for day in working_hours.get("daysOfWeek") or []
+        if day.lower() in WEEKDAYS
+    ]
+    # Graph returns times with seven fractional digits, e.g. 08:00:00.0000000
+    start = (working_hours.get("startTime") or "")[:8]
+    end = (working_hours.get("endTime") or "")[:8]
+    if not days or not start or not end or start >= end:
+        days = sorted(BUSINESS_HOURS)
+        start = BUSINESS_HOURS[days[0]][0].isoformat()
+        end = BUSINESS_HOURS[days[0]][1].isoformat()
+
+    return {
+        "name": user.get("displayName") or "",
+        "email": user.get("mail") or user.get("userPrincipalName") or "",
+        "timezone": timezone,
+        "working_hours": {
+            "days": sorted(days),
+            "start": start,
+            "end": end,
+            "timezone": iana_timezone((working_hours.get("timeZone") or {}).get("name"), timezone),
+        },
+    }
+
+
+def get_profile(account, interface="cli"):
+    """
+    Returns the profile of the account's user, see fetch_profile.
+
+    The email interface caches profiles in the database, so they're shared by the
+    web and worker processes. The CLI keeps them in process memory for PROFILE_TTL.
+    """
+    if interface == "email":
+        from ..cache import get_profile as get_cached_profile
+
+        return get_cached_profile(interface, lambda: fetch_profile(account))
+
+    now = time.monotonic()
+    with _lock:
+        entry = _profiles.get(interface)
+    if entry is not None and now - entry[0] < PROFILE_TTL.total_seconds():
+        return entry[1]
+
+    profile = fetch_profile(account)
+    with _lock:
+        _profiles[interface] = (now, profile)
+    return profile
+
+
+def invalidate_profile(interface="cli"):
+    """Drops the cached profile of an interface, e.g. after the account changed."""
+    with _lock:
+        _profiles.pop(interface, None)
+    if interface == "email":
+        from ..cache import invalidate_profile as invalidate_cached_profile
+
+        invalidate_cached_profile(interface)
+
+
+def profile_business_hours(profile):
+    """
+    Returns the profile's working hours in the format of freebusy.BUSINESS_HOURS, and their time zone.
+    """
+    working_hours = profile["working_hours"]
+    hours = (dt_time.fromisoformat(working_hours["start"]), dt_time.fromisoformat(working_hours["end"]))
+    return {day: hours for day in working_hours["days"]}, ZoneInfo(working_hours["timezone"])
@@ -0,0 +1,123 @@
+import time, threading, openai
+from pydantic import ValidationError
+
+"""Upper bounds, in milliseconds, of the tool latency histogram buckets."""
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, float("inf"))
+
+
+class ToolStats:
+    """Call count, error count and latency histogram for one tool."""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS_MS)
+
+    def record(self, elapsed_ms, error=False):
+        self.calls += 1
+        self.errors += int(error)
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                self.buckets[i] += 1
+                break
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket containing the given latency percentile."""
+        target = fraction * self.calls
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, self.buckets):
+            seen += count
+            if count and seen >= target:
+                return self.max_ms if bound == float("inf") else min(bound, self.max_ms)
+        return 0.0
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "mean_ms": round(self.total_ms / self.calls, 1) if self.calls else 0.0,
+            "p50_ms": round(self.percentile(0.5), 1),
+            "p95_ms": round(self.percentile(0.95), 1),
+            "max_ms": round(self.max_ms, 1),
+            "histogram_ms": {
+                ("inf" if bound == float("inf") else str(bound)): count
+                for bound, count in zip(LATENCY_BUCKETS_MS, self.buckets)
+            },
+        }
+
+
+class ToolRegistry:
+    """
+    Maps each toolkit function exposed to the model to its callable and parameter model.
+
+    Dispatch validates the model's arguments against the tool's Pydantic parameter
+    model and records per-tool latency and error statistics.
+    """
+
+    def __init__(self):
+        self._tools = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, function, parameters, description, read_only=False):
+        """Registers a toolkit function under the name the model calls it by."""
+        self._tools[name] = {
+            "function": function,
+            "parameters": parameters,
+            "read_only": read_only,
+            "schema": openai.pydantic_function_tool(
+                parameters, name=name, description=description
+            ),
+        }
+        self._stats[name] = ToolStats()
+
+    def schemas(self):
+        """Returns the tool schemas to pass to the OpenAI API."""
+        return [tool["schema"] for tool in self._tools.values()]
+
+    def is_read_only(self, name):
+        """Whether the tool only reads data, and can run concurrently with other tools."""
+        tool = self._tools.get(name)
+        return tool is not None and tool["read_only"]
+
+    def dispatch(self, name, arguments, interface="cli"):
+        """
+        Validates the JSON arguments for a tool and executes it.
+
+        Unknown tools and invalid arguments are reported back to the model as the
+        tool output, so it can correct the call. Exceptions raised by the tool itself
+        are counted and re-raised.
+        """
+        tool = self._tools.get(name)
+        if tool is None:
+            return "Error: There is no tool called " + name
+
+        start = time.perf_counter()
+        error = False
+        try:
+            parameters = tool["parameters"].model_validate_json(arguments or "{}")
+            return tool["function"](**parameters.model_dump(), interface=interface)
+        except ValidationError as e:
+            error = True
+            return "Error: Invalid arguments for " + name + ": " + str(e)
+        except Exception:
+            error = True
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with self._lock:
+                self._stats[name].record(elapsed_ms, error=error)
+
+    def stats(self):
+        """Returns the call statistics of every registered tool."""
+        with self._lock:
+            return {name: stats.as_dict() for name, stats in self._stats.items()}
+
+    def reset_stats(self):
+        with self._lock:
+            for name in self._stats:
+                self._stats[name] = ToolStats()
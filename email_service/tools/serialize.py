@@ -0,0 +1,226 @@
+import json, pprint, threading
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+"""Fields listed first in tool outputs, in this order. Long bodies go last."""
+FIELD_ORDER = (
+    "message_id",
+    "subject",
+    "from",
+    "organizer",
+    "to",
+    "cc",
+    "bcc",
+    "date",
+    "start_datetime",
+    "end_datetime",
+    "modified_date",
+)
+"""Fields listed last in tool outputs, so trimming them leaves the rest readable."""
+TRAILING_FIELDS = ("body",)
+"""Fields dropped from tool outputs when they are empty."""
+DROP_EMPTY_FIELDS = ("cc", "bcc")
+"""Maximum number of tokens of one tool output, bodies are trimmed to fit. None disables trimming."""
+TOOL_OUTPUT_TOKEN_BUDGET = 8000
+"""Encoding of the Assistant's model, used to count tokens when tiktoken is installed."""
+TOKEN_ENCODING = "o200k_base"
+"""Average characters per token, used to estimate tokens without tiktoken."""
+CHARS_PER_TOKEN = 4
+"""Appended to bodies trimmed to fit the token budget."""
+TRIMMED_MARKER = "...[trimmed]"
+"""Number of times bodies are trimmed further if the output still exceeds the budget."""
+TRIM_ATTEMPTS = 3
+"""One in this many outputs of each tool is also tokenized as pprint, to estimate the tokens saved."""
+BASELINE_SAMPLE_RATE = 20
+
+_encoding = None
+
+
+def count_tokens(text):
+    """Counts the tokens of a text with tiktoken, or estimates them if it isn't installed."""
+    global _encoding
+    if tiktoken is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+def _compact(value):
+    """Orders the fields of output dicts and drops the empty ones, recursively."""
+    if isinstance(value, list):
+        return [_compact(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+
+    fields = [key for key in FIELD_ORDER if key in value]
+    fields += [key for key in value if key not in FIELD_ORDER and key not in TRAILING_FIELDS]
+    fields += [key for key in TRAILING_FIELDS if key in value]
+    return {
+        key: _compact(value[key])
+        for key in fields
+        if not (key in DROP_EMPTY_FIELDS and not value[key])
+    }
+
+
+def _bodies(value):
+    """Lists the output dicts with a string body, recursively."""
+    if isinstance(value, list):
+        return [body for item in value for body in _bodies(item)]
+    if not isinstance(value, dict):
+        return []
+
+    bodies = [value] if isinstance(value.get("body"), str) else []
+    for key, item in value.items():
+        if key != "body":
+            bodies += _bodies(item)
+    return bodies
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def _trim_bodies(value, text, tokens, token_budget):
+    """
+    Trims the longest bodies of an output until it fits the token budget.
+
+    Bodies are capped at a common length, so short bodies are kept whole and the
+    longest ones lose the most.
+    """
+    outputs = _bodies(value)
+    originals = [output["body"] for output in outputs]
+    target = sum(len(body) for body in originals)
+
+    for _ in range(TRIM_ATTEMPTS):
+        if tokens <= token_budget or not outputs:
+            break
+
+        # Remove the excess characters, estimated from the output's characters per token
+        target = max(0, target - (tokens - token_budget) * len(text) // tokens - 1)
+
+        # Find the largest common cap whose bodies fit the target length
+        lengths = sorted(len(body) for body in originals)
+        cap, remaining = 0, target
+        for index, length in enumerate(lengths):
+            share = remaining // (len(lengths) - index)
+            if length > share:
+                cap = share
+                break
+            remaining -= length
+        else:
+            cap = lengths[-1]
+
+        for output, body in zip(outputs, originals):
+            output["body"] = body if len(body) <= cap else body[:cap] + TRIMMED_MARKER
+        text = _dumps(value)
+        tokens = count_tokens(text)
+
+    return text, tokens
+
+
+class OutputStats:
+    """
+    Tokens of the serialized outputs of each tool, and the tokens saved over pprint.
+
+    Tokenizing the pprint baseline costs as much as serializing the output, so it's
+    only done for one in BASELINE_SAMPLE_RATE outputs, and the savings of the
+    sampled outputs are extrapolated to every call.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def should_sample(self, name):
+        """Whether the next output of a tool should have its baseline tokenized."""
+        with self._lock:
+            stats = self._stats.get(name)
+            return stats is None or stats["calls"] % BASELINE_SAMPLE_RATE == 0
+
+    def record(self, name, tokens, baseline_tokens, trimmed):
+        """Records an output, with baseline_tokens None if it was not sampled."""
+        with self._lock:
+            stats = self._stats.setdefault(
+                name,
+                {"calls": 0, "tokens": 0, "trimmed": 0, "sampled": 0, "sampled_tokens_saved": 0},
+            )
+            stats["calls"] += 1
+            stats["tokens"] += tokens
+            stats["trimmed"] += int(trimmed)
+            if baseline_tokens is not None:
+                stats["sampled"] += 1
+                stats["sampled_tokens_saved"] += baseline_tokens - tokens
+
+    def stats(self):
+        with self._lock:
+            result = {}
+            for name, stats in self._stats.items():
+                mean_tokens_saved = (
+                    stats["sampled_tokens_saved"] / stats["sampled"] if stats["sampled"] else 0
+                )
+                result[name] = {
+                    "calls": stats["calls"],
+                    "tokens": stats["tokens"],
+                    "tokens_saved": round(mean_tokens_saved * stats["calls"]),
+                    "trimmed": stats["trimmed"],
+                    "sampled": stats["sampled"],
+                    "mean_tokens": round(stats["tokens"] / stats["calls"], 1),
+                    "mean_tokens_saved": round(mean_tokens_saved, 1),
+                }
+            return result
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+
+output_stats = OutputStats()
+
+
+def serialize_output(output, name=None, token_budget=TOOL_OUTPUT_TOKEN_BUDGET):
+    """
+    Serializes a tool output for the model as compact JSON.
+
+    Fields are ordered consistently, empty cc and bcc lists are dropped, and bodies
+    are trimmed if the output exceeds the token budget. Tools that already return
+    JSON strings are compacted too, other strings are returned unchanged.
+
+    Parameters:
+    output: The value returned by the toolkit function.
+    name (str): The tool's name, to record token statistics in output_stats.
+    token_budget (int): Maximum number of tokens of the output (default is
+        TOOL_OUTPUT_TOKEN_BUDGET), or None to never trim.
+
+    Returns:
+    str: The serialized output.
+    """
+    value = output
+    if isinstance(output, str):
+        try:
+            value = json.loads(output) if output[:1] in ("{", "[") else None
+        except ValueError:
+            value = None
+
+    trimmed = False
+    if isinstance(value, (dict, list)):
+        value = _compact(value)
+        text = _dumps(value)
+        tokens = count_tokens(text)
+        trimmed = token_budget is not None and tokens > token_budget
+        if trimmed:
+            text, tokens = _trim_bodies(value, text, tokens, token_budget)
+    else:
+        # Plain strings, e.g. confirmations and errors, are already compact
+        text = output if isinstance(output, str) else _dumps(output)
+        tokens = count_tokens(text)
+
+    if name is not None:
+        baseline_tokens = None
+        if output_stats.should_sample(name):
+            baseline_tokens = count_tokens(pprint.pformat(output))
+        output_stats.record(name, tokens, baseline_tokens, trimmed)
+    return text
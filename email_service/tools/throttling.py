@@ -0,0 +1,259 @@
+import os, re, time, random, asyncio, threading, weakref
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from O365 import Account
+from O365.connection import Connection, RETRIES_BACKOFF_FACTOR
+
+"""Statuses Graph returns when a request is throttled or the service is busy."""
+THROTTLED_STATUSES = (429, 503, 504)
+"""Retries of a throttled request before its error is raised."""
+MAX_THROTTLE_RETRIES = 5
+"""Base and cap, in seconds, of the jittered exponential backoff without a Retry-After header."""
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 60
+# Outlook limits each app to 4 concurrent requests and 10,000 requests every
+# 10 minutes per mailbox, and Graph to 130,000 requests every 10 seconds per app
+MAILBOX_CONCURRENCY = 4
+MAILBOX_REQUESTS_PER_SECOND = 10000 / 600
+APP_REQUESTS_PER_SECOND = float(os.environ.get("GRAPH_APP_REQUESTS_PER_SECOND", 13000))
+"""Seconds of requests a token bucket lets through in a burst."""
+BURST_SECONDS = 10
+
+_USERS_PATH = re.compile(r"/users/([^/?(]+)", re.IGNORECASE)
+
+
+class TokenBucket:
+    """Token bucket rate limiter, whose callers wait the returned delay themselves."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = max(1.0, capacity if capacity is not None else rate * BURST_SECONDS)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Takes one request from the bucket, returning the seconds to wait before sending it."""
+        with self._lock:
+            self._refill()
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def available(self):
+        """Number of requests that can be sent right away."""
+        with self._lock:
+            self._refill()
+            return max(0, int(self.tokens))
+
+
+class ThrottleStats:
+    """Process-wide counters of Graph requests, throttling responses and retries."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.throttled = 0
+            self.retries = 0
+            self.exhausted = 0
+            self.limiter_wait_seconds = 0.0
+            self.backoff_seconds = 0.0
+
+    def record(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def stats(self):
+        """Return the counters, with wait times rounded to milliseconds."""
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "throttled": self.throttled,
+                "retries": self.retries,
+                "exhausted": self.exhausted,
+                "limiter_wait_seconds": round(self.limiter_wait_seconds, 3),
+                "backoff_seconds": round(self.backoff_seconds, 3),
+            }
+
+
+"""Process-wide throttling counters shared by the sync and async Graph clients."""
+throttle_stats = ThrottleStats()
+
+app_bucket = TokenBucket(APP_REQUESTS_PER_SECOND)
+_mailbox_buckets = {}
+_mailbox_semaphores = {}
+# asyncio semaphores belong to one event loop, so keep them per loop
+_async_semaphores = weakref.WeakKeyDictionary()
+_limits_lock = threading.Lock()
+
+
+def mailbox_of(url, default):
+    """The mailbox a Graph url targets: the /users/{id} segment, or default for /me."""
+    match = _USERS_PATH.search(urlsplit(url).path)
+    return "users/" + match.group(1).lower() if match else default
+
+
+def mailbox_bucket(mailbox):
+    with _limits_lock:
+        bucket = _mailbox_buckets.get(mailbox)
+        if bucket is None:
+            bucket = _mailbox_buckets[mailbox] = TokenBucket(MAILBOX_REQUESTS_PER_SECOND)
+        return bucket
+
+
+def mailbox_semaphore(mailbox):
+    """Limits a mailbox to MAILBOX_CONCURRENCY requests in flight across threads."""
+    with _limits_lock:
+        semaphore = _mailbox_semaphores.get(mailbox)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(MAILBOX_CONCURRENCY)
+            _mailbox_semaphores[mailbox] = semaphore
+        return semaphore
+
+
+def async_mailbox_semaphore(mailbox):
+    """Async version of mailbox_semaphore, for the running event loop."""
+    loop = asyncio.get_running_loop()
+    with _limits_lock:
+        semaphores = _async_semaphores.setdefault(loop, {})
+        semaphore = semaphores.get(mailbox)
+        if semaphore is None:
+            semaphore = semaphores[mailbox] = asyncio.Semaphore(MAILBOX_CONCURRENCY)
+        return semaphore
+
+
+def reserve(mailbox):
+    """Takes a request from the app's and the mailbox's buckets, returning the seconds to wait."""
+    return max(app_bucket.reserve(), mailbox_bucket(mailbox).reserve())
+
+
+def retry_after_seconds(value):
+    """Parses a Retry-After header, in seconds or as an HTTP date, returning None if invalid."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff_delay(attempt, retry_after=None):
+    """
+    Returns the seconds to wait before retrying a throttled request.
+
+    Graph's Retry-After is honored when present. Otherwise the delay is drawn
+    uniformly up to an exponentially growing cap ("full jitter"), so workers
+    throttled together don't retry together.
+
+    Parameters:
+    attempt (int): The number of retries already made.
+    retry_after (str): The response's Retry-After header.
+    """
+    seconds = retry_after_seconds(retry_after)
+    if seconds is not None:
+        return min(seconds, BACKOFF_MAX_SECONDS)
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2**attempt))
+
+
+def should_retry(method, status, attempt):
+    """
+    Whether a throttled response is retried.
+
+    A 429 means Graph didn't process the request, so any method is retried.
+    A busy service may have, so only idempotent methods are retried on 503 and 504.
+    """
+    if status not in THROTTLED_STATUSES or attempt >= MAX_THROTTLE_RETRIES:
+        return False
+    return status == 429 or method.upper() in ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+
+
+class ThrottlingAdapter(HTTPAdapter):
+    """
+    Transport adapter pacing a connection's Graph requests and retrying throttled ones.
+
+    Every request waits for the app's and its mailbox's token buckets and holds
+    one of the mailbox's MAILBOX_CONCURRENCY slots while in flight. Throttled
+    responses are retried after their Retry-After, or a jittered backoff, with
+    the slot released while waiting.
+    """
+
+    def __init__(self, connection, retries=0, **kwargs):
+        # Only connection errors are retried by urllib3, statuses are retried here
+        super().__init__(
+            max_retries=Retry(
+                total=retries, status=0, backoff_factor=RETRIES_BACKOFF_FACTOR
+            ),
+            **kwargs,
+        )
+        self.connection = connection
+
+    def send(self, request, **kwargs):
+        mailbox = mailbox_of(request.url, getattr(self.connection, "mailbox_key", None) or "me")
+        attempt = 0
+        while True:
+            delay = reserve(mailbox)
+            if delay:
+                throttle_stats.record(limiter_wait_seconds=delay)
+                time.sleep(delay)
+
+            with mailbox_semaphore(mailbox):
+                response = super().send(request, **kwargs)
+            throttle_stats.record(requests=1)
+
+            if response.status_code not in THROTTLED_STATUSES:
+                return response
+            throttle_stats.record(throttled=1)
+            if not should_retry(request.method, response.status_code, attempt):
+                throttle_stats.record(exhausted=1)
+                return response
+
+            delay = backoff_delay(attempt, response.headers.get("Retry-After"))
+            # Release the pooled connection before waiting
+            response.close()
+            throttle_stats.record(retries=1, backoff_seconds=delay)
+            time.sleep(delay)
+            attempt += 1
+
+
+class ThrottledConnection(Connection):
+    """
+    O365 connection whose OAuth session sends requests through a ThrottlingAdapter.
+
+    The token buckets pace requests across connections, so O365's fixed delay
+    between the requests of one connection is not needed.
+    """
+
+    # Identifies the connection's mailbox for the per-mailbox limits
+    mailbox_key = None
+
+    def __init__(self, credentials, **kwargs):
+        kwargs.setdefault("requests_delay", 0)
+        super().__init__(credentials, **kwargs)
+
+    def get_session(self, **kwargs):
+        session = super().get_session(**kwargs)
+        adapter = ThrottlingAdapter(self, retries=self.request_retries)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+
+class GraphAccount(Account):
+    connection_constructor = ThrottledConnection
@@ -1,32 +1,171 @@
-import os
+import os, time, threading, hashlib
+from .body import extract_text
 
-def clean_body(body: str) -> str:
-    """Clean body of a message or event."""
+def clean_body(body: str, limit: int = None, strip_quotes: bool = False) -> str:
+    """
+    Clean body of a message or event.
+
+    Parameters:
+    body (str): The HTML or plain text body.
+    limit (int): Maximum number of characters to return, parsing stops once reached.
+    strip_quotes (bool): Whether to drop quoted reply history, keeping forwarded content.
+    """
     try:
-        from bs4 import BeautifulSoup
+        return extract_text(str(body), limit=limit, strip_quotes=strip_quotes)
+    except Exception:
+        return str(body) if limit is None else str(body)[:limit]
+
+
+"""Seconds a pooled account is reused before its stored token version is checked again."""
+TOKEN_VERSION_CHECK_SECONDS = 60
+
+
+class PooledAccount:
+    """A pooled account, with the version of the stored token it was built from."""
+
+    def __init__(self, account, token_version=None):
+        self.account = account
+        self.token_version = token_version
+        self.checked_at = time.monotonic()
+        self.refresh_lock = threading.Lock()
+
+    def needs_version_check(self):
+        """Whether the stored token should be checked, before a refresh or now and then."""
+        token = self.account.con.token_backend.token
+        return (
+            not token
+            or token.is_access_expired
+            or time.monotonic() - self.checked_at >= TOKEN_VERSION_CHECK_SECONDS
+        )
+
+
+class AccountPool:
+    """
+    Process-wide cache of authenticated O365 accounts.
+
+    Accounts are keyed by interface and credentials, so their HTTP keep-alive
+    session and token state are reused between toolkit calls instead of being
+    rebuilt (and the token re-read from the backend) on every call. Accounts
+    whose stored token was replaced by another process, e.g. a re-authentication
+    in the web process, are rebuilt instead of reused. The stored token is only
+    read before a refresh, or every TOKEN_VERSION_CHECK_SECONDS, so pool hits
+    don't query the database.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._accounts = {}
+        # Serializes creating the account of one key, without blocking other keys
+        self._creating = {}
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.reloads = 0
+
+    def get(self, key, factory, token_version=None):
+        """
+        Return the pooled account for key, creating it with factory on a miss.
+
+        Parameters:
+        token_version (callable): Returns the version of the stored token, and
+            the account is rebuilt when it differs from the one it was built from.
+        """
+        with self._lock:
+            entry = self._accounts.get(key)
+
+        checked = False
+        if entry is not None and token_version is not None and entry.needs_version_check():
+            version = token_version()
+            checked = True
+
+        with self._lock:
+            entry = self._accounts.get(key)
+            if entry is not None and checked:
+                if entry.token_version != version:
+                    # The token was replaced since the account loaded it, so refreshing
+                    # the account's copy would save the old token over the new one
+                    del self._accounts[key]
+                    entry = None
+                    self.reloads += 1
+                else:
+                    entry.checked_at = time.monotonic()
+            if entry is not None:
+                self.hits += 1
+            else:
+                create_lock = self._creating.setdefault(key, threading.Lock())
+
+        if entry is None:
+            # Create the account outside the pool's lock, as it may authenticate
+            # interactively, but only once for concurrent callers of the same key
+            with create_lock:
+                with self._lock:
+                    entry = self._accounts.get(key)
+                    if entry is None:
+                        self.misses += 1
+                if entry is None:
+                    account = factory()
+                    if account is None:
+                        return None
+                    version = token_version() if token_version is not None else None
+                    entry = PooledAccount(account, version)
+                    with self._lock:
+                        self._accounts[key] = entry
 
-        try:
-            # Remove HTML
-            soup = BeautifulSoup(str(body), "html.parser")
-            body = soup.get_text()
+        self._refresh_if_expired(entry, token_version)
+        return entry.account
 
-            # Remove return characters
-            body = "".join(body.splitlines())
+    def _refresh_if_expired(self, entry, token_version=None):
+        """Refresh an expired access token once, even with concurrent callers."""
+        token = entry.account.con.token_backend.token
+        if not token or not token.is_access_expired:
+            return
 
-            # Remove extra spaces
-            body = " ".join(body.split())
+        with entry.refresh_lock:
+            # Another thread may have refreshed the token while we waited
+            token = entry.account.con.token_backend.token
+            if token.is_access_expired and entry.account.con.refresh_token():
+                # The refreshed token is saved as a new version, which is this account's
+                if token_version is not None:
+                    entry.token_version = token_version()
+                    entry.checked_at = time.monotonic()
+                with self._lock:
+                    self.refreshes += 1
 
-            return str(body)
-        except Exception:
-            return str(body)
-    except ImportError:
-        return str(body)
+    def recheck(self, interface=None):
+        """Checks the stored token of pooled accounts on their next use, e.g. after a 401."""
+        with self._lock:
+            for key, entry in self._accounts.items():
+                if interface is None or key[0] == interface:
+                    entry.checked_at = float("-inf")
+
+    def invalidate(self, interface=None):
+        """Drop pooled accounts, optionally only those for one interface."""
+        with self._lock:
+            for key in list(self._accounts):
+                if interface is None or key[0] == interface:
+                    del self._accounts[key]
+
+    def stats(self):
+        """Return the pool's size and hit/miss/refresh counters."""
+        with self._lock:
+            return {
+                "accounts": len(self._accounts),
+                "hits": self.hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "reloads": self.reloads,
+            }
+
+
+"""Process-wide account pool shared by all toolkit functions."""
+account_pool = AccountPool()
 
 
 def authenticate(interface="cli"):
     """Authenticate using the Microsoft Grah API"""
     try:
-        from O365 import Account
+        # Accounts send their requests through the throttling-aware transport
+        from .throttling import GraphAccount as Account
     except ImportError as e:
         raise ImportError(
             "Cannot import 0365. Please install the package with `pip install O365`."
@@ -44,8 +183,57 @@ def authenticate(interface="cli"):
         )
         return None
 
+    # Email deployments can serve several tenants, each with their own token
+    tenant = None
+    if interface == "email":
+        from ..tenants import current_tenant
+
+        tenant = current_tenant()
+
+    # Key the pool by a digest of the secret so it is never held in the key
+    key = (
+        interface,
+        client_id,
+        hashlib.sha256(client_secret.encode()).hexdigest(),
+        tenant.pk if tenant is not None else None,
+    )
+
+    return account_pool.get(
+        key,
+        lambda: _create_account(Account, credentials, interface, tenant),
+        token_version=(lambda: stored_token_version(tenant)) if interface == "email" else None,
+    )
+
+
+def stored_token_version(tenant=None):
+    """
+    Identifies the latest stored token of the email interface, or of a tenant.
+
+    Every process saves a token as a new row, so the latest row's id and update
+    time change whenever another process re-authenticates or refreshes it.
+    """
+    from ..models import TokenModel
+
+    return (
+        TokenModel.objects.filter(tenant=tenant)
+        .order_by("-created_at")
+        .values_list("pk", "updated_at")
+        .first()
+    )
+
+
+def _create_account(Account, credentials, interface, tenant=None):
+    """Build and authenticate a new account for the given interface"""
     if interface == "cli":
         account = Account(credentials)
+    elif interface == "email" and tenant is not None:
+        from ..models import TokenModel
+        from ..tenants import TenantAccount, TenantTokenBackend, graph_budget
+
+        # Keep the tenant's token apart, and its Graph requests within its budget
+        token_backend = TenantTokenBackend(TokenModel, tenant)
+        account = TenantAccount(credentials, token_backend=token_backend)
+        account.con.budget = graph_budget(tenant)
     elif interface == "email":
         from ..models import TokenModel
         from O365.utils import DjangoTokenBackend
@@ -54,6 +242,9 @@ def authenticate(interface="cli"):
         token_backend = DjangoTokenBackend(token_model=TokenModel)
         account = Account(credentials, token_backend=token_backend)
 
+    # Requests to /me share the per-mailbox limits of the tenant, or of the interface
+    account.con.mailbox_key = tenant.slug if tenant is not None else interface
+
     if account.is_authenticated is False:
         if not account.authenticate(
             scopes=[
@@ -1,10 +1,20 @@
 # email_service/urls.py
 
 from django.urls import path
-from .views import ProcessEmailView, AuthenticationView, AuthenticationCallbackView
+from .views import (
+    ProcessEmailView,
+    AsyncProcessEmailView,
+    GraphNotificationView,
+    ToolStatsView,
+    AuthenticationView,
+    AuthenticationCallbackView,
+)
 
 urlpatterns = [
     path("process-email/", ProcessEmailView.as_view(), name="process_email"),
+    path("process-email-async/", AsyncProcessEmailView.as_view(), name="process_email_async"),
+    path("notifications/", GraphNotificationView.as_view(), name="graph_notifications"),
+    path("tool-stats/", ToolStatsView.as_view(), name="tool_stats"),
     path("authenticate/", AuthenticationView.as_view(), name='authentication'),
     path("authenticate_callback/", AuthenticationCallbackView.as_view(), name='authentication_callback'),
 ]
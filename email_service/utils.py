@@ -1,67 +1,70 @@
-import os, pprint, json, time
+import time, contextvars
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
-from openai import OpenAI
-from .tools.o365_toolkit import (
-    o365search_emails,
-    o365search_email,
-    o365search_events,
-    o365send_message,
-    o365reply_message,
-    o365send_event,
-    o365find_free_time_slots,
-    tools,
-    toolkit_prompt,
-)
+from zoneinfo import ZoneInfo
+from openai import APIConnectionError, NotFoundError
+from .tools.o365_toolkit import tools, toolkit_prompt, toolkit_registry
 from .tools.utils import authenticate
+from .tools.serialize import serialize_output
+from .tools.freebusy import describe_business_hours
+from .tools.profile import get_profile, profile_business_hours
+from .assistants import forget_missing_assistant, get_or_create_assistant
+from .openai_clients import openai_client, rate_limits
 
 assistant_first_name = "Monica"
 assistant_last_name = "Ingenio"
 assistant_name = assistant_first_name + " A. " + assistant_last_name
-business_hours = "(09:00:00 to 17:00:00)"
+business_hours = describe_business_hours()
 
+# Polling backoff bounds used when the streaming API is not in use
+POLL_MIN_DELAY_SECONDS = 0.05
+POLL_MAX_DELAY_SECONDS = 2
+# Stream events and run statuses that end a run without a response
+RUN_FAILED_EVENTS = ("thread.run.failed", "thread.run.cancelled", "thread.run.expired")
+RUN_FAILED_STATUSES = ("failed", "cancelled", "expired")
+RUN_FAILED_RESPONSE = "Run failed try again!"
+# Maximum number of read-only tools running concurrently within one step
+MAX_TOOL_WORKERS = 5
+
+
+def assistant_names(interface="cli"):
+    """
+    Returns the assistant's first and last names.
+
+    Email deployments serving several executives take them from the current
+    tenant's persona.
+    """
+    if interface == "email":
+        from .tenants import current_tenant
+
+        tenant = current_tenant()
+        if tenant is not None:
+            return tenant.assistant_first_name, tenant.assistant_last_name
+    return assistant_first_name, assistant_last_name
+
+
+def build_assistant_instructions(debug=False, interface="cli"):
+    """
+    Builds the static instructions for the long-lived Assistant.
+
+    These only depend on the interface and debug flag, so the registered Assistant
+    can be reused across days and users. Per-user and per-day context is passed to
+    each run by build_context_instructions instead.
+    """
+    first_name, last_name = assistant_names(interface)
+    name = first_name + " A. " + last_name
 
-def create_client(debug=False, model=None, interface="cli"):
-    # Retrieve user information
-    account = authenticate(interface=interface)
-    ## Code below pulls user's time zone from Office365
-    ## However, value is innacurate during DST in the US
-    # mailbox = account.mailbox()
-    # mailboxsettings = mailbox.get_settings()
-    # mailbox = account.mailbox()
-    # timezone = mailboxsettings.timezone
-    timezone = "America/New_York"
-    directory = account.directory(resource="me")
-    user = directory.get_current_user()
-    client_name = user.full_name
-    client_email = user.mail
-
-    # Set values for global variables
-    current_date = dt.now()
-    formatted_date = current_date.strftime("%A, %B %d, %Y")
-    openai_api_key = os.environ.get("OPENAI_API_KEY")
     assistant_instructions = (
         "You are an AI Administrative Assistant called "
-        + assistant_name
-        + ", and I am your executive. My name is "
-        + client_name
-        + ". My email is "
-        + client_email
-        + ", and I am in the "
-        + timezone
-        + " timezone. Today is "
-        + formatted_date
-        + "."
-        + "My business hours are "
-        + business_hours
-        + " of my time zone. "
-        + "I am not free outside these times so don't recomment times outside these business hours. "
+        + name
+        + ", and I am your executive. "
     )
 
     # Add the email prompt if the user interacts via email
     if interface == "email":
         assistant_instructions = (
             assistant_instructions
-            + "I will send you requests in an email that start with the phrase 'Hi Monica, '."
+            + "I will send you requests in an email that start with the phrase 'Hi " + first_name + ", '."
             + "Always respond to my requests either with the answer, or a description of the task you performed after you performed it."
             + "Respond always in HTML using only <br> tags for spacing between paragraphs. Do not use <p> tags for paragraph formatting, as they may not render correctly in email clients."
             + "Do not ever respond using markdown formatting, code block tags, or any other markup language."
@@ -73,7 +76,7 @@ def create_client(debug=False, model=None, interface="cli"):
             + "<ul><li>8:00 am - 9:00 am GMT</li><li>11:00 am - 1:00 pm GMT</li><li>3:00 pm - 4:00 pm EST</li>"
             + "</ul></li><li>Friday, Oct. 4<ul><li>8:00 am - 9:00 am GMT</li><li>11:00 am - 1:00 pm GMT</li>"
             + "<li>3:00 pm - 4:00 pm GMT</li></ul></li></ul><br>This is the last line or paragraph with a <b>bolded</b> word for emphasis."
-            + "<br><br><br>Best,<br><br>Monica A. Ingenio<br><i>(OpenAI-Powered Assistant in Beta, please excuse any "
+            + "<br><br><br>Best,<br><br>" + name + "<br><i>(OpenAI-Powered Assistant in Beta, please excuse any "
             + "mistakes)</i><br><br>"
         )
 
@@ -93,95 +96,379 @@ def create_client(debug=False, model=None, interface="cli"):
     # Add the toolkit prompt
     assistant_instructions = assistant_instructions + toolkit_prompt
 
-    client = OpenAI(
-        api_key=openai_api_key,
+    return assistant_instructions
+
+
+def build_context_instructions(interface="cli"):
+    """Builds the per-user and per-day context passed to each run as additional instructions."""
+    # Retrieve user information, cached so most runs don't call Graph
+    account = authenticate(interface=interface)
+    return profile_context_instructions(get_profile(account, interface))
+
+
+def profile_context_instructions(profile):
+    """Formats the context instructions of a user profile, with today's date in their time zone."""
+    hours, hours_timezone = profile_business_hours(profile)
+
+    current_date = dt.now(ZoneInfo(profile["timezone"]))
+    formatted_date = current_date.strftime("%A, %B %d, %Y")
+
+    return format_context_instructions(
+        profile["name"],
+        profile["email"],
+        profile["timezone"],
+        formatted_date,
+        describe_business_hours(hours),
+        hours_timezone.key,
     )
 
-    assistant = client.beta.assistants.create(
-        name="AI Administrative Assistant",
+
+def format_context_instructions(
+    client_name, client_email, timezone, formatted_date, hours=None, hours_timezone=None
+):
+    """
+    Formats the per-run context instructions.
+
+    Parameters:
+    hours (str): The user's business hours, as described by describe_business_hours
+        (default is the standard business_hours).
+    hours_timezone (str): Time zone of the business hours, if not the user's.
+    """
+    return (
+        "My name is "
+        + client_name
+        + ". My email is "
+        + client_email
+        + ", and I am in the "
+        + timezone
+        + " timezone. Today is "
+        + formatted_date
+        + "."
+        + "My business hours are "
+        + (hours or business_hours)
+        + (
+            " of my time zone. "
+            if hours_timezone in (None, timezone)
+            else " of the " + hours_timezone + " time zone. "
+        )
+        + "I am not free outside these times so don't recomment times outside these business hours. "
+    )
+
+
+def create_client(debug=False, model=None, interface="cli", thread_id=None, client=None):
+    """
+    Creates the OpenAI client, the Assistant and a thread to run prompts on.
+
+    Parameters:
+    thread_id (str): An existing thread to continue instead of creating one.
+    client (OpenAI): The client to use (default is the process-wide one).
+
+    Raises:
+    openai.NotFoundError: If the thread_id doesn't exist.
+    """
+    assistant_instructions = build_assistant_instructions(debug=debug, interface=interface)
+
+    # The process-wide client keeps its connections alive between runs
+    client = client or openai_client()
+
+    assistant = get_or_create_assistant(
+        client,
         instructions=assistant_instructions,
         model=model,
         tools=tools,
-        temperature=0.05
+        temperature=0.05,
+        interface=interface,
     )
 
-    thread = client.beta.threads.create()
+    if thread_id is not None:
+        thread = client.beta.threads.retrieve(thread_id)
+    else:
+        thread = client.beta.threads.create()
 
     return client, assistant, thread
 
 
-def run_prompt(prompt, client, assistant, thread):
+def run_prompt(prompt, client, assistant, thread, interface="cli", additional_instructions=None):
     message = client.beta.threads.messages.create(
         thread_id=thread.id,
         role="user",
         content=prompt,
     )
 
+    # Per-user and per-day context is sent with the run, keeping the Assistant static
+    if additional_instructions is None:
+        additional_instructions = build_context_instructions(interface=interface)
+
     run = client.beta.threads.runs.create(
         thread_id=thread.id,
         assistant_id=assistant.id,
+        additional_instructions=additional_instructions,
     )
     return run
 
 
+def execute_tool_call(tool_call, interface="cli"):
+    """
+    Executes a single tool call through the toolkit registry and returns its output as a string.
+
+    A tool that raises is reported to the model as its output, so the other tool
+    calls of the step still get theirs submitted.
+    """
+    try:
+        output = toolkit_registry.dispatch(
+            tool_call.function.name, tool_call.function.arguments, interface=interface
+        )
+    except Exception as e:
+        print("Error: " + tool_call.function.name + " failed: " + str(e))
+        return "Error: " + tool_call.function.name + " failed: " + str(e)
+
+    # Serialize the function output into compact JSON within the token budget
+    return serialize_output(output, name=tool_call.function.name)
+
+
+def _execute_tool_call_in_thread(tool_call, interface="cli"):
+    """Executes a tool call on a worker thread, releasing its database connections."""
+    try:
+        return execute_tool_call(tool_call, interface=interface)
+    finally:
+        if interface == "email":
+            from django.db import connections
+
+            connections.close_all()
+
+
+def execute_tool_calls(tool_calls, interface="cli"):
+    """
+    Executes the tool calls of a requires_action step and returns their outputs.
+
+    Read-only tools run concurrently on up to MAX_TOOL_WORKERS threads, while tools
+    that write to the mailbox or calendar run one at a time in the order the model
+    requested them. Outputs are returned in the order of the tool calls.
+    """
+    read_calls = [c for c in tool_calls if toolkit_registry.is_read_only(c.function.name)]
+    outputs = {}
+
+    if len(read_calls) > 1:
+        with ThreadPoolExecutor(max_workers=min(MAX_TOOL_WORKERS, len(read_calls))) as executor:
+            futures = {
+                # Run each call in a copy of this context, so tools see the current tenant
+                tool_call.id: executor.submit(
+                    contextvars.copy_context().run,
+                    _execute_tool_call_in_thread,
+                    tool_call,
+                    interface,
+                )
+                for tool_call in read_calls
+            }
+
+            # Write tools run on this thread while the reads are in flight
+            for tool_call in tool_calls:
+                if tool_call.id not in futures:
+                    outputs[tool_call.id] = execute_tool_call(tool_call, interface=interface)
+
+            for tool_call_id, future in futures.items():
+                outputs[tool_call_id] = future.result()
+    else:
+        for tool_call in tool_calls:
+            outputs[tool_call.id] = execute_tool_call(tool_call, interface=interface)
+
+    return [
+        {"tool_call_id": tool_call.id, "output": outputs[tool_call.id]}
+        for tool_call in tool_calls
+    ]
+
+
+def execute_prompt(
+    prompt,
+    client,
+    assistant,
+    thread,
+    model,
+    debug=False,
+    interface="cli",
+    stream=True,
+    additional_instructions=None,
+    on_text=None,
+):
+    """
+    Runs a prompt on the thread and returns the Assistant's response.
+
+    Parameters:
+    stream (bool): Whether to use the streaming event API. If False, or if the stream
+        breaks after the run was created, the run is polled with poll_for_response.
+    on_text (callable): Optional callback receiving response text deltas while streaming.
+
+    Returns:
+    str: The text of the Assistant's response.
+    """
+    try:
+        # Runs queue for one of their model's slots, and pace their requests to its rate limits
+        with rate_limits.slot(model):
+            if not stream:
+                run = run_prompt(
+                    prompt,
+                    client,
+                    assistant,
+                    thread,
+                    interface=interface,
+                    additional_instructions=additional_instructions,
+                )
+                return poll_for_response(client, thread, run, model, debug, interface)
+
+            client.beta.threads.messages.create(
+                thread_id=thread.id,
+                role="user",
+                content=prompt,
+            )
+
+            if additional_instructions is None:
+                additional_instructions = build_context_instructions(interface=interface)
+
+            stream_manager = client.beta.threads.runs.stream(
+                thread_id=thread.id,
+                assistant_id=assistant.id,
+                additional_instructions=additional_instructions,
+            )
+            return stream_for_response(client, thread, stream_manager, model, debug, interface, on_text)
+    except NotFoundError:
+        # The Assistant may have been deleted outside the registry, the next run recreates it
+        forget_missing_assistant(client, assistant.id, interface)
+        raise
+
+
+class RunEvents:
+    """
+    The state of a run followed on its event stream.
+
+    Shared by stream_for_response and astream_for_response, which only differ in
+    how they read the events and execute the tool calls.
+    """
+
+    def __init__(self, debug=False, on_text=None):
+        self.debug = debug
+        self.on_text = on_text
+        self.run = None
+        self.response = None
+        self.failed = False
+
+    def handle(self, event):
+        """
+        Applies a stream event to the run's state.
+
+        Returns:
+        list: The tool calls to execute when the run requires action, else None.
+        """
+        if event.event.startswith("thread.run.") and not event.event.startswith(
+            "thread.run.step"
+        ):
+            self.run = event.data
+            if self.debug:
+                print("The Assistant's Status is: " + self.run.status)
+
+        if event.event == "thread.message.delta" and self.on_text is not None:
+            for content in event.data.delta.content or []:
+                if content.type == "text" and content.text.value:
+                    self.on_text(content.text.value)
+        elif event.event == "thread.message.completed":
+            self.response = event.data.content[0].text.value
+        elif event.event == "thread.run.requires_action":
+            return self.run.required_action.submit_tool_outputs.tool_calls
+        elif event.event in RUN_FAILED_EVENTS:
+            self.failed = True
+        return None
+
+    def run_to_poll(self, error):
+        """
+        Returns the run to poll after the stream broke with error, which is raised
+        again if the run was never created.
+        """
+        if self.run is None:
+            raise error
+        return self.run
+
+
+class PollBackoff:
+    """
+    Delays between the polls of a run, shared by poll_for_response and apoll_for_response.
+
+    The delay starts at POLL_MIN_DELAY_SECONDS and doubles up to
+    POLL_MAX_DELAY_SECONDS, restarting whenever the run changes status.
+    """
+
+    def __init__(self, debug=False):
+        self.debug = debug
+        self.delay = POLL_MIN_DELAY_SECONDS
+        self.last_status = None
+
+    def next_delay(self, status):
+        """Returns the delay before the next poll of a run with status."""
+        if self.debug:
+            print("The Assistant's Status is: " + status)
+
+        # Poll quickly right after a transition, then back off exponentially
+        if status != self.last_status or status == "requires_action":
+            self.delay = POLL_MIN_DELAY_SECONDS
+        else:
+            self.delay = min(self.delay * 2, POLL_MAX_DELAY_SECONDS)
+        self.last_status = status
+        return self.delay
+
+
+def latest_message_text(messages):
+    """The text of the newest message of a thread's message list, or None if it's empty."""
+    if messages.data:
+        return messages.data[0].content[0].text.value
+    return None
+
+
+def stream_for_response(
+    client, thread, stream_manager, model, debug=False, interface="cli", on_text=None
+):
+    """Consumes a run's event stream, executing tool calls as soon as they are requested."""
+    events = RunEvents(debug, on_text)
+
+    try:
+        while stream_manager is not None:
+            with stream_manager as stream:
+                stream_manager = None
+
+                for event in stream:
+                    tool_calls = events.handle(event)
+                    if tool_calls is not None:
+                        # The run pauses here, so submit the outputs on a new stream
+                        stream_manager = client.beta.threads.runs.submit_tool_outputs_stream(
+                            thread_id=thread.id,
+                            run_id=events.run.id,
+                            tool_outputs=execute_tool_calls(tool_calls, interface=interface),
+                        )
+                    elif events.failed:
+                        return RUN_FAILED_RESPONSE
+    except APIConnectionError as e:
+        # The stream broke, so fall back to polling the run if it was created
+        return poll_for_response(client, thread, events.run_to_poll(e), model, debug, interface)
+
+    return events.response
+
+
 def poll_for_response(client, thread, run, model, debug=False, interface="cli"):
-    LOOP_DELAY_SECONDS = 3
+    """Polls a run until it completes, executing tool calls when requested, see PollBackoff."""
+    backoff = PollBackoff(debug)
 
     while True:
         run = client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
-        status = run.status
-
-        if status == "completed":
-            response = client.beta.threads.messages.list(thread_id=thread.id)
-            if response.data:
-                return response.data[0].content[0].text.value
-            break
-        elif status == "requires_action":
-            tools_outputs = []
-
-            for tool_call in run.required_action.submit_tool_outputs.tool_calls:
-                tool_call_id = tool_call.id
-                function_name = tool_call.function.name
-                function_arguments = tool_call.function.arguments
-                function_arguments = json.loads(function_arguments)
-
-                # Case statement to execute each toolkit function
-                if function_name == "o365search_emails":
-                    output = o365search_emails(
-                        **function_arguments, interface=interface
-                    )
-                elif function_name == "o365search_email":
-                    output = o365search_email(**function_arguments, interface=interface)
-                elif function_name == "o365search_events":
-                    output = o365search_events(
-                        **function_arguments, interface=interface
-                    )
-                elif function_name == "o365send_message":
-                    output = o365send_message(**function_arguments, interface=interface)
-                elif function_name == "o365send_event":
-                    output = o365send_event(**function_arguments, interface=interface)
-                elif function_name == "o365reply_message":
-                    output = o365reply_message(
-                        **function_arguments, interface=interface
-                    )
-                elif function_name == "o365find_free_time_slots":
-                    output = o365find_free_time_slots(**function_arguments, interface=interface)
-
-                # Clean the function output into JSON-like output
-                output = pprint.pformat(output)
-                tool_output = {"tool_call_id": tool_call_id, "output": output}
-                tools_outputs.append(tool_output)
+
+        if run.status == "completed":
+            return latest_message_text(client.beta.threads.messages.list(thread_id=thread.id))
+        elif run.status == "requires_action":
+            tools_outputs = execute_tool_calls(
+                run.required_action.submit_tool_outputs.tool_calls, interface=interface
+            )
 
             if run.required_action.type == "submit_tool_outputs":
                 client.beta.threads.runs.submit_tool_outputs(
                     thread_id=thread.id, run_id=run.id, tool_outputs=tools_outputs
                 )
+        elif run.status in RUN_FAILED_STATUSES:
+            return RUN_FAILED_RESPONSE
 
-        elif status == "failed":
-            return "Run failed try again!"
-            break
-
-        if debug:
-            print("The Assistant's Status is: " + status)
-
-        time.sleep(LOOP_DELAY_SECONDS)
+        time.sleep(backoff.next_delay(run.status))
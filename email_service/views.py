@@ -1,116 +1,170 @@
 # email_service/views.py
 
-import os, json
-from django.http import JsonResponse, HttpResponseRedirect
+import os, json, hmac, asyncio, threading
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, JsonResponse, HttpResponseRedirect
 from django.urls import reverse
+from django.utils.decorators import method_decorator
 from django.views import View
-from .models import ProcessedEmail, TokenModel, AuthenticationState
+from django.views.decorators.csrf import csrf_exempt
+from .models import TokenModel, AuthenticationState, Tenant
 from django.conf import settings
-from .utils import (
-    create_client,
-    run_prompt,
-    poll_for_response,
-    assistant_first_name,
-)
-from .tools.utils import authenticate
-from datetime import datetime as dt
-from openai import OpenAI
-from .tools.o365_toolkit import (
-    o365search_emails,
-    o365search_email,
-    o365reply_message,
-    o365delete_message,
-)
+from .jobs import enqueue_email, enqueue_all_pending_emails, job_stats, awork
+from .subscriptions import is_valid_notification, needs_renewal, handle_lifecycle_events
+from .tools.utils import account_pool
+from .tools.o365_toolkit import toolkit_registry
+from .tools.serialize import output_stats
+from .tools.throttling import throttle_stats
+from .openai_clients import rate_limits
+from .tools.profile import invalidate_profile
+from .tenants import tenant_context, TenantTokenBackend
 from O365 import Account
 from O365.utils import DjangoTokenBackend
 
-class ProcessEmailView(View):
-    assistant_first_name = "Monica"
+# Maximum number of emails AsyncProcessEmailView processes at a time
+ASYNC_CONCURRENCY = 50
+# The background task processing the queue, at most one per process
+background_worker = None
+# Authentication states searched for the one a callback answers
+AUTHENTICATION_STATE_LOOKBACK = 20
 
+class ProcessEmailView(View):
     def get(self, request):
         try:
-            # Assign constants
-            model = "gpt-4o"
-
-            # Get prompt email
-            prompt, message_id, call = self.get_prompt_email()
+            # Queue every pending request email, for deployments without notifications
+            message_ids = enqueue_all_pending_emails()
 
-            # Check if the email has already been processed
-            if ProcessedEmail.objects.filter(message_id=message_id).exists():
+            if not message_ids:
                 return JsonResponse(
-                    {
-                        "status": "skipped",
-                        "message": "Email has already been processed.",
-                    }
+                    {"status": "skipped", "message": "No new emails to process."}
                 )
 
-            # Check if the email prompt starts with "Hi {assistant_first_name}"
-            if not call:
-                # Save the processed message_id to the database
-                ProcessedEmail.objects.create(message_id=message_id)
+            return JsonResponse({"status": "queued", "message_ids": message_ids})
 
-                return JsonResponse(
-                    {
-                        "status": "skipped",
-                        "message": "Email includes call, but does not start with it.",
-                    }
-                )
-
-            # Create client, assistant, and thread
-            client, assistant, thread = create_client(
-                debug=False, model=model, interface="email"
-            )
+        except Exception as e:
+            return JsonResponse({"status": "error", "message": str(e)}, status=500)
 
-            # Run prompt
-            run = run_prompt(prompt, client, assistant, thread)
+def start_background_worker():
+    """
+    Starts processing the job queue on the running event loop, unless it already is.
 
-            # Poll for response
-            response = poll_for_response(client = client, thread = thread, run = run, model = model, interface = "email")
+    The running task keeps claiming jobs until the queue is empty, so jobs queued
+    by overlapping requests are picked up without starting another one.
+    """
+    global background_worker
+    if (
+        background_worker is None
+        or background_worker.done()
+        or background_worker.get_loop() is not asyncio.get_running_loop()
+    ):
+        background_worker = asyncio.ensure_future(awork(ASYNC_CONCURRENCY, once=True))
+    return background_worker
 
-            # Reply to the email
-            reply = o365reply_message(
-                message_id,
-                response,
-                interface="email",
-                reply_to_sender=True,
-            )
+class AsyncProcessEmailView(View):
+    async def get(self, request):
+        try:
+            # Queue every pending request email, then process the queue on this
+            # server's event loop, for ASGI deployments without a worker process
+            message_ids = await sync_to_async(enqueue_all_pending_emails)()
 
-            # Save the processed message_id to the database
-            ProcessedEmail.objects.create(message_id=message_id)
+            start_background_worker()
 
-            # Delete the processed email
-            output = o365delete_message(message_id, interface="email")
+            if not message_ids:
+                return JsonResponse(
+                    {"status": "skipped", "message": "No new emails to process."}
+                )
 
-            return JsonResponse({"status": "success", "reply": reply})
+            return JsonResponse({"status": "queued", "message_ids": message_ids})
 
         except Exception as e:
             return JsonResponse({"status": "error", "message": str(e)}, status=500)
 
-    def get_prompt_email(self):
-        # Authenticate user
-        account = authenticate(interface="email")
-        directory = account.directory(resource="me")
-        user = directory.get_current_user()
-        client_email = user.mail
+@method_decorator(csrf_exempt, name="dispatch")
+class GraphNotificationView(View):
+    def post(self, request):
+        # Graph validates the url when subscribing by echoing back a validation token
+        validation_token = request.GET.get("validationToken")
+        if validation_token is not None:
+            return HttpResponse(validation_token, content_type="text/plain")
 
-        query = (
-            f"from:{client_email} to:{client_email} body:'Hi {assistant_first_name}, '"
-        )
+        try:
+            notifications = json.loads(request.body).get("value", [])
+        except (ValueError, AttributeError):
+            return JsonResponse(
+                {"status": "error", "message": "Invalid notification."}, status=400
+            )
 
-        emails = o365search_emails(query=query, folder="inbox", max_results=5, interface="email")
+        # Notifications of each tenant's subscription are handled for that tenant
+        tenants = {}
+        for notification in notifications:
+            # Ignore notifications that don't carry our subscription's clientState
+            subscription = is_valid_notification(notification)
+            if subscription is None:
+                continue
+
+            message_ids, lifecycle_events = tenants.setdefault(
+                subscription.tenant, ([], [])
+            )
+            if "lifecycleEvent" in notification:
+                lifecycle_events.append(notification["lifecycleEvent"])
+            elif notification.get("changeType") == "created":
+                message_id = (notification.get("resourceData") or {}).get("id")
+                if message_id and message_id not in message_ids:
+                    message_ids.append(message_id)
 
-        if not emails:
-            raise ValueError("No emails found matching the query.")
+        for tenant, (message_ids, lifecycle_events) in tenants.items():
+            with tenant_context(tenant):
+                # Workers check whether each email is a request when processing it
+                for message_id in message_ids:
+                    enqueue_email(message_id)
 
-        # Sort emails based on date
-        emails.sort(key=lambda x: x["date"], reverse=True)
+                # Graph retries notifications that are not acknowledged within seconds
+                if lifecycle_events or needs_renewal():
+                    threading.Thread(
+                        target=handle_lifecycle_events,
+                        args=(lifecycle_events, tenant),
+                        daemon=True,
+                    ).start()
 
-        # Get the latest email
-        message_id = emails[0]["message_id"]
-        email = o365search_email(message_id=message_id, interface="email")
-        call = emails[0]["body"].startswith(f"Hi {assistant_first_name},")
+        return HttpResponse(status=202)
 
-        return str(email), message_id, call
+def is_admin_request(request):
+    """
+    Whether a request may see the deployment's operational data: it comes from an
+    active staff user, like the Django admin requires, or carries the admin token
+    set in ADMINGPT_ADMIN_TOKEN as "Authorization: Bearer <token>".
+    """
+    user = getattr(request, "user", None)
+    if user is not None and user.is_active and user.is_staff:
+        return True
+    token = os.environ.get("ADMINGPT_ADMIN_TOKEN")
+    return bool(token) and hmac.compare_digest(
+        request.headers.get("Authorization", ""), "Bearer " + token
+    )
+
+class AdminRequiredMixin:
+    """Rejects requests that don't pass is_admin_request with a 403."""
+
+    def dispatch(self, request, *args, **kwargs):
+        if not is_admin_request(request):
+            return JsonResponse({"status": "error", "message": "Forbidden."}, status=403)
+        return super().dispatch(request, *args, **kwargs)
+
+class ToolStatsView(AdminRequiredMixin, View):
+    def get(self, request):
+        # Per-process tool latency and error statistics, account pool counters,
+        # the number of queued email jobs, tool output token counts, Graph
+        # throttling counters and OpenAI rate limits per model
+        return JsonResponse(
+            {
+                "tools": toolkit_registry.stats(),
+                "accounts": account_pool.stats(),
+                "jobs": job_stats(),
+                "outputs": output_stats.stats(),
+                "graph": throttle_stats.stats(),
+                "openai": rate_limits.stats(),
+            }
+        )
 
 class AuthenticationView(View):
     def get(self, request):
@@ -126,6 +180,13 @@ class AuthenticationView(View):
                 "tokens: https://learn.microsoft.com/en-us/graph/auth/"
         )
 
+        # Deployments serving several executives authorize each one's mailbox
+        tenant = None
+        if request.GET.get("tenant"):
+            tenant = Tenant.objects.filter(slug=request.GET["tenant"]).first()
+            if tenant is None:
+                return JsonResponse({"status": "error", "message": "Unknown tenant."}, status=404)
+
         account = Account(credentials)
         
         # Callback URL for OAuth step two
@@ -145,12 +206,29 @@ class AuthenticationView(View):
         )
         state = json.dumps(state)
 
-        # Store the state in the database
-        AuthenticationState.objects.create(state=state)
+        # Store the state in the database, with the tenant whose mailbox is authorized
+        AuthenticationState.objects.create(state=state, tenant=tenant)
         
         # Redirect to Microsoft login
         return HttpResponseRedirect(url)
 
+def _find_authentication_state(state):
+    """
+    Returns the stored authentication state matching a callback's state parameter,
+    or the latest one if the callback has none.
+    """
+    states = AuthenticationState.objects.order_by("-created_at")
+    if not state:
+        return states.first()
+    for saved in states.select_related("tenant")[:AUTHENTICATION_STATE_LOOKBACK]:
+        try:
+            flow = json.loads(saved.state)
+        except ValueError:
+            continue
+        if isinstance(flow, dict) and flow.get("state") == state:
+            return saved
+    return None
+
 class AuthenticationCallbackView(View):
     def get(self, request):
         # Handle the callback from Microsoft login
@@ -165,16 +243,21 @@ class AuthenticationCallbackView(View):
                 "tokens: https://learn.microsoft.com/en-us/graph/auth/"
         )
 
-        # Use the Django token backend to store the token
-        token_backend = DjangoTokenBackend(token_model=TokenModel)
-        account = Account(credentials, token_backend=token_backend)
-        
-        # Retrieve the saved state from the database
-        saved_state = AuthenticationState.objects.latest('created_at')
-        saved_state = json.loads(saved_state.state)
-        
+        # Retrieve the saved state this callback answers from the database
+        saved = _find_authentication_state(request.GET.get("state"))
+        if saved is None:
+            return JsonResponse({"status": "error", "message": "Invalid state."}, status=400)
+        saved_state = json.loads(saved.state)
+
         if not saved_state:
             return JsonResponse({"status": "error", "message": "Invalid state."}, status=400)
+
+        # Use the Django token backend to store the token, apart for each tenant
+        if saved.tenant is not None:
+            token_backend = TenantTokenBackend(TokenModel, saved.tenant)
+        else:
+            token_backend = DjangoTokenBackend(token_model=TokenModel)
+        account = Account(credentials, token_backend=token_backend)
         
         # Build the callback URL
         callback = request.build_absolute_uri(reverse('authentication_callback'))
@@ -188,4 +271,10 @@ class AuthenticationCallbackView(View):
             flow=saved_state
         )
 
+        # Drop pooled accounts so the next request picks up the new token, and
+        # the cached profile, as the token may belong to another user
+        account_pool.invalidate(interface="email")
+        with tenant_context(saved.tenant):
+            invalidate_profile("email")
+
         return HttpResponseRedirect("https://github.com/sdelgadoc/AdminGPT")